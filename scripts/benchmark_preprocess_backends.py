@@ -0,0 +1,114 @@
+import sys
+sys.path.append("..")
+
+import os
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+from functools import partial
+
+from src.data.descriptors.rdNormalizedDescriptors import RDKit2DNormalized
+from src.data.featurizer import smiles_to_graph_tune
+from src.data.fingerprint import rdkfp_packed
+from src.data.pipeline import ChunkedRunner, descriptor_row, featurize_molecule
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Arguments")
+    parser.add_argument("--smiles_path", type=str, required=True, help='a .csv file with a smiles column or a file with one smiles per line')
+    parser.add_argument("--n_mols", type=int, default=10000, help='benchmark the first n_mols molecules')
+    parser.add_argument("--stages", type=str, default='descriptors,fingerprints,graphs,molecules')
+    parser.add_argument("--backends", type=str, default='process,thread')
+    parser.add_argument("--n_jobs", type=int, default=32)
+    parser.add_argument("--chunk_size", type=int, default=100000)
+    parser.add_argument("--imap_chunksize", type=int, default=None)
+    parser.add_argument("--path_length", type=int, default=5)
+    parser.add_argument("--work_dir", type=str, default=None, help='where the stage chunks are written, defaults to a temporary directory')
+    args = parser.parse_args()
+    return args
+
+def load_smiles(path, n_mols):
+    if path.endswith('.csv'):
+        return pd.read_csv(path).smiles.values.tolist()[:n_mols]
+    with open(path, 'r') as f:
+        return [line.strip('\n') for line, _ in zip(f, range(n_mols))]
+
+def stage_funcs(args):
+    # stage -> (function of a smiles string, ChunkedRunner stage kind)
+    return {
+        'descriptors': (partial(descriptor_row, generator=RDKit2DNormalized()), 'array'),
+        'fingerprints': (rdkfp_packed, 'array'),
+        'graphs': (partial(smiles_to_graph_tune, max_length=args.path_length, n_virtual_nodes=2), 'graphs'),
+        'molecules': (partial(featurize_molecule, generator=RDKit2DNormalized(), max_length=args.path_length,
+                              n_virtual_nodes=2), 'molecules'),
+    }
+
+def same_tensors(a, b):
+    return a.shape == b.shape and bool(((a == b) | (torch.isnan(a) & torch.isnan(b))).all())
+
+def same_graphs(graphs, other):
+    for g, h in zip(graphs, other):
+        if (g is None) != (h is None):
+            return False
+        if g is None:
+            continue
+        if not all(torch.equal(x, y) for x, y in zip(g.edges(), h.edges())):
+            return False
+        for data, other_data in [(g.ndata, h.ndata), (g.edata, h.edata)]:
+            if set(data.keys()) != set(other_data.keys()):
+                return False
+            if not all(same_tensors(data[key], other_data[key]) for key in data.keys()):
+                return False
+    return len(graphs) == len(other)
+
+def same_results(kind, results, other):
+    if kind == 'graphs':
+        return same_graphs(results, other)
+    if kind == 'molecules':
+        # (graphs, sizes, fps, mds)
+        return same_graphs(results[0], other[0]) and all(
+            np.array_equal(a, b, equal_nan=True) for a, b in zip(results[1:], other[1:]))
+    return np.array_equal(results, other, equal_nan=True)
+
+def run_stage(work_dir, backend, name, func, kind, smiless, args):
+    with ChunkedRunner(work_dir, n_jobs=args.n_jobs, chunk_size=args.chunk_size,
+                       imap_chunksize=args.imap_chunksize, backend=backend) as runner:
+        runner.run(name, func, smiless, kind=kind)
+    if kind == 'graphs':
+        results = runner.merge_graphs(name, len(smiless))
+    elif kind == 'molecules':
+        results = runner.merge_molecules(name, len(smiless))
+    else:
+        results = runner.merge_arrays(name, len(smiless))
+    return runner.throughput[name], results
+
+if __name__ == '__main__':
+    args = parse_args()
+    smiless = load_smiles(args.smiles_path, args.n_mols)
+    backends = args.backends.split(',')
+    funcs = stage_funcs(args)
+    root = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='backend_benchmark_')
+    rows = []
+    identical = True
+    for stage in args.stages.split(','):
+        func, kind = funcs[stage]
+        rates, results = {}, {}
+        for backend in backends:
+            work_dir = os.path.join(root, backend)
+            shutil.rmtree(os.path.join(work_dir, stage), ignore_errors=True)
+            print(f'[{stage}] {backend} backend, {args.n_jobs} jobs')
+            rates[backend], results[backend] = run_stage(work_dir, backend, stage, func, kind, smiless, args)
+        reference = results[backends[0]]
+        same = all(same_results(kind, reference, results[backend]) for backend in backends[1:])
+        identical &= same
+        rows.append([stage] + [f'{rates[backend]:.1f}' for backend in backends] +
+                    [max(rates, key=rates.get), 'yes' if same else 'NO'])
+    if args.work_dir is None:
+        shutil.rmtree(root)
+
+    print(f'\n{len(smiless)} molecules, {args.n_jobs} jobs, mol/s per backend')
+    print(pd.DataFrame(rows, columns=['stage'] + backends + ['fastest', 'identical']).to_string(index=False))
+    if not identical:
+        sys.exit('results differ between backends')
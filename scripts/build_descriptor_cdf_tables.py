@@ -0,0 +1,25 @@
+import sys
+sys.path.append("..")
+
+import argparse
+
+from src.data.descriptors.cdfTables import CDF_TABLES, buildCdfTables
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Arguments")
+    parser.add_argument("--out_path", type=str, default=CDF_TABLES, help='RDKit2DNormalized loads the tables from the default path')
+    parser.add_argument("--tol", type=float, default=1e-6, help='maximum absolute error of the interpolated cdfs')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    errors = buildCdfTables(args.out_path, tol=args.tol)
+    stored = {name: err for name, err in errors.items() if err <= args.tol}
+    if stored:
+        worst = max(stored, key=stored.get)
+        print(f'tabulated {len(stored)} of {len(errors)} cdfs, max error {stored[worst]:.3g} ({worst})')
+    else:
+        print(f'no cdf could be tabulated within {args.tol:g}')
+    if len(stored) < len(errors):
+        print(f'{len(errors) - len(stored)} cdfs fall back to scipy: {", ".join(sorted(set(errors) - set(stored)))}')
@@ -0,0 +1,45 @@
+import sys
+sys.path.append("..")
+
+import os
+import numpy as np
+import argparse
+
+from src.data.pipeline import ChunkedRunner
+from src.data.molecule_store import deduplicate
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Arguments")
+    parser.add_argument("--data_path", type=str, default='../datasets')
+    parser.add_argument("--corpus", type=str, default='mix.txt', help='pubchem-10m-clean.txt, smiles.smi or mix.txt')
+    parser.add_argument("--out_path", type=str, required=True, help='directory of the deduplicated corpus, it keeps the corpus file name')
+    parser.add_argument("--key", type=str, default='smiles', help='choose from smiles, inchikey')
+    parser.add_argument("--n_jobs", type=int, default=32)
+    parser.add_argument("--work_dir", type=str, default=None, help='where completed chunks are kept for resuming, defaults to <out_path>/preprocess_chunks')
+    parser.add_argument("--chunk_size", type=int, default=100000)
+    parser.add_argument("--imap_chunksize", type=int, default=None)
+    parser.add_argument("--backend", type=str, default='process', help='run the stages in n_jobs processes or threads, choose from process, thread')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(f"{args.data_path}/{args.corpus}", 'r') as f:
+        lines = f.readlines()
+        smiless = [line.strip('\n') for line in lines]
+    os.makedirs(args.out_path, exist_ok=True)
+    work_dir = args.work_dir if args.work_dir is not None else f"{args.out_path}/preprocess_chunks"
+
+    with ChunkedRunner(work_dir, n_jobs=args.n_jobs, chunk_size=args.chunk_size, imap_chunksize=args.imap_chunksize, backend=args.backend) as runner:
+        print('canonicalizing and hashing molecules')
+        source_index, hash_set = deduplicate(runner, smiless, kind=args.key)
+        runner.report()
+        # the keys are merged into source_index and hash_set, the chunks are only kept for resuming
+        runner.cleanup()
+
+    with open(f"{args.out_path}/{args.corpus}", 'w') as f:
+        for i in source_index:
+            f.write(smiless[i] + '\n')
+    # row i of the deduplicated corpus is row source_index[i] of the original one
+    np.save(f"{args.out_path}/source_index.npy", source_index)
+    np.save(f"{args.out_path}/hash_set_{args.key}.npy", hash_set)
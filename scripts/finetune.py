@@ -15,6 +15,7 @@ import wandb
 from src.data.featurizer import Vocab, N_ATOM_TYPES, N_BOND_TYPES
 from src.data.finetune_dataset import MoleculeDataset
 from src.data.collator import Collator_tune
+from src.data.sampler import CostAwareBatchSampler
 from src.model.light import LiGhTPredictor as LiGhT
 from src.trainer.scheduler import PolynomialDecayLR
 from src.trainer.finetune_trainer import Trainer
@@ -56,9 +57,21 @@ def parse_args():
     parser.add_argument("--lr", type=float, default=3e-5)
     parser.add_argument("--cuda", type=str, default='cuda:1')
     parser.add_argument("--n_threads", type=int, default=8)
+    parser.add_argument("--max_batch_cost", type=int, default=None, help='budget of graph nodes or edges per batch; enables cost-aware batching')
+    parser.add_argument("--batch_cost", type=str, default='edges', help='choose from nodes, edges')
+    parser.add_argument("--attention_backend", type=str, default=None, help='overrides the attention_backend of the config, choose from dgl (sparse edge softmax), dense (padded per-graph blocks, for small molecules)')
+    parser.add_argument("--graph_backend", type=str, default='dgl', help='choose from dgl, scatter (batches of plain tensors, the model runs without dgl ops)')
     args = parser.parse_args()
     return args
 
+def get_loader(args, dataset, collator, g, shuffle, drop_last):
+    if args.max_batch_cost is None:
+        return DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle, num_workers=args.n_threads, worker_init_fn=seed_worker, generator=g, drop_last=drop_last, collate_fn=collator)
+    sizes = dataset.graph_sizes()
+    costs = sizes[:, 0] if args.batch_cost == 'nodes' else sizes[:, 1]
+    batch_sampler = CostAwareBatchSampler(costs, args.max_batch_cost, max_batch_size=args.batch_size, shuffle=shuffle, drop_last=drop_last, num_replicas=1, rank=0, seed=args.seed)
+    return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=args.n_threads, worker_init_fn=seed_worker, generator=g, collate_fn=collator)
+
 def get_predictor(d_input_feats, n_tasks, n_layers, predictor_drop, device, d_hidden_feats=None):
     if n_layers == 1:
         predictor = nn.Linear(d_input_feats, n_tasks)
@@ -86,13 +99,13 @@ def finetune(args):
     g = torch.Generator()
     g.manual_seed(args.seed)
     device = torch.device(args.cuda if torch.cuda.is_available() else "cpu")
-    collator = Collator_tune(config['path_length'])
+    collator = Collator_tune(config['path_length'], graph_backend=args.graph_backend)
     train_dataset = MoleculeDataset(root_path=args.data_path, dataset = args.dataset, dataset_type=args.dataset_type, split_name=f'{args.split}', split='train')
     val_dataset = MoleculeDataset(root_path=args.data_path, dataset = args.dataset, dataset_type=args.dataset_type, split_name=f'{args.split}', split='val')
     test_dataset = MoleculeDataset(root_path=args.data_path, dataset = args.dataset, dataset_type=args.dataset_type, split_name=f'{args.split}', split='test')
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_threads, worker_init_fn=seed_worker, generator=g, drop_last=True, collate_fn=collator)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_threads, worker_init_fn=seed_worker, generator=g, drop_last=False, collate_fn=collator)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_threads, worker_init_fn=seed_worker, generator=g, drop_last=False, collate_fn=collator)
+    train_loader = get_loader(args, train_dataset, collator, g, shuffle=True, drop_last=True)
+    val_loader = get_loader(args, val_dataset, collator, g, shuffle=False, drop_last=False)
+    test_loader = get_loader(args, test_dataset, collator, g, shuffle=False, drop_last=False)
     # Model Initialization
     model = LiGhT(
         d_node_feats=config['d_node_feats'],
@@ -108,7 +121,8 @@ def finetune(args):
         input_drop=0,
         attn_drop=args.dropout,
         feat_drop=args.dropout,
-        n_node_types=vocab.vocab_size
+        n_node_types=vocab.vocab_size,
+        attention_backend=args.attention_backend or config['attention_backend']
     ).to(device)
     # Finetuning Setting
     model.load_state_dict({k.replace('module.',''):v for k,v in torch.load(f'{args.model_path}').items()})
@@ -119,7 +133,8 @@ def finetune(args):
     del model.subgraph_predictor
     print("model have {}M paramerters in total".format(sum(x.numel() for x in model.parameters())/1e6))
     optimizer = Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
-    lr_scheduler = PolynomialDecayLR(optimizer, warmup_updates=args.n_epochs*len(train_dataset)//32//10, tot_updates=args.n_epochs*len(train_dataset)//32,lr=args.lr, end_lr=1e-9,power=1)
+    tot_updates = args.n_epochs*len(train_dataset)//32 if args.max_batch_cost is None else args.n_epochs*len(train_loader)
+    lr_scheduler = PolynomialDecayLR(optimizer, warmup_updates=tot_updates//10, tot_updates=tot_updates,lr=args.lr, end_lr=1e-9,power=1)
     if args.dataset_type == 'classification':
         loss_fn = BCEWithLogitsLoss(reduction='none')
     else:
@@ -0,0 +1,37 @@
+import sys
+sys.path.append("..")
+
+import argparse
+
+from src.data.descriptors.corpusDistributions import fitCorpusDistributions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Arguments")
+    parser.add_argument("--smiles_path", type=str, required=True, help='a file with one smiles per line')
+    parser.add_argument("--out_path", type=str, required=True, help='.npz cdf tables, pass to the preprocessing scripts with --descriptor_normalization')
+    parser.add_argument("--n_jobs", type=int, default=32)
+    parser.add_argument("--chunk_size", type=int, default=100000, help='molecules whose descriptors are held in memory at a time')
+    parser.add_argument("--max_distinct", type=int, default=4096, help='descriptors with more distinct values are histogrammed')
+    parser.add_argument("--n_bins", type=int, default=4096)
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.smiles_path, 'r') as f:
+        smiless = [line.strip('\n') for line in f]
+    distributions = fitCorpusDistributions(smiless, args.out_path, chunk_size=args.chunk_size, n_jobs=args.n_jobs,
+                                           jobs_chunk_size=max(args.chunk_size // (4 * args.n_jobs), 1),
+                                           maxDistinct=args.max_distinct, nBins=args.n_bins)
+    summary = distributions.summary()
+    quantiles = distributions.quantiles([0.01, 0.5, 0.99])
+    print(f"{'descriptor':<28} {'n':>10} {'distinct':>9} {'min':>11} {'q01':>11} {'median':>11} {'q99':>11} {'max':>11}")
+    for name in distributions.names:
+        row = summary[name]
+        distinct = row['distinct'] if row['exact'] else 'binned'
+        q01, median, q99 = quantiles[name]
+        print(f"{name:<28} {row['n']:>10} {distinct:>9} {row['minV']:>11.4g} {q01:>11.4g} {median:>11.4g} {q99:>11.4g} {row['maxV']:>11.4g}")
+    constant = [name for name in distributions.names if summary[name]['n'] and summary[name]['minV'] == summary[name]['maxV']]
+    if constant:
+        print(f'constant over the corpus (normalized to 0.5): {", ".join(constant)}')
+    print(f'cdf tables of {len(distributions.names)} descriptors written to {args.out_path}')
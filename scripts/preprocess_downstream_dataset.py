@@ -3,16 +3,16 @@ sys.path.append("..")
 
 import pandas as pd
 import numpy as np
-from multiprocessing import Pool
+from functools import partial
 import dgl.backend as F
 from dgl.data.utils import save_graphs
-from dgllife.utils.io import pmap
-from rdkit import Chem
-from scipy import sparse as sp
 import argparse 
 
-from src.data.featurizer import smiles_to_graph_tune
-from src.data.descriptors.rdNormalizedDescriptors import RDKit2DNormalized
+from src.data.descriptors.rdNormalizedDescriptors import RDKit2DNormalized, useNormalization
+from src.data.descriptors.descriptorProfile import loadProfiles, writeReport
+from src.data.fingerprint import packed_to_npz
+from src.data.pipeline import ChunkedRunner, featurize_molecule
+from src.data.molecule_store import MoleculeStore, update_store
 
 
 def parse_args():
@@ -21,20 +21,58 @@ def parse_args():
     parser.add_argument("--dataset", type=str, required=True)
     parser.add_argument("--path_length", type=int, default=5)
     parser.add_argument("--n_jobs", type=int, default=32)
+    parser.add_argument("--work_dir", type=str, default=None, help='where completed chunks are kept for resuming, defaults to <data_path>/<dataset>/preprocess_chunks')
+    parser.add_argument("--chunk_size", type=int, default=100000)
+    parser.add_argument("--imap_chunksize", type=int, default=None)
+    parser.add_argument("--backend", type=str, default='process', help='run the stages in n_jobs processes or threads, choose from process, thread')
+    parser.add_argument("--incremental", action='store_true', help='only featurize molecules missing from <data_path>/<dataset>/molecule_store_<path_length>')
+    parser.add_argument("--key", type=str, default='smiles', help='molecule key of the incremental store, choose from smiles, inchikey')
+    parser.add_argument("--descriptor_cache", type=str, default=None, help='sqlite file caching molecular descriptors by canonical smiles across runs')
+    parser.add_argument("--descriptor_cache_size", type=int, default=0, help='molecular descriptor rows kept in memory by every worker, 0 disables the in-memory cache')
+    parser.add_argument("--descriptor_profile", type=str, default=None, help='directory collecting per descriptor timings of all workers, written to report.txt there; includes earlier runs into the same directory')
+    parser.add_argument("--descriptor_normalization", type=str, default=None, help='cdf tables fitted by fit_descriptor_normalization.py, used instead of the built-in descriptor distributions')
     args = parser.parse_args()
     return args
 
 def preprocess_dataset(args):
     df = pd.read_csv(f"{args.data_path}/{args.dataset}/{args.dataset}.csv")
     cache_file_path = f"{args.data_path}/{args.dataset}/{args.dataset}_{args.path_length}.pkl"
+    work_dir = args.work_dir if args.work_dir is not None else f"{args.data_path}/{args.dataset}/preprocess_chunks"
     smiless = df.smiles.values.tolist()
     task_names = df.columns.drop(['smiles']).tolist()
-    print('constructing graphs')
-    graphs = pmap(smiles_to_graph_tune,
-                                   smiless,
-                                   max_length=args.path_length,
-                                   n_virtual_nodes=2,
-                                   n_jobs=args.n_jobs)
+    fp_path = f"{args.data_path}/{args.dataset}/rdkfp1-7_512_packed.npy"
+    if args.descriptor_normalization is not None:
+        # before the runner starts its workers, which inherit the normalization
+        useNormalization(args.descriptor_normalization)
+    with ChunkedRunner(work_dir, n_jobs=args.n_jobs, chunk_size=args.chunk_size, imap_chunksize=args.imap_chunksize, backend=args.backend) as runner:
+        print('constructing graphs, fingerprints and molecular descriptors')
+        generator = RDKit2DNormalized()
+        if args.descriptor_cache is not None or args.descriptor_cache_size > 0:
+            generator.enableCache(args.descriptor_cache_size, args.descriptor_cache)
+        if args.descriptor_profile is not None:
+            generator.enableProfiling(args.descriptor_profile)
+        featurize = partial(featurize_molecule, generator=generator, max_length=args.path_length, n_virtual_nodes=2)
+        # stages and stores are tied to the descriptor cdfs too, another normalization does not reuse them
+        descriptors = generator.cacheNamespace()
+        stage = f'molecules_{args.path_length}_{descriptors}'
+        if args.incremental:
+            store = MoleculeStore(f"{args.data_path}/{args.dataset}/molecule_store_{args.path_length}", key=args.key,
+                                  max_length=args.path_length, n_virtual_nodes=2, build_graph=True,
+                                  descriptors=descriptors)
+            keys = update_store(runner, store, smiless, featurize, stage_prefix=stage)
+            graphs, _, _, arr = store.gather(keys, fp_out_path=fp_path)
+        else:
+            runner.run(stage, featurize, smiless, kind='molecules')
+            graphs, _, _, arr = runner.merge_molecules(stage, len(smiless), fp_out_path=fp_path)
+        runner.report()
+        # everything is merged into the dataset files, the chunks are only kept for resuming
+        runner.cleanup()
+    if args.descriptor_profile is not None:
+        # the workers saved their profiles when the pool was closed, threads recorded into this process's
+        for profile in generator.profiles():
+            profile.save()
+        writeReport(loadProfiles(args.descriptor_profile), f"{args.descriptor_profile}/report.txt")
+        print(f'descriptor timings written to {args.descriptor_profile}/report.txt')
     valid_ids = []
     valid_graphs = []
     for i, g in enumerate(graphs):
@@ -48,22 +86,12 @@ def preprocess_dataset(args):
     save_graphs(cache_file_path, valid_graphs,
                 labels={'labels': labels})
 
-    print('extracting fingerprints')
-    FP_list = []
-    for smiles in smiless:
-        mol = Chem.MolFromSmiles(smiles)
-        FP_list.append(list(Chem.RDKFingerprint(mol, minPath=1, maxPath=7, fpSize=512)))
-    FP_arr = np.array(FP_list)
-    FP_sp_mat = sp.csc_matrix(FP_arr)
     print('saving fingerprints')
-    sp.save_npz(f"{args.data_path}/{args.dataset}/rdkfp1-7_512.npz", FP_sp_mat)
+    packed_to_npz(fp_path, f"{args.data_path}/{args.dataset}/rdkfp1-7_512.npz")
 
-    print('extracting molecular descriptors')
-    generator = RDKit2DNormalized()
-    features_map = Pool(args.n_jobs).imap(generator.process, smiless)
-    arr = np.array(list(features_map))
-    np.savez_compressed(f"{args.data_path}/{args.dataset}/molecular_descriptors.npz",md=arr[:,1:])
+    print('saving descriptors')
+    np.savez_compressed(f"{args.data_path}/{args.dataset}/molecular_descriptors.npz",md=arr)
 
 if __name__ == '__main__':
     args = parse_args()
-    preprocess_dataset(args)
\ No newline at end of file
+    preprocess_dataset(args)
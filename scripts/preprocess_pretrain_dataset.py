@@ -1,24 +1,36 @@
 import sys
 sys.path.append("..")
 
+import os
 import numpy as np
-from multiprocessing import Pool
-from tqdm import tqdm
-from rdkit import Chem
-from scipy import sparse as sp
+from functools import partial
 import argparse 
 
-from src.data.descriptors.rdNormalizedDescriptors import RDKit2DNormalized
-
-def calculate_fingerprint(smiles):
-    mol = Chem.MolFromSmiles(smiles)
-    return list(Chem.RDKFingerprint(mol, minPath=1, maxPath=7, fpSize=512))
+from src.data.descriptors.rdNormalizedDescriptors import RDKit2DNormalized, useNormalization
+from src.data.descriptors.descriptorProfile import loadProfiles, writeReport
+from src.data.size_index import save_size_index
+from src.data.fingerprint import packed_to_npz
+from src.data.pipeline import ChunkedRunner, featurize_molecule
+from src.data.molecule_store import MoleculeStore, update_store
+from src.data.mol_binary import mol_binary
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Arguments")
     parser.add_argument("--data_path", type=str, default='../datasets')
     parser.add_argument("--path_length", type=int, default=5)
     parser.add_argument("--n_jobs", type=int, default=32)
+    parser.add_argument("--fp_format", type=str, default='npz', help='choose from packed, npz (packed plus the sparse rdkfp1-7_512.npz)')
+    parser.add_argument("--work_dir", type=str, default=None, help='where completed chunks are kept for resuming, defaults to <data_path>/preprocess_chunks')
+    parser.add_argument("--chunk_size", type=int, default=100000)
+    parser.add_argument("--imap_chunksize", type=int, default=None)
+    parser.add_argument("--backend", type=str, default='process', help='run the stages in n_jobs processes or threads, choose from process, thread')
+    parser.add_argument("--incremental", action='store_true', help='only featurize molecules missing from <data_path>/molecule_store_<path_length>')
+    parser.add_argument("--key", type=str, default='smiles', help='molecule key of the incremental store, choose from smiles, inchikey')
+    parser.add_argument("--descriptor_cache", type=str, default=None, help='sqlite file caching molecular descriptors by canonical smiles across runs')
+    parser.add_argument("--descriptor_cache_size", type=int, default=0, help='molecular descriptor rows kept in memory by every worker, 0 disables the in-memory cache')
+    parser.add_argument("--descriptor_profile", type=str, default=None, help='directory collecting per descriptor timings of all workers, written to report.txt there; includes earlier runs into the same directory')
+    parser.add_argument("--descriptor_normalization", type=str, default=None, help='cdf tables fitted by fit_descriptor_normalization.py, used instead of the built-in descriptor distributions')
+    parser.add_argument("--mol_binaries", action='store_true', help='also store canonicalized RDKit molecules for training without SMILES parsing')
     args = parser.parse_args()
     return args
 
@@ -28,30 +40,56 @@ if __name__ == '__main__':
     with open(f"{args.data_path}/mix.txt", 'r') as f: 
             lines = f.readlines()
             smiless = [line.strip('\n') for line in lines]
+    work_dir = args.work_dir if args.work_dir is not None else f"{args.data_path}/preprocess_chunks"
 
-    print('extracting fingerprints')
-    pool = Pool(processes=128)
-    FP_list = list(tqdm(pool.imap(calculate_fingerprint, smiless), total=len(smiless)))
-    pool.close()
-    pool.join()
-
-    print('process complete')
-    FP_arr = np.array(FP_list)
-    print('convert to numpy array success')
-    del FP_list
-    print('delete FP_list success')
-    FP_sp_mat = sp.csc_matrix(FP_arr)
-    print('saving fingerprints')
-    sp.save_npz(f"{args.data_path}/rdkfp1-7_512.npz", FP_sp_mat)
+    fp_path = f"{args.data_path}/rdkfp1-7_512_packed.npy"
+    # descriptors are streamed into this memmap, then compressed into molecular_descriptors.npz
+    md_path = f"{work_dir}/molecular_descriptors.npy"
+    if args.descriptor_normalization is not None:
+        # before the runner starts its workers, which inherit the normalization
+        useNormalization(args.descriptor_normalization)
+    with ChunkedRunner(work_dir, n_jobs=args.n_jobs, chunk_size=args.chunk_size, imap_chunksize=args.imap_chunksize, backend=args.backend) as runner:
+        print('extracting size index, fingerprints and molecular descriptors')
+        generator = RDKit2DNormalized()
+        if args.descriptor_cache is not None or args.descriptor_cache_size > 0:
+            generator.enableCache(args.descriptor_cache_size, args.descriptor_cache)
+        if args.descriptor_profile is not None:
+            generator.enableProfiling(args.descriptor_profile)
+        featurize = partial(featurize_molecule, generator=generator, max_length=args.path_length, n_virtual_nodes=2, build_graph=False)
+        # stages and stores are tied to the descriptor cdfs too, another normalization does not reuse them
+        descriptors = generator.cacheNamespace()
+        stage = f'molecules_{args.path_length}_{descriptors}'
+        if args.incremental:
+            store = MoleculeStore(f"{args.data_path}/molecule_store_{args.path_length}", key=args.key,
+                                  max_length=args.path_length, n_virtual_nodes=2, build_graph=False,
+                                  descriptors=descriptors)
+            keys = update_store(runner, store, smiless, featurize, stage_prefix=stage)
+            _, sizes, _, arr = store.gather(keys, fp_out_path=fp_path, md_out_path=md_path)
+        else:
+            runner.run(stage, featurize, smiless, kind='molecules')
+            _, sizes, _, arr = runner.merge_molecules(stage, len(smiless),
+                                                      fp_out_path=fp_path, md_out_path=md_path)
+        if args.mol_binaries:
+            print('storing molecule binaries')
+            runner.run('mol_binaries', mol_binary, smiless, kind='blobs')
+            runner.merge_blobs('mol_binaries', len(smiless), f"{args.data_path}/mol_binaries.npy", f"{args.data_path}/mol_offsets.npy")
+        runner.report()
+        # everything is merged into the dataset files, the chunks are only kept for resuming
+        runner.cleanup()
+    if args.descriptor_profile is not None:
+        # the workers saved their profiles when the pool was closed, threads recorded into this process's
+        for profile in generator.profiles():
+            profile.save()
+        writeReport(loadProfiles(args.descriptor_profile), f"{args.descriptor_profile}/report.txt")
+        print(f'descriptor timings written to {args.descriptor_profile}/report.txt')
+    save_size_index(f"{args.data_path}/size_index_{args.path_length}.npz", sizes, args.path_length, n_virtual_nodes=2)
 
-    print('extracting molecular descriptors')
-    generator = RDKit2DNormalized()
-    pool = Pool(processes=128)  # use 128 processes
-    features_map = Pool(args.n_jobs).imap(generator.process, tqdm(smiless))
-    pool.close()
-    pool.join()
+    if args.fp_format == 'npz':
+        print('saving fingerprints')
+        packed_to_npz(fp_path, f"{args.data_path}/rdkfp1-7_512.npz")
 
-    arr = np.array(list(features_map))
-    del features_map
     print('saving descriptors')
-    np.savez_compressed(f"{args.data_path}/molecular_descriptors.npz",md=arr[:,1:])
\ No newline at end of file
+    np.savez_compressed(f"{args.data_path}/molecular_descriptors.npz",md=arr)
+    # close the memmap before removing its file
+    del arr
+    os.remove(md_path)
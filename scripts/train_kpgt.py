@@ -17,6 +17,7 @@ from src.utils import set_random_seed
 from src.data.featurizer import Vocab, N_BOND_TYPES, N_ATOM_TYPES
 from src.data.pretrain_dataset import MoleculeDataset
 from src.data.collator import Collator_pretrain
+from src.data.sampler import CostAwareBatchSampler, EdgeBalancedDistributedSampler
 from src.model.light import LiGhTPredictor as LiGhT
 from src.trainer.scheduler import PolynomialDecayLR
 from src.trainer.pretrain_trainer import Trainer
@@ -47,7 +48,15 @@ def parse_args():
     parser.add_argument("--data_aug2_rate", type=float, default=0.2)
     parser.add_argument("--save_name", type=str, default=None, help='name of saved model')
     parser.add_argument("--wandb_key", type=str, default=None)
+    parser.add_argument("--max_batch_cost", type=int, default=None, help='per-device budget of graph nodes or edges per batch; enables cost-aware batching')
+    parser.add_argument("--batch_cost", type=str, default='edges', help='choose from nodes, edges')
+    parser.add_argument("--balance_ranks", action='store_true', help='give every rank batches of near-equal total cost at each step, not with --max_batch_cost')
+    parser.add_argument("--use_mol_binaries", action='store_true', help='build graphs from the preprocessed molecule binaries instead of parsing smiles')
+    parser.add_argument("--attention_backend", type=str, default=None, help='overrides the attention_backend of the config, choose from dgl (sparse edge softmax), dense (padded per-graph blocks, for small molecules)')
     args = parser.parse_args()
+    if args.max_batch_cost is not None and args.balance_ranks:
+        # cost-aware batches are split across ranks by CostAwareBatchSampler itself
+        parser.error('--balance_ranks cannot be combined with --max_batch_cost')
     return args
 
 def seed_worker(worker_id):
@@ -55,6 +64,28 @@ def seed_worker(worker_id):
     np.random.seed(worker_seed)
     random.seed(worker_seed)
 
+def get_train_loader(args, config, train_dataset, collator):
+    if args.max_batch_cost is None and not args.balance_ranks:
+        return DataLoader(train_dataset, sampler=DistributedSampler(train_dataset), 
+                          batch_size=args.batch_size// args.n_devices, num_workers=args.n_threads, 
+                          worker_init_fn=seed_worker, drop_last=True, collate_fn=collator, pin_memory=True
+        )
+    sizes = train_dataset.graph_sizes(max_length=config['path_length'], n_virtual_nodes=2, n_jobs=args.n_threads)
+    costs = sizes[:, 0] if args.batch_cost == 'nodes' else sizes[:, 1]
+    if args.max_batch_cost is None:
+        sampler = EdgeBalancedDistributedSampler(costs, args.batch_size// args.n_devices, seed=args.seed)
+        if local_rank == 0:
+            print(f'rank balance (max/mean cost per step): {sampler.balance_report()}')
+        return DataLoader(train_dataset, sampler=sampler, 
+                          batch_size=args.batch_size// args.n_devices, num_workers=args.n_threads, 
+                          worker_init_fn=seed_worker, drop_last=True, collate_fn=collator, pin_memory=True
+        )
+    batch_sampler = CostAwareBatchSampler(costs, args.max_batch_cost, max_batch_size=args.batch_size// args.n_devices,
+                                          shuffle=True, drop_last=True, seed=args.seed)
+    return DataLoader(train_dataset, batch_sampler=batch_sampler, num_workers=args.n_threads, 
+                      worker_init_fn=seed_worker, collate_fn=collator, pin_memory=True
+    )
+
 if __name__ == '__main__':
     args = parse_args()
     config = config_dict[args.config]
@@ -72,11 +103,8 @@ if __name__ == '__main__':
         candi_rate=config['candi_rate'], fp_disturb_rate=config['fp_disturb_rate'], md_disturb_rate=config['md_disturb_rate'], 
         data_aug1=args.data_aug1, data_aug1_rate=args.data_aug1_rate, data_aug2=args.data_aug2, data_aug2_rate=args.data_aug2_rate
     )
-    train_dataset = MoleculeDataset(root_path=args.pretrain1_path)
-    train_loader = DataLoader(train_dataset, sampler=DistributedSampler(train_dataset), 
-                              batch_size=args.batch_size// args.n_devices, num_workers=args.n_threads, 
-                              worker_init_fn=seed_worker, drop_last=True, collate_fn=collator, pin_memory=True
-    )
+    train_dataset = MoleculeDataset(root_path=args.pretrain1_path, use_mol_binaries=args.use_mol_binaries)
+    train_loader = get_train_loader(args, config, train_dataset, collator)
 
     model = LiGhT(
         d_node_feats=config['d_node_feats'],
@@ -92,7 +120,8 @@ if __name__ == '__main__':
         input_drop=config['input_drop'],
         attn_drop=config['attn_drop'],
         feat_drop=config['feat_drop'],
-        n_node_types=vocab.vocab_size
+        n_node_types=vocab.vocab_size,
+        attention_backend=args.attention_backend or config['attention_backend']
     ).to(device)
     model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank], output_device=local_rank, find_unused_parameters=True)
     optimizer = Adam(model.parameters(), lr=config['lr'], weight_decay=config['weight_decay'])
@@ -121,10 +150,8 @@ if __name__ == '__main__':
     del train_loader
     
     if 'mix' not in args.pretrain1_path and not args.pretrain2_path == None:
-        train_dataset = MoleculeDataset(root_path=args.pretrain2_path)
-        train_loader = DataLoader(train_dataset, sampler=DistributedSampler(train_dataset), batch_size=args.batch_size// args.n_devices, 
-                                  num_workers=args.n_threads, worker_init_fn=seed_worker, drop_last=True, collate_fn=collator, pin_memory=True
-        )
+        train_dataset = MoleculeDataset(root_path=args.pretrain2_path, use_mol_binaries=args.use_mol_binaries)
+        train_loader = get_train_loader(args, config, train_dataset, collator)
 
         clf_loss_fn = BCEWithLogitsLoss(weight=train_dataset._task_pos_weights.to(device),reduction='none')
             
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import numpy as np
 from copy import deepcopy
 from .featurizer import smiles_to_graph
+from .graph_batch import GraphBatch
 
 def preprocess_batch_light(batch_num, batch_num_target, tensor_data):
     batch_num = np.concatenate([[0],batch_num],axis=-1)
@@ -278,10 +279,15 @@ class Collator_pretrain(object):
         return smiles_list, batched_graph, fps, mds, sl_labels, disturbed_fps, disturbed_mds
 
 class Collator_tune(object):
-    def __init__(self, max_length=5, n_virtual_nodes=2, add_self_loop=True):
+    # 'scatter' batches are GraphBatch tensors for the dgl-free scatter backend of LiGhT
+    GRAPH_BACKENDS = ['dgl', 'scatter']
+    def __init__(self, max_length=5, n_virtual_nodes=2, add_self_loop=True, graph_backend='dgl'):
+        if graph_backend not in self.GRAPH_BACKENDS:
+            raise ValueError(f'Unknown graph backend {graph_backend}, choose from {", ".join(self.GRAPH_BACKENDS)}')
         self.max_length = max_length
         self.n_virtual_nodes = n_virtual_nodes
         self.add_self_loop = add_self_loop
+        self.graph_backend = graph_backend
     def __call__(self, samples):
         smiles_list, graphs, fps, mds, labels = map(list, zip(*samples))
 
@@ -290,4 +296,6 @@ class Collator_tune(object):
         mds = torch.stack(mds, dim=0).reshape(len(smiles_list),-1)
         labels = torch.stack(labels, dim=0).reshape(len(smiles_list),-1)
         batched_graph.edata['path'][:, :] = preprocess_batch_light(batched_graph.batch_num_nodes(), batched_graph.batch_num_edges(), batched_graph.edata['path'][:, :])
+        if self.graph_backend == 'scatter':
+            batched_graph = GraphBatch.from_dgl(batched_graph)
         return smiles_list, batched_graph, fps, mds, labels
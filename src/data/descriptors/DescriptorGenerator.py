@@ -35,8 +35,14 @@ import pandas as pd
 import pandas_flavor as pf
 import sys
 import numpy as np
-# set to 0 to disable caching
-MAX_CACHE = 0
+import json, hashlib
+import rdkit
+from .descriptorCache import processCache
+from . import descriptorProfile
+from .descriptorTable import writeDescriptors
+from multiprocessing import Pool
+# default number of rows kept in memory by enableCache
+MAX_CACHE = 10000
 
 import sys
 from numbers import Number
@@ -70,6 +76,26 @@ def getsize(obj_0):
         return size
     return inner(obj_0)
 
+# the generator of a parallel processSmiles/processMols pool worker
+_workerGenerator = None
+
+def _initWorker(generator):
+    # every pool worker unpickles the generator once; forked workers inherit
+    #  the profile of the parent instead, which must not be counted again
+    global _workerGenerator
+    _workerGenerator = generator
+    generator.takeProfiles()
+
+def _processMolsChunk(task):
+    start, mols, smiles, internalParsing = task
+    values, valid = _workerGenerator.processMolsInto(mols, smiles, internalParsing=internalParsing)
+    return start, values, valid, _workerGenerator.takeProfiles()
+
+def _processSmilesChunk(task):
+    start, smiles = task
+    values, valid = _workerGenerator.processSmilesInto(smiles)
+    return start, values, valid, _workerGenerator.takeProfiles()
+
 class DescriptorGenerator:
     REGISTRY = {}
     NAME = None
@@ -82,9 +108,8 @@ class DescriptorGenerator:
         # the columns to be actually calculated
         #  GetColumns returns more columns here.
         self.columns = []
-        self.cache = {}
-        self.cache_hit = 0
-        self.cache_miss = 0
+        self.descriptorCache = None
+        self.descriptorProfile = None
         
     def molFromSmiles(self, smiles):
         """Prepare a smiles to a molecule"""
@@ -104,6 +129,74 @@ class DescriptorGenerator:
         """Override me for the actual calculation"""
         raise NotImplementedError
     
+    def cacheNamespace(self):
+        """Identifies the results of this generator in a shared descriptor cache"""
+        spec = json.dumps([self.NAME, rdkit.__version__, [name for name, _ in self.columns]])
+        return "%s-%s" % (self.NAME, hashlib.blake2b(spec.encode(), digest_size=8).hexdigest())
+
+    def enableCache(self, maxsize=MAX_CACHE, path=None):
+        """Cache processMol results by canonical smiles
+
+        Keeps up to maxsize rows per process in an LRU; with a path rows are
+        also stored in (and read from) a sqlite database shared by all
+        processes and runs.  Duplicates of a molecule get the results of the
+        first atom ordering seen, which can differ from their own in the last
+        bits of order dependent sums.
+        """
+        dtype = np.result_type(*[t for _, t in self.columns]) if self.columns else np.float64
+        self.descriptorCache = processCache(maxsize, path, self.cacheNamespace(), dtype)
+        return self.descriptorCache
+
+    def disableCache(self):
+        self.flushCache()
+        self.descriptorCache = None
+
+    def flushCache(self):
+        """Write pending rows to the on-disk cache, if any"""
+        if self.descriptorCache is not None:
+            self.descriptorCache.flush()
+
+    def cacheStats(self):
+        """hit/miss/eviction counts of this process, None without a cache"""
+        if self.descriptorCache is None:
+            return None
+        return self.descriptorCache.stats()
+
+    def enableProfiling(self, path=None):
+        """Record wall time, calls and failures per descriptor function
+
+        Generators with per descriptor functions (RDKit2D and
+        RDKit2DNormalized) record every function, shared intermediate and
+        normalization cdf they evaluate.  Profiles of pool workers are
+        added to this one by parallel processMols/processSmilesInto; with a
+        path every process also saves its profile in that directory, see
+        descriptorProfile.loadProfiles.
+        """
+        self.descriptorProfile = descriptorProfile.processProfile(self.NAME, path)
+        return self.descriptorProfile
+
+    def disableProfiling(self):
+        self.descriptorProfile = None
+
+    def profiles(self):
+        """The DescriptorProfiles being recorded"""
+        return [self.descriptorProfile] if self.descriptorProfile is not None else []
+
+    def takeProfiles(self):
+        """Stats recorded since the last call, one dict per profile"""
+        return [profile.take() for profile in self.profiles()]
+
+    def mergeProfiles(self, stats):
+        for profile, profile_stats in zip(self.profiles(), stats):
+            profile.merge(profile_stats)
+
+    def profileReport(self):
+        """Text table of the recorded times, slowest first"""
+        return descriptorProfile.report(self.profiles())
+
+    def writeProfileReport(self, path):
+        descriptorProfile.writeReport(self.profiles(), path)
+    
     def processMol(self, m, smiles, internalParsing=False):
         """rdmol, smiles -> result
         generate descriptors from a smiles string using the specified
@@ -115,6 +208,13 @@ class DescriptorGenerator:
         The first value returned is always True to indicate that the
         descriptors have actually been set in the store
         """
+        cache = self.descriptorCache
+        if cache is not None:
+            key = Chem.MolToSmiles(m)
+            res = cache.get(key)
+            if res is not None:
+                return res
+
         if not internalParsing:
             m = self.molFromMol(m)
 
@@ -122,38 +222,141 @@ class DescriptorGenerator:
         #  mark the row as failed and replace None's with default values
         #  for storage.
         res = self.calculateMol(m, smiles, internalParsing)
-        if None in res:
-            logging.error("None in res")
-            columns = self.GetColumns()
-
-            for idx,v in enumerate(res):
-                if v is None:
-                    if self.NAME:
-                        logging.error("At least one result: %s(%s) failed: %s",
-                                      self.NAME,
-                                      columns[idx+1][0],
-                                      smiles)
-                        res[idx] = columns[idx+1][1]() # default value here
-                    else:
-                        logging.error("At least one result: %s failed: %s",
-                                      columns[idx][0],
-                                      smiles)
-                        res[idx] = columns[idx][1]() # default value here
-
-            logging.info("res %r", res)
+        if self.setDefaults(res, smiles):
             if type(res) == list:
                 res.insert(0, False)
             else:
-                np.insert(res, 0, 3)
+                res = np.insert(res, 0, False)
         else:
             if type(res) == list:
                 res.insert(0, True)
             else:
-                np.insert(res, 0, -1)
+                res = np.insert(res, 0, True)
 
+        if cache is not None:
+            cache.put(key, res)
         return res
     
-    def processMols(self, mols, smiles, internalParsing=False):
+    def setDefaults(self, res, smiles):
+        """Replaces None's in a calculateMol result with default values
+
+        returns True if there were any, i.e. the calculation failed
+        """
+        if not (type(res) == list and None in res):
+            return False
+        logging.error("None in res")
+        columns = self.GetColumns()
+
+        for idx,v in enumerate(res):
+            if v is None:
+                if self.NAME:
+                    logging.error("At least one result: %s(%s) failed: %s",
+                                  self.NAME,
+                                  columns[idx+1][0],
+                                  smiles)
+                    res[idx] = columns[idx+1][1]() # default value here
+                else:
+                    logging.error("At least one result: %s failed: %s",
+                                  columns[idx][0],
+                                  smiles)
+                    res[idx] = columns[idx][1]() # default value here
+
+        logging.info("res %r", res)
+        return True
+
+    def allocateResults(self, n):
+        """n -> values, valid
+        Preallocated columnar results for n molecules: a (n, len(self.columns))
+        float64 array of descriptor values, without the "calculated" flag,
+        and the boolean vector of those flags.
+        """
+        return np.zeros((n, len(self.columns)), dtype=np.float64), np.zeros(n, dtype=bool)
+
+    def processMolInto(self, m, smiles, out, internalParsing=False):
+        """rdmol, smiles, out -> calculated flag
+        Columnar processMol: writes the descriptor values into the float
+        array out (one row of allocateResults) and returns the flag that
+        processMol would prepend.  Failed values are set to their defaults.
+        """
+        cache = self.descriptorCache
+        if cache is not None:
+            key = Chem.MolToSmiles(m)
+            flag = cache.getInto(key, out)
+            if flag is not None:
+                return flag
+
+        if not internalParsing:
+            m = self.molFromMol(m)
+
+        res = self.calculateMol(m, smiles, internalParsing)
+        flag = not self.setDefaults(res, smiles)
+        out[:] = res
+
+        if cache is not None:
+            cache.putRow(key, flag, out)
+        return flag
+
+    def parallelInto(self, worker, tasks, n, values=None, valid=None, n_jobs=2):
+        """Runs worker over (start, ...) tasks in a pool of n_jobs processes
+
+        Every worker builds this generator once.  The (start, values, valid,
+        profiles) chunks the worker returns are copied into the rows of one
+        preallocated result starting at start, so the result is in input
+        order, and the worker profiles are added to the ones of this
+        generator.
+        """
+        if values is None:
+            values = np.zeros((n, len(self.columns)), dtype=np.float64)
+        if valid is None:
+            valid = np.zeros(n, dtype=bool)
+        pool = Pool(n_jobs, initializer=_initWorker, initargs=(self,))
+        try:
+            for start, chunk_values, chunk_valid, profiles in pool.imap(worker, tasks):
+                values[start:start+len(chunk_valid)] = chunk_values
+                valid[start:start+len(chunk_valid)] = chunk_valid
+                self.mergeProfiles(profiles)
+        except:
+            pool.terminate()
+            raise
+        # closing lets the workers flush their descriptor caches
+        pool.close()
+        pool.join()
+        return values, valid
+
+    def parallelMolsInto(self, mols, smiles, values, valid, internalParsing, n_jobs, chunk_size):
+        if len(mols) != len(smiles):
+            raise ValueError("Number of molecules does not match number of unparsed molecules")
+        tasks = ((start, mols[start:start+chunk_size], smiles[start:start+chunk_size], internalParsing)
+                 for start in range(0, len(mols), chunk_size))
+        return self.parallelInto(_processMolsChunk, tasks, len(mols), values, valid, n_jobs)
+
+    def processMolsInto(self, mols, smiles, values=None, valid=None, internalParsing=False,
+                        n_jobs=1, chunk_size=1000):
+        """mols, smiles -> values, valid
+        Columnar processMols: fills the rows of values and valid (see
+        allocateResults, allocated when not given) in the order of mols.
+
+        With n_jobs > 1 the molecules are processed in chunks of chunk_size
+        by a pool of n_jobs processes.
+        """
+        if n_jobs > 1:
+            return self.parallelMolsInto(mols, smiles, values, valid, internalParsing, n_jobs, chunk_size)
+        if len(mols) != len(smiles):
+            raise ValueError("Number of molecules does not match number of unparsed molecules")
+        if values is None:
+            values = np.zeros((len(mols), len(self.columns)), dtype=np.float64)
+        if valid is None:
+            valid = np.zeros(len(mols), dtype=bool)
+
+        for i, (m, smile) in enumerate(zip(mols, smiles)):
+            valid[i] = self.processMolInto(m, smile, values[i], internalParsing)
+        return values, valid
+
+    def resultLists(self, values, valid):
+        """columnar results -> processMol style lists"""
+        return [[bool(flag)] + row for flag, row in zip(valid, values.tolist())]
+
+    def processMols(self, mols, smiles, internalParsing=False, n_jobs=1, chunk_size=1000):
         """mols, smiles -> results
         Process the molecules.  Note that smiles
         may not actually be smiles strings, but molblocks as well
@@ -165,7 +368,13 @@ class DescriptorGenerator:
         ordering input for MoKa descriptors)  
 
         Calling this directly requires the User to properly prepare the molecules if necessary
+
+        With n_jobs > 1 the molecules are processed in parallel (see
+        processMolsInto) and every result is a list.
         """
+        if n_jobs > 1:
+            return self.resultLists(*self.processMolsInto(mols, smiles, internalParsing=internalParsing,
+                                                          n_jobs=n_jobs, chunk_size=chunk_size))
         if len(mols) != len(smiles):
             raise ValueError("Number of molecules does not match number of unparsed molecules")
 
@@ -194,79 +403,73 @@ class DescriptorGenerator:
 
         return self.processMol(mol, smiles, internalParsing=True)
 
-    def processSmiles(self, smiles, keep_mols=True):
-        """smiles -> descriptors
-        Process many smiles string and generate the descriptors"""
+    def processSmilesInto(self, smiles, values=None, valid=None, n_jobs=1, chunk_size=1000):
+        """smiles -> values, valid
+        Columnar processSmiles: invalid smiles get valid False and default
+        (zero) values instead of None rows.  With n_jobs > 1 every pool
+        worker parses and processes chunks of chunk_size smiles.
+        """
+        if n_jobs > 1:
+            tasks = ((start, smiles[start:start+chunk_size]) for start in range(0, len(smiles), chunk_size))
+            return self.parallelInto(_processSmilesChunk, tasks, len(smiles), values, valid, n_jobs)
+        if values is None:
+            values = np.zeros((len(smiles), len(self.columns)), dtype=np.float64)
+        if valid is None:
+            valid = np.zeros(len(smiles), dtype=bool)
+
         mols = []
-        allmols = []
         indices = []
         goodsmiles = []
-        _results = []
-
-        if MAX_CACHE:
-            for i,smile in enumerate(smiles):
-                res,m = self.cache.get(smile, (None, None))
-                if res:
-                    _results.append((i, res))
-                    if keep_mols:
-                        allmols.append(m)
-                else:
-                    m = self.molFromSmiles(smile)
-                    if m:
-                        mols.append(m)
-                        indices.append(i)
-                        goodsmiles.append(smile)
-                    if keep_mols:
-                        allmols.append(m)
-        else:
-            for i,smile in enumerate(smiles):
+        for i,smile in enumerate(smiles):
+            try:
                 m = self.molFromSmiles(smile)
-                if m:
-                    mols.append(m)
-                    indices.append(i)
-                    goodsmiles.append(smile)
-                if keep_mols:
-                    allmols.append(m)
-                        
-        if len(smiles) + len(self.cache) > MAX_CACHE:
-            self.cache.clear()
-            
-        # all cached
-        if len(_results) == len(smiles):
-            all_results = [r[1] for r in _results]
-            return allmols, all_results
-        
-        # none cached
-        elif len(_results) == 0:
-            results = self.processMols(mols, goodsmiles, internalParsing=True)
-
-            if MAX_CACHE:
-                if len(indices) == len(smiles):
-                    for smile, res, m in zip(smiles, results, allmols):
-                        self.cache[smile] = res, m
-                    
-                return mols, results
-
-            # default values are None
-            all_results = [None] * len(smiles)
-            for idx,result,m in zip(indices, results, allmols):
-                self.cache[smiles[idx]] = result,m
-                all_results[idx] = result
-            return allmols, all_results
-        # some cached
+            except:
+                m = None
+            if m:
+                mols.append(m)
+                indices.append(i)
+                goodsmiles.append(smile)
+
+        if len(indices) == len(smiles):
+            self.processMolsInto(mols, goodsmiles, values, valid, internalParsing=True)
         else:
-            results = self.processMols(mols, goodsmiles, internalParsing=True)
-            all_results = [None] * len(smiles)
-            # grab cached
-            for i,res in _results:
-                all_results[i] = res
-
-            # grab processed
-            for idx,result,m in zip(indices, results, allmols):
-                if MAX_CACHE:
-                    self.cache[smiles[idx]] = result,m
-                all_results[idx] = result
-            return allmols, all_results
+            valid[:] = False
+            values[:] = 0.
+            if indices:
+                values[indices], valid[indices] = self.processMolsInto(mols, goodsmiles, internalParsing=True)
+        self.flushCache()
+        return values, valid
+
+    def processSmiles(self, smiles, keep_mols=True, n_jobs=1, chunk_size=1000):
+        """smiles -> descriptors
+        Process many smiles string and generate the descriptors
+
+        Results of invalid smiles are None, as are their molecules.  Cached
+        results are served by processMol (see enableCache).  With n_jobs > 1
+        the parsed molecules are processed in parallel (see processMols).
+        """
+        mols = []
+        allmols = []
+        indices = []
+        goodsmiles = []
+
+        for i,smile in enumerate(smiles):
+            m = self.molFromSmiles(smile)
+            if m:
+                mols.append(m)
+                indices.append(i)
+                goodsmiles.append(smile)
+            if keep_mols:
+                allmols.append(m)
+
+        results = self.processMols(mols, goodsmiles, internalParsing=True, n_jobs=n_jobs, chunk_size=chunk_size)
+        self.flushCache()
+
+        # default values are None
+        all_results = [None] * len(smiles)
+        for idx,result in zip(indices, results):
+            all_results[idx] = result
+        return allmols, all_results
 
     def processCtab(self, ctab):
         raise NotImplementedError
@@ -280,7 +483,34 @@ class Container(DescriptorGenerator):
         columns = self.columns = []
         for g in generators:
             columns.extend(g.GetColumns())
-        self.cache = {}
+        self.descriptorCache = None
+        self.descriptorProfile = None
+
+    def enableCache(self, maxsize=MAX_CACHE, path=None):
+        """Caches the results of every generator, see DescriptorGenerator.enableCache"""
+        return [g.enableCache(maxsize, path) for g in self.generators]
+
+    def disableCache(self):
+        for g in self.generators:
+            g.disableCache()
+
+    def flushCache(self):
+        for g in self.generators:
+            g.flushCache()
+
+    def cacheStats(self):
+        return {g.NAME: g.cacheStats() for g in self.generators}
+
+    def enableProfiling(self, path=None):
+        """Profiles every generator, see DescriptorGenerator.enableProfiling"""
+        return [g.enableProfiling(path) for g in self.generators]
+
+    def disableProfiling(self):
+        for g in self.generators:
+            g.disableProfiling()
+
+    def profiles(self):
+        return [profile for g in self.generators for profile in g.profiles()]
 
     def processMol(self, m, smiles, internalParsing=False):
         results = []
@@ -289,7 +519,44 @@ class Container(DescriptorGenerator):
             
         return results
 
-    def processMols(self, mols, smiles, internalParsing=False):
+    def processMolInto(self, m, smiles, out, internalParsing=False):
+        values, valid = self.processMolsInto([m], [smiles], out[None], internalParsing=internalParsing)
+        return bool(valid[0])
+
+    def processMolsInto(self, mols, smiles, values=None, valid=None, internalParsing=False,
+                        n_jobs=1, chunk_size=1000):
+        """Columnar processMols; every generator fills its "calculated" flag
+        column and the value columns after it, valid is True where all
+        generators succeeded.
+        """
+        if n_jobs > 1:
+            return self.parallelMolsInto(mols, smiles, values, valid, internalParsing, n_jobs, chunk_size)
+        if len(mols) != len(smiles):
+            raise ValueError("Number of molecules does not match number of unparsed molecules")
+        if values is None:
+            values = np.zeros((len(mols), len(self.columns)), dtype=np.float64)
+        if valid is None:
+            valid = np.zeros(len(mols), dtype=bool)
+        valid[:] = True
+        offset = 0
+        for g in self.generators:
+            g_valid = np.zeros(len(mols), dtype=bool)
+            start = offset + 1 if g.NAME else offset
+            g.processMolsInto(mols, smiles, values[:, start:start+len(g.columns)], g_valid, internalParsing)
+            if g.NAME:
+                values[:, offset] = g_valid
+            valid &= g_valid
+            offset = start + len(g.columns)
+        return values, valid
+
+    def resultLists(self, values, valid):
+        # the flags are columns of values
+        return values.tolist()
+
+    def processMols(self, mols, smiles, internalParsing=False, n_jobs=1, chunk_size=1000):
+        if n_jobs > 1:
+            return self.resultLists(*self.processMolsInto(mols, smiles, internalParsing=internalParsing,
+                                                          n_jobs=n_jobs, chunk_size=chunk_size))
         results = []
         for m in mols:
             results.append([])
@@ -331,7 +598,9 @@ def MakeGenerator( generator_names ):
 @pf.register_dataframe_method
 def create_descriptors(df: pd.DataFrame,
                        mols_column_name: str,
-                       generator_names: list):
+                       generator_names: list,
+                       n_jobs: int = 1,
+                       chunk_size: int = 1000):
     """pyjanitor style function for using the descriptor generator
 
     Convert a column of smiles strings or RDKIT Mol objects into Descriptors.
@@ -339,6 +608,10 @@ def create_descriptors(df: pd.DataFrame,
     intentional, as Descriptors are usually high-dimensional
     features.
 
+    Rows of invalid molecules have their "calculated" column(s) set to
+    False.  With n_jobs > 1 the column is processed in chunks of chunk_size
+    by a pool of n_jobs processes.
+
     This method does not mutate the original DataFrame.
 
     .. code-block:: python
@@ -350,15 +623,39 @@ def create_descriptors(df: pd.DataFrame,
             mols_column_name='smiles', generator_names=["Morgan3Count"])
     """
     generator = MakeGenerator(generator_names)
-    mols = df[mols_column_name]
-    if len(mols):
-        if type(mols[0]) == str:
-            _, results = generator.processSmiles(mols)
-        else:
-            results = generator.processMols(mols, [Chem.MolToSmiles(m) for m in mols])
-
+    mols = df[mols_column_name].tolist()
+    if len(mols) and type(mols[0]) == str:
+        values, valid = generator.processSmilesInto(mols, n_jobs=n_jobs, chunk_size=chunk_size)
     else:
-        results = []
-    fpdf = pd.DataFrame(results, columns=generator.GetColumns())
-    fpdf.index = df.index
-    return fpdf
+        values, valid = generator.processMolsInto(mols, [Chem.MolToSmiles(m) for m in mols],
+                                                  n_jobs=n_jobs, chunk_size=chunk_size)
+    columns = generator.GetColumns()
+    arrays = ([valid] if generator.NAME else []) + [values[:, j] for j in range(values.shape[1])]
+    # column by column, so every column keeps its dtype (e.g. the bool "calculated" flag)
+    return pd.DataFrame({name: np.asarray(array).astype(dtype) for (name, dtype), array in zip(columns, arrays)},
+                        columns=[name for name, _ in columns], index=df.index)
+
+@pf.register_dataframe_method
+def write_descriptors(df: pd.DataFrame,
+                      mols_column_name: str,
+                      generator_names: list,
+                      path: str,
+                      chunk_size: int = 10000,
+                      n_jobs: int = 1):
+    """Streaming create_descriptors: writes the descriptors to a columnar table
+
+    The descriptors of chunk_size molecules at a time are written to the
+    directory path (see descriptorTable) with the dtypes of the generator
+    columns, so the result never has to fit in memory.  Returns the lazily
+    loaded DescriptorTable, whose rows are in the order of df.
+
+    .. code-block:: python
+        table = df.write_descriptors(mols_column_name='smiles',
+                                     generator_names=["RDKit2DNormalized"],
+                                     path="descriptors")
+        for chunk in table.iterChunks(100000):
+            ...
+    """
+    generator = MakeGenerator(generator_names)
+    return writeDescriptors(generator, df[mols_column_name].tolist(), path,
+                            chunk_size=chunk_size, n_jobs=n_jobs)
@@ -60,8 +60,9 @@ from rdkit.Chem import rdMolDescriptors as rdmd
 from rdkit import Chem
 
 # General
-from copy import deepcopy
+import numpy as np
 from math import exp, log
+from .patternScreen import PatternScreen, molKinds
 
 #
 AliphaticRings = Chem.MolFromSmarts('[$([A;R][!a])]')
@@ -207,6 +208,10 @@ StructuralAlerts = []
 for smarts in StructuralAlertSmarts:
   StructuralAlerts.append(Chem.MolFromSmarts(smarts))
 
+# element/ring pre-screens: patterns a molecule cannot match are not searched
+AcceptorScreen = PatternScreen(Acceptors)
+StructuralAlertScreen = PatternScreen(StructuralAlerts)
+
 # ADS parameters for the 8 molecular properties: [row][column]
 #   rows[8]:   MW, ALOGP, HBA, HBD, PSA, ROTB, AROM, ALERTS
 #   columns[7]: A, B, C, D, E, F, DMAX
@@ -229,25 +234,35 @@ def properties(mol):
   """
   Calculates the properties that are required to calculate the QED descriptor.
   """
-  matches = []
   if (mol is None):
     raise TypeError('You need to provide a mol argument.')
+  kinds = molKinds(mol)
   x = [0] * 8
   x[0] = rdmd._CalcMolWt(mol)                        # MW 
   x[1] = Crippen.MolLogP(mol)                        # ALOGP
-  for hbaPattern in Acceptors:                            # HBA
-    if (mol.HasSubstructMatch(hbaPattern)):
-      matches = mol.GetSubstructMatches(hbaPattern)
-      x[2] += len(matches)
+  x[2] = AcceptorScreen.countMatches(mol, kinds)     # HBA
   x[3] = Lipinski.NumHDonors(mol)               # HBD
   x[4] = MolSurf.TPSA(mol)                        # PSA
   x[5] = Lipinski.NumRotatableBonds(mol)         # ROTB
-  x[6] = Chem.GetSSSR(Chem.DeleteSubstructs(deepcopy(mol), AliphaticRings))  # AROM
-  for alert in StructuralAlerts:                        # ALERTS
-    if (mol.HasSubstructMatch(alert)): x[7] += 1
+  if mol.GetRingInfo().NumRings():                # AROM
+    # GetSSSR returns the number of rings in older RDKit versions and the rings in newer ones
+    rings = Chem.GetSSSR(Chem.DeleteSubstructs(Chem.Mol(mol), AliphaticRings))
+    x[6] = rings if isinstance(rings, int) else len(rings)
+  x[7] = StructuralAlertScreen.countMatching(mol, kinds)  # ALERTS
   return x
 
 
+def propertiesMany(mols):
+  """
+  properties of every molecule as an (n, 8) array, rows of unparsable (None) molecules are nan.
+  """
+  res = np.full((len(mols), 8), np.nan)
+  for i, mol in enumerate(mols):
+    if mol is not None:
+      res[i] = properties(mol)
+  return res
+
+
 def qed(m=None,w=(0.66, 0.46, 0.05, 0.61, 0.06, 0.65, 0.48, 0.95),
         p=None):
   """ Calculate the weighted sum of ADS mapped properties
@@ -280,7 +295,7 @@ def weights_max(mol):
   Calculates the QED descriptor using maximal descriptor weights.
   """
   props = properties(mol)
-  return qed(mol,w=[0.50, 0.25, 0.00, 0.50, 0.00, 0.50, 0.25, 1.00])
+  return qed(mol,w=[0.50, 0.25, 0.00, 0.50, 0.00, 0.50, 0.25, 1.00],p=props)
 
 
 def weights_mean(mol):
@@ -288,7 +303,7 @@ def weights_mean(mol):
   Calculates the QED descriptor using average descriptor weights.
   """
   props = properties(mol)
-  return qed(mol,w=[0.66, 0.46, 0.05, 0.61, 0.06, 0.65, 0.48, 0.95])
+  return qed(mol,w=[0.66, 0.46, 0.05, 0.61, 0.06, 0.65, 0.48, 0.95],p=props)
 
 def weights_none(mol):
   """
@@ -297,6 +312,22 @@ def weights_none(mol):
   return qed(mol,w=[1.00, 1.00, 1.00, 1.00, 1.00, 1.00, 1.00, 1.00])
 
 
+def qedMany(mols, w=(0.66, 0.46, 0.05, 0.61, 0.06, 0.65, 0.48, 0.95), p=None):
+  """
+  qed of every molecule as an array, nan for unparsable (None) molecules.
+
+  The ADS functions are evaluated on the whole (n, 8) property array, which may
+  be given as p, e.g. to score the same molecules with several weightings.
+  """
+  if p is None:
+    p = propertiesMany(mols)
+  p = np.asarray(p, dtype=np.float64)
+  a, b, c, d, e, f, dmax = np.array(pads).T
+  ads = (a + (b / (1 + np.exp(-1 * (p - c + d / 2) / e)) * (1 - 1 / (1 + np.exp(-1 * (p - c - d / 2) / f))))) / dmax
+  w = np.asarray(w, dtype=np.float64)
+  return np.exp(np.log(ads).dot(w) / w.sum())
+
+
 def default(mol):
   """
   Calculates the QED descriptor using average descriptor weights.
@@ -0,0 +1,153 @@
+"""Piecewise-linear tables of the descriptor normalization CDFs.
+
+buildCdfTables tabulates every clipped CDF of dists.dists over [minV, maxV]
+on an adaptive grid and verifies the maximum absolute interpolation error.
+RDKit2DNormalized uses the tables, when present, for np.interp lookups, so
+scipy.stats is only imported to build them or for cdfs without a table.
+The same format stores the empirical cdfs fitted by corpusDistributions.
+"""
+import os
+import json
+import logging
+import numpy as np
+from . import dists
+
+CDF_TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cdf_tables.npz")
+
+def _spec(name):
+    # the distribution entry a table was built from, used to detect stale tables
+    return json.dumps(dists.dists[name])
+
+def scipyCdfs(names=None):
+    """name -> clipped scipy cdf for every (or the given) normalized descriptor
+
+    scipy.stats is imported on the first call of a cdf, not here.
+    """
+    cdfs = {}
+    for name, (dist, params, minV,maxV,avg,std) in dists.dists.items():
+        if names is not None and name not in names:
+            continue
+        arg = params[:-2]
+        loc = params[-2]
+        scale = params[-1]
+
+        # make the cdf with the parameters
+        def cdf(v, dist=dist, arg=arg,loc=loc,scale=scale,minV=minV,maxV=maxV):
+            import scipy.stats as st
+            v = getattr(st, dist).cdf(np.clip(v, minV, maxV), loc=loc, scale=scale, *arg)
+            return np.clip(v, 0., 1.)
+
+        cdfs[name] = cdf
+    return cdfs
+
+def tableCdf(x, y):
+    # np.interp clamps to the end points, which are the cdf values at minV and maxV
+    def cdf(v, x=x, y=y):
+        return np.interp(v, x, y)
+    return cdf
+
+def _probeErrors(cdf, lo, hi, flo, fhi, t):
+    # interpolation error at lo + (hi - lo) * t, evaluated at the rounded probe points
+    probes = lo[:, None] + (hi - lo)[:, None] * t[None, :]
+    exact = cdf(probes.ravel()).reshape(probes.shape)
+    approx = flo[:, None] + (fhi - flo)[:, None] * ((probes - lo[:, None]) / (hi - lo)[:, None])
+    return np.abs(exact - approx).max(axis=1), probes, exact
+
+def tabulate(cdf, minV, maxV, tol=1e-6, n_init=65, n_verify=15, max_points=1 << 16):
+    """Adaptive grid (x, y) for cdf on [minV, maxV]
+
+    Intervals whose quarter/mid-point interpolation error exceeds tol/2 are
+    halved until none does, then the grid is checked at n_verify interior
+    points per interval and failing intervals are refined again.  Only new
+    intervals are probed, so every round costs as many cdf evaluations as
+    there are intervals left to settle.  Refinement stops at max_points, e.g.
+    for cdfs whose scipy implementation is noisier than tol.
+
+    Returns x, y and the verified maximum absolute error.
+    """
+    if maxV <= minV:
+        x = np.array([minV, minV], dtype=np.float64)
+        return x, cdf(x).astype(np.float64), 0.
+    x = np.linspace(minV, maxV, n_init)
+    y = cdf(x).astype(np.float64)
+    t = np.array([0.25, 0.5, 0.75])
+    t_verify = np.arange(1, n_verify + 1) / (n_verify + 1.)
+    pending = (x[:-1], x[1:], y[:-1], y[1:])
+    force = False
+    while True:
+        new_x, new_y = [x], [y]
+        n_points = len(x)
+        while len(pending[0]) and n_points < max_points:
+            lo, hi, flo, fhi = pending
+            errors, probes, exact = _probeErrors(cdf, lo, hi, flo, fhi, t)
+            mid, fmid = probes[:, 1], exact[:, 1]
+            split = force | (errors > tol / 2)
+            # intervals too narrow to halve in float64 are kept as they are
+            split &= (mid > lo) & (mid < hi)
+            new_x.append(mid[split])
+            new_y.append(fmid[split])
+            n_points += int(split.sum())
+            pending = (np.concatenate([lo[split], mid[split]]), np.concatenate([mid[split], hi[split]]),
+                       np.concatenate([flo[split], fmid[split]]), np.concatenate([fmid[split], fhi[split]]))
+            force = False
+        x = np.concatenate(new_x)
+        y = np.concatenate(new_y)
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+        errors = _probeErrors(cdf, x[:-1], x[1:], y[:-1], y[1:], t_verify)[0]
+        bad = errors > tol
+        if not bad.any() or len(x) >= max_points:
+            return x, y, float(errors.max())
+        # refine where the verification failed; these intervals already passed
+        # the quarter point test, so they are halved unconditionally
+        pending = (x[:-1][bad], x[1:][bad], y[:-1][bad], y[1:][bad])
+        force = True
+
+def buildCdfTables(path=CDF_TABLES, tol=1e-6):
+    """Tabulate every normalization cdf into path, returns {name: max error}
+
+    cdfs that cannot be tabulated within tol are left out and keep using scipy.
+    """
+    cdfs = scipyCdfs()
+    names, xs, ys, errors = [], [], [], {}
+    for name in sorted(cdfs):
+        dist, params, minV, maxV, avg, std = dists.dists[name]
+        x, y, err = tabulate(cdfs[name], minV, maxV, tol)
+        errors[name] = err
+        if err > tol:
+            logging.warning("CDF table for %s has max error %g > %g, not storing it", name, err, tol)
+            continue
+        names.append(name)
+        xs.append(x)
+        ys.append(y)
+    saveCdfTables(path, names, [_spec(name) for name in names], xs, ys, [errors[name] for name in names], tol)
+    return errors
+
+def saveCdfTables(path, names, specs, xs, ys, errors, tol, source="dists"):
+    """Stores the tables (xs[i], ys[i]) of names with their spec strings and errors
+
+    source "dists" marks tables of the dists.dists cdfs, whose specs are
+    checked when loading; tables of other sources (e.g. the empirical cdfs
+    of corpusDistributions) are loaded as they are.
+    """
+    offsets = np.concatenate([[0], np.cumsum([len(x) for x in xs])]).astype(np.int64)
+    np.savez(path, names=np.array(names), specs=np.array(specs), offsets=offsets,
+             x=np.concatenate(xs) if xs else np.zeros(0), y=np.concatenate(ys) if ys else np.zeros(0),
+             errors=np.array(errors, dtype=np.float64), tol=tol, source=source)
+
+def loadCdfTables(path=CDF_TABLES):
+    """name -> interpolating cdf for every table of path
+
+    Tables built from dists.dists are only used while they match it.
+    """
+    data = np.load(path)
+    offsets = data['offsets']
+    # tables written before the source was stored are dists tables
+    source = str(data['source']) if 'source' in data.files else "dists"
+    cdfs = {}
+    for i, (name, spec) in enumerate(zip(data['names'].tolist(), data['specs'].tolist())):
+        if source == "dists" and (name not in dists.dists or spec != _spec(name)):
+            logging.warning("CDF table for %s does not match dists.py, ignoring it", name)
+            continue
+        cdfs[name] = tableCdf(data['x'][offsets[i]:offsets[i+1]], data['y'][offsets[i]:offsets[i+1]])
+    return cdfs
@@ -0,0 +1,203 @@
+"""Empirical descriptor distributions of a corpus in bounded memory.
+
+fitCorpusDistributions streams the raw descriptors of a corpus through
+CorpusDistributions chunk by chunk (computed in parallel by
+processSmilesInto), so the full descriptor matrix is never held.  Every
+descriptor keeps a StreamingHistogram: exact value counts while it has at
+most maxDistinct distinct values (count descriptors like fr_* or
+NumHDonors), a fixed number of bins over sign(v) * log1p(|v|) otherwise,
+whose range doubles whenever a value falls outside it.
+
+The resulting empirical cdfs are saved in the cdfTables format (with
+source "corpus"), which rdNormalizedDescriptors.useNormalization loads in
+place of the cdfs of dists.dists.
+"""
+import json
+import logging
+import numpy as np
+from . import cdfTables
+from .rdDescriptors import RDKit2D
+
+def _forward(v):
+    return np.sign(v) * np.log1p(np.abs(v))
+
+def _inverse(t):
+    return np.sign(t) * np.expm1(np.abs(t))
+
+
+class StreamingHistogram(object):
+    def __init__(self, maxDistinct=4096, nBins=4096):
+        if nBins % 2:
+            raise ValueError("nBins must be even, got %d" % nBins)
+        self.maxDistinct = maxDistinct
+        self.nBins = nBins
+        self.n = 0
+        self.nonFinite = 0
+        self.total = 0.
+        self.totalSquares = 0.
+        self.minV = np.inf
+        self.maxV = -np.inf
+        # exact mode: sorted distinct values and their counts
+        self.values = np.zeros(0, dtype=np.float64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        # histogram mode: bin i covers [lo + i * width, lo + (i + 1) * width) of _forward(v)
+        self.bins = None
+        self.lo = 0.
+        self.width = 0.
+
+    @property
+    def exact(self):
+        return self.bins is None
+
+    def update(self, v):
+        """Adds the values of the 1d array v; nan and inf are only counted"""
+        v = np.asarray(v, dtype=np.float64)
+        finite = np.isfinite(v)
+        self.nonFinite += int(len(v) - finite.sum())
+        v = v[finite]
+        if not len(v):
+            return
+        self.n += len(v)
+        self.total += float(v.sum())
+        self.totalSquares += float(np.dot(v, v))
+        self.minV = min(self.minV, float(v.min()))
+        self.maxV = max(self.maxV, float(v.max()))
+        if self.exact:
+            values, counts = np.unique(v, return_counts=True)
+            self._addExact(values, counts)
+        else:
+            self._addBinned(v, None)
+
+    def _addExact(self, values, counts):
+        merged = np.union1d(self.values, values)
+        mergedCounts = np.zeros(len(merged), dtype=np.int64)
+        mergedCounts[np.searchsorted(merged, self.values)] += self.counts
+        mergedCounts[np.searchsorted(merged, values)] += counts
+        if len(merged) <= self.maxDistinct:
+            self.values, self.counts = merged, mergedCounts
+            return
+        # too many distinct values, switch to bins spanning the values seen so far
+        t = _forward(merged)
+        self.lo = float(t[0])
+        self.width = max(float(t[-1] - t[0]), 1e-12) / self.nBins * (1 + 1e-9)
+        self.bins = np.zeros(self.nBins, dtype=np.int64)
+        self.values = self.counts = None
+        self._addBinned(merged, mergedCounts)
+
+    def _addBinned(self, v, counts):
+        t = _forward(v)
+        tMin, tMax = float(t.min()), float(t.max())
+        half = self.nBins // 2
+        while tMin < self.lo or tMax >= self.lo + self.nBins * self.width:
+            # double the bin width, the current range becomes one half of the new one
+            merged = self.bins[0::2] + self.bins[1::2]
+            self.bins = np.zeros(self.nBins, dtype=np.int64)
+            if tMin < self.lo:
+                self.bins[half:] = merged
+                self.lo -= self.nBins * self.width
+            else:
+                self.bins[:half] = merged
+            self.width *= 2
+        index = np.minimum(((t - self.lo) / self.width).astype(np.int64), self.nBins - 1)
+        self.bins += np.bincount(index, weights=counts, minlength=self.nBins).astype(np.int64)
+
+    def cdfTable(self):
+        """(x, y) of the empirical cdf for np.interp, and its maximum step
+
+        Exact distributions map every observed value to its mid-rank
+        P(X < x) + P(X = x) / 2 (ties share their average rank, a constant
+        descriptor is 0.5); binned ones interpolate the cumulative bin counts
+        linearly within bins.  The maximum step is the largest probability
+        mass interpolated over, i.e. the resolution of the cdf.
+        """
+        if not self.n:
+            return None, None, 1.
+        if self.exact:
+            below = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+            return self.values.copy(), (below + 0.5 * self.counts) / self.n, float(self.counts.max()) / self.n
+        edges = _inverse(self.lo + self.width * np.arange(self.nBins + 1))
+        y = np.concatenate([[0], np.cumsum(self.bins)]) / self.n
+        # the cdf spans the observed extremes: edges beyond them (of the bins
+        # holding minV and maxV or of empty bins outside) are clamped onto
+        # them, which keeps the edges sorted
+        edges = np.clip(edges, self.minV, self.maxV)
+        # interior points of flat stretches (empty bins) are dropped
+        keep = np.ones(len(y), dtype=bool)
+        keep[1:-1] = (y[1:-1] != y[:-2]) | (y[1:-1] != y[2:])
+        return edges[keep], y[keep], float(self.bins.max()) / self.n
+
+    def quantiles(self, q):
+        x, y, _ = self.cdfTable()
+        if x is None:
+            return np.full(np.shape(q), np.nan)
+        return np.interp(q, y, x)
+
+    def summary(self):
+        mean = self.total / self.n if self.n else np.nan
+        std = np.sqrt(max(self.totalSquares / self.n - mean * mean, 0.)) if self.n else np.nan
+        return dict(n=self.n, nonFinite=self.nonFinite, minV=self.minV, maxV=self.maxV, avg=mean, std=std,
+                    exact=self.exact, distinct=len(self.values) if self.exact else None)
+
+
+class CorpusDistributions(object):
+    """StreamingHistograms of the columns names of descriptor matrix chunks"""
+    def __init__(self, names, maxDistinct=4096, nBins=4096):
+        self.names = list(names)
+        self.histograms = [StreamingHistogram(maxDistinct, nBins) for _ in self.names]
+
+    def update(self, values, valid=None):
+        """Adds the (n, len(names)) values, only the rows with valid[i] when given"""
+        if valid is not None:
+            values = values[valid]
+        for j, histogram in enumerate(self.histograms):
+            histogram.update(values[:, j])
+
+    def quantiles(self, q):
+        """name -> quantiles q of the descriptor"""
+        return {name: histogram.quantiles(q) for name, histogram in zip(self.names, self.histograms)}
+
+    def summary(self):
+        """{name: n, nonFinite, minV, maxV, avg, std, exact, distinct} of every descriptor"""
+        return {name: histogram.summary() for name, histogram in zip(self.names, self.histograms)}
+
+    def save(self, path):
+        """Writes the empirical cdfs in the cdfTables format, returns {name: max step}
+
+        Descriptors without a single finite value are left out, so they keep
+        their dists.dists normalization.
+        """
+        names, specs, xs, ys, steps = [], [], [], [], {}
+        for name, histogram in zip(self.names, self.histograms):
+            x, y, step = histogram.cdfTable()
+            steps[name] = step
+            if x is None:
+                logging.warning("No finite values of %s in the corpus, not storing a cdf", name)
+                continue
+            names.append(name)
+            specs.append(json.dumps(histogram.summary()))
+            xs.append(x)
+            ys.append(y)
+        cdfTables.saveCdfTables(path, names, specs, xs, ys, [steps[name] for name in names],
+                                tol=1., source="corpus")
+        return steps
+
+def fitCorpusDistributions(smiles, path=None, generator=None, chunk_size=10000, n_jobs=1,
+                           jobs_chunk_size=1000, maxDistinct=4096, nBins=4096):
+    """Streams the raw descriptors of smiles strings into CorpusDistributions
+
+    generator defaults to RDKit2D, whose columns are the normalized
+    descriptors of RDKit2DNormalized.  Only chunk_size rows are held in
+    memory at a time, computed with n_jobs processes (see
+    processSmilesInto); invalid smiles are skipped, descriptors that failed
+    count with their default value as in processMol.  The cdfs are saved to
+    path when given.
+    """
+    generator = RDKit2D() if generator is None else generator
+    distributions = CorpusDistributions([name for name, _ in generator.columns], maxDistinct, nBins)
+    for start in range(0, len(smiles), chunk_size):
+        values, valid = generator.processSmilesInto(smiles[start:start+chunk_size], n_jobs=n_jobs,
+                                                    chunk_size=jobs_chunk_size)
+        distributions.update(values, valid)
+    if path is not None:
+        distributions.save(path)
+    return distributions
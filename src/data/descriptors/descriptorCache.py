@@ -0,0 +1,165 @@
+"""Size bounded LRU cache of descriptor results keyed by canonical SMILES.
+
+Results are kept as compact numpy rows, (calculated flag, values), instead
+of the python lists or arrays processMol returns, and never hold on to
+molecules.
+With a path the cache is backed by a sqlite database that can be shared by
+all worker processes and reused by later runs; rows found there are moved
+into the in-memory LRU.
+
+Caches are registered per process under (path, namespace, maxsize), so a
+generator that is pickled to Pool.imap workers with every task batch keeps
+using the cache its worker already filled.  Threads of a process share its
+caches, which serialize access with a lock.
+"""
+import os
+import sqlite3
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import util
+
+_PROCESS_CACHES = {}
+
+def processCache(maxsize, path=None, namespace="", dtype=np.float64):
+    """The DescriptorCache of this process for (path, namespace, maxsize)"""
+    key = (os.getpid(), path, namespace, maxsize)
+    cache = _PROCESS_CACHES.get(key)
+    if cache is None:
+        cache = _PROCESS_CACHES[key] = DescriptorCache(maxsize, path, namespace, dtype)
+    return cache
+
+
+class DescriptorCache(object):
+    # pending rows are written to the database in batches of this size
+    FLUSH_EVERY = 256
+
+    def __init__(self, maxsize, path=None, namespace="", dtype=np.float64):
+        self.maxsize = maxsize
+        self.path = path
+        self.namespace = namespace
+        self.dtype = np.dtype(dtype)
+        self.rows = OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = None
+        self._pid = None
+        self.lock = threading.RLock()
+
+    def __reduce__(self):
+        return (processCache, (self.maxsize, self.path, self.namespace, self.dtype))
+
+    def db(self):
+        # sqlite connections cannot be shared with forked processes
+        if self._db is None or self._pid != os.getpid():
+            # the connection is used by every thread, under self.lock
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS descriptors (namespace TEXT, smiles TEXT, "
+                             "flag INTEGER, row BLOB, PRIMARY KEY (namespace, smiles))")
+            self._db.commit()
+            self._pid = os.getpid()
+            # pool workers run finalizers when the pool is closed and joined
+            util.Finalize(self, self.flush, exitpriority=10)
+        return self._db
+
+    def toEntry(self, res):
+        # processMol results are [flag] + values lists or numpy arrays starting with the flag
+        if isinstance(res, list):
+            return bool(res[0]), np.asarray(res[1:], dtype=self.dtype), False
+        return bool(res[0]), np.array(res[1:], dtype=self.dtype), True
+
+    def fromEntry(self, entry):
+        flag, row, asArray = entry
+        if asArray:
+            return np.concatenate([[flag], row]).astype(self.dtype)
+        return [flag] + row.tolist()
+
+    def _remember(self, key, entry):
+        self.rows[key] = entry
+        if len(self.rows) > self.maxsize:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+
+    def _entry(self, key):
+        entry = self.rows.get(key)
+        if entry is not None:
+            self.rows.move_to_end(key)
+            self.hits += 1
+            return entry
+        if self.path is not None:
+            found = self.db().execute("SELECT flag, row FROM descriptors WHERE namespace=? AND smiles=?",
+                                      (self.namespace, key)).fetchone()
+            if found is not None:
+                flag, blob = found
+                entry = (bool(flag & 1), np.frombuffer(blob, dtype=self.dtype).copy(), bool(flag & 2))
+                self._remember(key, entry)
+                self.disk_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def get(self, key):
+        """processMol result for the canonical smiles key, None if not cached"""
+        with self.lock:
+            entry = self._entry(key)
+        if entry is None:
+            return None
+        return self.fromEntry(entry)
+
+    def getInto(self, key, out):
+        """Writes the cached values for key into out and returns their flag, None if not cached"""
+        with self.lock:
+            entry = self._entry(key)
+        if entry is None:
+            return None
+        out[:] = entry[1]
+        return entry[0]
+
+    def _store(self, key, entry):
+        self._remember(key, entry)
+        if self.path is not None:
+            flag = int(entry[0]) | (2 if entry[2] else 0)
+            self.pending.append((self.namespace, key, flag, entry[1].tobytes()))
+            if len(self.pending) >= self.FLUSH_EVERY:
+                self.flush()
+
+    def put(self, key, res):
+        entry = self.toEntry(res)
+        with self.lock:
+            self._store(key, entry)
+
+    def putRow(self, key, flag, row):
+        """Caches a columnar result, which processMol hits return as a list"""
+        entry = (bool(flag), np.array(row, dtype=self.dtype), False)
+        with self.lock:
+            self._store(key, entry)
+
+    def flush(self):
+        """Write pending rows to the database
+
+        Also called when the process exits normally; rows still pending in
+        a terminated worker are lost and simply recomputed by the next run.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            try:
+                db = self.db()
+                db.executemany("INSERT OR IGNORE INTO descriptors VALUES (?, ?, ?, ?)", self.pending)
+                db.commit()
+            except sqlite3.Error:
+                logging.exception("Could not write %d rows to descriptor cache %s", len(self.pending), self.path)
+            self.pending = []
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+    def stats(self):
+        return dict(size=len(self.rows), maxsize=self.maxsize, hits=self.hits, disk_hits=self.disk_hits,
+                    misses=self.misses, evictions=self.evictions)
@@ -0,0 +1,119 @@
+"""Per descriptor timing of descriptor generators.
+
+A DescriptorProfile accumulates the wall time, number of calls and number
+of failures of every descriptor function, shared intermediate and
+normalization cdf a generator evaluates, see
+DescriptorGenerator.enableProfiling.
+
+Like descriptor caches, profiles are registered per process, so a generator
+that is pickled to pool workers with every task batch keeps adding to the
+profile of its worker.  Parallel processMols/processSmiles return the
+worker profiles with every chunk.  With a path, every process also writes
+its profile to a json file in that directory when it exits (pool workers do
+when the pool is closed and joined), and loadProfiles aggregates all files
+of the directory.  Threads of a process share its profiles.
+"""
+import os
+import json
+import uuid
+import threading
+from multiprocessing import util
+
+_PROCESS_PROFILES = {}
+
+def processProfile(generator, path=None):
+    """The DescriptorProfile of this process for (generator, path)"""
+    key = (os.getpid(), generator, path)
+    profile = _PROCESS_PROFILES.get(key)
+    if profile is None:
+        profile = _PROCESS_PROFILES[key] = DescriptorProfile(generator, path)
+    return profile
+
+
+class DescriptorProfile(object):
+    def __init__(self, generator, path=None):
+        self.generator = generator
+        self.path = path
+        # (kind, name) -> [calls, failures, seconds]
+        self.stats = {}
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.filename = os.path.join(path, "%s-%d-%s.json" % (generator, os.getpid(), uuid.uuid4().hex[:8]))
+            util.Finalize(self, self.save, exitpriority=10)
+
+    def __reduce__(self):
+        return (processProfile, (self.generator, self.path))
+
+    def record(self, kind, name, seconds, calls=1, failures=0):
+        with self.lock:
+            entry = self.stats.get((kind, name))
+            if entry is None:
+                entry = self.stats[(kind, name)] = [0, 0, 0.]
+            entry[0] += calls
+            entry[1] += int(failures)
+            entry[2] += seconds
+
+    def merge(self, stats):
+        for (kind, name), (calls, failures, seconds) in stats.items():
+            self.record(kind, name, seconds, calls, failures)
+
+    def take(self):
+        """Returns the stats recorded so far and starts over"""
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def clear(self):
+        self.take()
+
+    def save(self):
+        """Write the stats to this process's file in path"""
+        if self.path is None or not self.stats:
+            return
+        with self.lock:
+            stats = [[kind, name] + entry for (kind, name), entry in self.stats.items()]
+        with open(self.filename, "w") as f:
+            json.dump(stats, f)
+
+    def rows(self):
+        """[{generator, kind, name, calls, failures, seconds, share}], slowest first
+
+        share is the fraction of the total recorded time of the generator.
+        """
+        total = sum(entry[2] for entry in self.stats.values()) or 1.
+        rows = [dict(generator=self.generator, kind=kind, name=name, calls=calls, failures=failures,
+                     seconds=seconds, share=seconds / total)
+                for (kind, name), (calls, failures, seconds) in self.stats.items()]
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+def loadProfiles(path):
+    """Aggregated DescriptorProfiles (one per generator) of all files in path"""
+    profiles = {}
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith(".json"):
+            continue
+        generator = filename.rsplit("-", 2)[0]
+        profile = profiles.get(generator)
+        if profile is None:
+            profile = profiles[generator] = DescriptorProfile(generator)
+        with open(os.path.join(path, filename)) as f:
+            for kind, name, calls, failures, seconds in json.load(f):
+                profile.record(kind, name, seconds, calls, failures)
+    return list(profiles.values())
+
+def report(profiles):
+    """Text table of the rows of all profiles, slowest first"""
+    rows = sorted((row for profile in profiles for row in profile.rows()),
+                  key=lambda row: row["seconds"], reverse=True)
+    lines = ["%-20s %-12s %-28s %10s %8s %10s %10s %6s" % (
+        "generator", "kind", "name", "calls", "failures", "total s", "mean us", "share")]
+    for row in rows:
+        lines.append("%-20s %-12s %-28s %10d %8d %10.3f %10.1f %5.1f%%" % (
+            row["generator"], row["kind"], row["name"], row["calls"], row["failures"], row["seconds"],
+            1e6 * row["seconds"] / max(row["calls"], 1), 100 * row["share"]))
+    return "\n".join(lines) + "\n"
+
+def writeReport(profiles, path):
+    with open(path, "w") as f:
+        f.write(report(profiles))
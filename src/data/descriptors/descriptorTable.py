@@ -0,0 +1,128 @@
+"""Columnar on-disk descriptor tables.
+
+A table is a directory with one .npy file per column dtype and a
+schema.json describing the columns.  Every .npy file holds the columns of
+its dtype as rows of an (n_columns, n_rows) array, so a column is one
+contiguous range of the file and is read lazily through a memmap.
+
+DescriptorTableWriter fills the files chunk by chunk, e.g. from the
+columnar processMolsInto results, and writes the schema when it is
+closed, so directories without a schema are incomplete tables.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from rdkit import Chem
+
+SCHEMA = "schema.json"
+
+def _blockName(dtype):
+    return "%s.npy" % np.dtype(dtype).name
+
+
+class DescriptorTableWriter(object):
+    """Writes rows of n_rows x columns ([(name, dtype)], e.g. GetColumns()) to path"""
+    def __init__(self, path, columns, n_rows):
+        self.path = path
+        self.n_rows = n_rows
+        self.columns = [(name, np.dtype(dtype)) for name, dtype in columns]
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, SCHEMA)):
+            os.remove(os.path.join(path, SCHEMA))
+        # dtype -> indices of its columns, in column order
+        self.groups = {}
+        for j, (name, dtype) in enumerate(self.columns):
+            self.groups.setdefault(dtype, []).append(j)
+        self.blocks = {dtype: np.lib.format.open_memmap(os.path.join(path, _blockName(dtype)), mode='w+',
+                                                        dtype=dtype, shape=(len(indices), n_rows))
+                       for dtype, indices in self.groups.items()}
+
+    def write(self, start, values):
+        """Writes the (n, n_columns) rows values, in column order, to rows start:start+n"""
+        for dtype, indices in self.groups.items():
+            self.blocks[dtype][:, start:start+len(values)] = values[:, indices].T
+
+    def close(self):
+        """Flushes the data, writes the schema and returns the DescriptorTable"""
+        for block in self.blocks.values():
+            block.flush()
+        self.blocks = {}
+        positions = {}
+        schema = []
+        for name, dtype in self.columns:
+            position = positions.get(dtype, 0)
+            positions[dtype] = position + 1
+            schema.append([name, dtype.name, position])
+        with open(os.path.join(self.path, SCHEMA), 'w') as f:
+            json.dump({"n_rows": self.n_rows, "columns": schema}, f)
+        return DescriptorTable(self.path)
+
+
+class DescriptorTable(object):
+    """Lazily loaded table written by DescriptorTableWriter
+
+    table[name] is the memmapped column, table.rows(start, stop) and
+    table.toDataFrame(...) read (a subset of) columns for a range of rows,
+    iterChunks streams them as DataFrames.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SCHEMA)) as f:
+            schema = json.load(f)
+        self.n_rows = schema["n_rows"]
+        self.columns = [name for name, _, _ in schema["columns"]]
+        self.dtypes = {name: np.dtype(dtype) for name, dtype, _ in schema["columns"]}
+        self.positions = {name: position for name, _, position in schema["columns"]}
+        self.blocks = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def block(self, dtype):
+        if dtype not in self.blocks:
+            self.blocks[dtype] = np.load(os.path.join(self.path, _blockName(dtype)), mmap_mode='r')
+        return self.blocks[dtype]
+
+    def __getitem__(self, name):
+        return self.block(self.dtypes[name])[self.positions[name]]
+
+    def rows(self, start=0, stop=None, columns=None, dtype=np.float64):
+        """(stop - start, n_columns) array of the given (default all) columns"""
+        columns = self.columns if columns is None else columns
+        stop = self.n_rows if stop is None else min(stop, self.n_rows)
+        res = np.empty((max(stop - start, 0), len(columns)), dtype=dtype)
+        for j, name in enumerate(columns):
+            res[:, j] = self[name][start:stop]
+        return res
+
+    def toDataFrame(self, start=0, stop=None, columns=None):
+        """DataFrame of rows start:stop keeping the column dtypes, indexed by row number"""
+        columns = self.columns if columns is None else columns
+        stop = self.n_rows if stop is None else min(stop, self.n_rows)
+        return pd.DataFrame({name: np.asarray(self[name][start:stop]) for name in columns},
+                            columns=columns, index=pd.RangeIndex(start, max(stop, start)))
+
+    def iterChunks(self, chunk_size=100000, columns=None):
+        for start in range(0, self.n_rows, chunk_size):
+            yield self.toDataFrame(start, start + chunk_size, columns)
+
+def writeDescriptors(generator, mols, path, chunk_size=10000, n_jobs=1, jobs_chunk_size=1000):
+    """Computes the descriptors of smiles strings or molecules into a DescriptorTable at path
+
+    Only chunk_size rows are held in memory at a time; they are computed by
+    the columnar processSmilesInto/processMolsInto (with n_jobs processes,
+    see processMolsInto) and stored with the dtypes of GetColumns().
+    """
+    writer = DescriptorTableWriter(path, generator.GetColumns(), len(mols))
+    for start in range(0, len(mols), chunk_size):
+        chunk = mols[start:start+chunk_size]
+        if type(chunk[0]) == str:
+            values, valid = generator.processSmilesInto(chunk, n_jobs=n_jobs, chunk_size=jobs_chunk_size)
+        else:
+            values, valid = generator.processMolsInto(chunk, [Chem.MolToSmiles(m) for m in chunk],
+                                                      n_jobs=n_jobs, chunk_size=jobs_chunk_size)
+        if generator.NAME:
+            values = np.column_stack([valid, values])
+        writer.write(start, values)
+    return writer.close()
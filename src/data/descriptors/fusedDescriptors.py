@@ -0,0 +1,224 @@
+"""Fused evaluation of the RDKit2D descriptors.
+
+The Descriptors.descList functions are independent, so evaluating them one
+by one recomputes the same intermediates: the EState indices for the four
+EState index columns and both EState VSA families, the Labute ASA
+contributions, the Gasteiger charges, the Crippen and VSA vectors and most
+of the QED properties.  FusedDescriptors computes every intermediate a column
+set needs once per molecule and derives the dependent columns from it, with
+the same arithmetic as RDKit.  Columns without a shared intermediate are
+evaluated with rdDescriptors.FUNCS.
+
+If an intermediate or a derived value fails (with one of the FAILURES RDKit
+raises), the affected columns fall back to rdDescriptors.applyFunc, so
+failures are logged and reported as None exactly as before.
+"""
+import bisect
+import time
+import numpy
+from rdkit import Chem
+from rdkit.Chem import Crippen, Descriptors, MolSurf, QED, rdPartialCharges
+from rdkit.Chem import rdMolDescriptors as rd
+from rdkit.Chem.EState import EState, EState_VSA
+from . import rdDescriptors
+from .patternScreen import PatternScreen, kindIndex, molKinds
+
+# how RDKit descriptor functions fail on molecules they cannot handle; other
+# exceptions are bugs and are raised rather than hidden by the applyFunc fallback
+FAILURES = (ArithmeticError, KeyError, RuntimeError, ValueError)
+
+# element/ring pre-screens of the RDKit QED patterns
+_ACCEPTORS = PatternScreen(QED.Acceptors)
+_ALERTS = PatternScreen(QED.StructuralAlerts)
+
+
+def _eStateVSA(estate, volContribs):
+    # EState_VSA.EState_VSA_: volume contributions binned by EState index
+    ans = numpy.zeros(len(EState_VSA.estateBins) + 1, dtype=numpy.float64)
+    for i, prop in enumerate(estate):
+        if prop is not None:
+            ans[bisect.bisect_right(EState_VSA.estateBins, prop)] += volContribs[i + 1]
+    return ans
+
+def _vsaEState(estate, volContribs):
+    # EState_VSA.VSA_EState_: EState indices binned by volume contribution
+    ans = numpy.zeros(len(EState_VSA.vsaBins) + 1, dtype=numpy.float64)
+    for i, prop in enumerate(estate):
+        if prop is not None:
+            ans[bisect.bisect_right(EState_VSA.vsaBins, volContribs[i + 1])] += prop
+    return ans
+
+def _eState(m):
+    estate = EState.EStateIndices(m, force=True)
+    volContribs = MolSurf._LabuteHelper(m)
+    return estate, _eStateVSA(estate, volContribs), _vsaEState(estate, volContribs)
+
+def _charges(m):
+    # Descriptors._ChargeDescriptors
+    rdPartialCharges.ComputeGasteigerCharges(m)
+    minChg = 500.
+    maxChg = -500.
+    for at in m.GetAtoms():
+        chg = float(at.GetProp('_GasteigerCharge'))
+        minChg = min(chg, minChg)
+        maxChg = max(chg, maxChg)
+    return minChg, maxChg
+
+def _qedProperties(m, known=None):
+    """QED.properties, reusing the columns it shares with RDKit2D
+
+    known maps QED properties (MW, ALOGP, HBD, PSA) to the values already
+    computed for m, the others are computed here; ROTB is not reused since
+    QED counts rotatable bonds strictly.  QED works on the molecule without
+    explicit hydrogens, which is the molecule itself unless it has hydrogen
+    atoms, so known is ignored for those.  Acceptor and alert patterns are
+    only searched when the pre-screens allow a match, and molecules without
+    rings have no aromatic rings.
+    """
+    kinds = molKinds(m)
+    if kinds[kindIndex(1, False)]:
+        return QED.properties(m)
+    known = known or {}
+    def value(prop, func):
+        return known[prop] if prop in known else func(m)
+    arom = 0
+    if m.GetRingInfo().NumRings():
+        # GetSSSR returns the number of rings in older RDKit versions and the rings in newer ones
+        rings = Chem.GetSSSR(Chem.DeleteSubstructs(Chem.Mol(m), QED.AliphaticRings))
+        arom = rings if isinstance(rings, int) else len(rings)
+    return QED.QEDproperties(
+        MW=value("MW", Descriptors.MolWt),
+        ALOGP=value("ALOGP", Crippen.MolLogP),
+        HBA=_ACCEPTORS.countMatches(m, kinds),
+        HBD=value("HBD", rd.CalcNumHBD),
+        PSA=value("PSA", MolSurf.TPSA),
+        ROTB=rd.CalcNumRotatableBonds(m, rd.NumRotatableBondsOptions.Strict),
+        AROM=arom,
+        ALERTS=_ALERTS.countMatching(m, kinds),
+    )
+
+# QED property -> the RDKit2D column with the same value
+QED_COLUMNS = dict(MW="MolWt", ALOGP="MolLogP", HBD="NumHDonors", PSA="TPSA")
+
+def _bins(prefix, n, index=None):
+    def getter(i):
+        if index is None:
+            return lambda v: v[i]
+        return lambda v: v[index][i]
+    return {"%s%d" % (prefix, i + 1): getter(i) for i in range(n)}
+
+# intermediate -> (function of the molecule, {column: function of the intermediate})
+INTERMEDIATES = {
+    "estate": (_eState, dict(
+        MaxEStateIndex=lambda v: max(v[0]),
+        MinEStateIndex=lambda v: min(v[0]),
+        MaxAbsEStateIndex=lambda v: max(abs(x) for x in v[0]),
+        MinAbsEStateIndex=lambda v: min(abs(x) for x in v[0]),
+        **_bins("EState_VSA", len(EState_VSA.estateBins) + 1, 1),
+        **_bins("VSA_EState", len(EState_VSA.vsaBins) + 1, 2))),
+    "charges": (_charges, dict(
+        MinPartialCharge=lambda v: v[0],
+        MaxPartialCharge=lambda v: v[1],
+        MaxAbsPartialCharge=lambda v: max(abs(v[0]), abs(v[1])),
+        MinAbsPartialCharge=lambda v: min(abs(v[0]), abs(v[1])))),
+    "crippen": (rd.CalcCrippenDescriptors, dict(
+        MolLogP=lambda v: v[0],
+        MolMR=lambda v: v[1])),
+    "peoe_vsa": (lambda m: MolSurf.PEOE_VSA_(m, force=False), _bins("PEOE_VSA", 14)),
+    "smr_vsa": (lambda m: MolSurf.SMR_VSA_(m, force=False), _bins("SMR_VSA", 10)),
+    "slogp_vsa": (lambda m: MolSurf.SlogP_VSA_(m, force=False), _bins("SlogP_VSA", 12)),
+}
+
+
+class FusedDescriptors(object):
+    """Computes the given descriptor columns of a molecule, sharing intermediates
+
+    calculate(m) returns the same list as [applyFunc(name, m) for name in names].
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        index = {name: j for j, name in enumerate(self.names)}
+        self.groups = []
+        for label, (func, derived) in INTERMEDIATES.items():
+            columns = [(index[name], name, derived[name]) for name in derived if name in index]
+            if columns:
+                self.groups.append((label, func, columns))
+        self.qed = index.get("qed")
+        self.qedColumns = [(prop, index[name]) for prop, name in QED_COLUMNS.items() if name in index]
+        fused = set(j for _, _, columns in self.groups for j, _, _ in columns)
+        if self.qed is not None:
+            fused.add(self.qed)
+        self.single = [(j, name) for j, name in enumerate(self.names) if j not in fused]
+
+    def __reduce__(self):
+        # the column groups hold lambdas, so generators are sent to workers by column names
+        return (FusedDescriptors, (self.names,))
+
+    def _qedKnown(self, res, crippen):
+        # the QED properties among the computed columns, ALOGP also from the crippen intermediate
+        known = {prop: res[j] for prop, j in self.qedColumns if res[j] is not None}
+        if "ALOGP" not in known and crippen is not None:
+            known["ALOGP"] = crippen[0]
+        return known
+
+    def calculate(self, m, profile=None):
+        if profile is not None:
+            return self.calculateProfiled(m, profile)
+        res, values = [None] * len(self.names), {}
+        for j, name in self.single:
+            res[j] = rdDescriptors.applyFunc(name, m)
+        for label, func, columns in self.groups:
+            try:
+                value = func(m)
+            except FAILURES:
+                value = None
+            values[label] = value
+            for j, name, derive in columns:
+                try:
+                    # columns of a failed intermediate are computed on their own
+                    res[j] = rdDescriptors.applyFunc(name, m) if value is None else derive(value)
+                except FAILURES:
+                    res[j] = rdDescriptors.applyFunc(name, m)
+        if self.qed is not None:
+            try:
+                res[self.qed] = QED.qed(m, qedProperties=_qedProperties(m, self._qedKnown(res, values.get("crippen"))))
+            except FAILURES:
+                res[self.qed] = rdDescriptors.applyFunc("qed", m)
+        return res
+
+    def calculateProfiled(self, m, profile):
+        """calculate, recording every descriptor function and intermediate in a DescriptorProfile
+
+        Derived columns are recorded as descriptors, including the time of
+        their applyFunc fallback; a None value counts as a failure.
+        """
+        clock = time.perf_counter
+        res, values = [None] * len(self.names), {}
+        for j, name in self.single:
+            start = clock()
+            res[j] = rdDescriptors.applyFunc(name, m)
+            profile.record("descriptor", name, clock() - start, failures=res[j] is None)
+        for label, func, columns in self.groups:
+            start = clock()
+            try:
+                value = func(m)
+            except FAILURES:
+                value = None
+            values[label] = value
+            profile.record("intermediate", label, clock() - start, failures=value is None)
+            for j, name, derive in columns:
+                start = clock()
+                try:
+                    # columns of a failed intermediate are computed on their own
+                    res[j] = rdDescriptors.applyFunc(name, m) if value is None else derive(value)
+                except FAILURES:
+                    res[j] = rdDescriptors.applyFunc(name, m)
+                profile.record("descriptor", name, clock() - start, failures=res[j] is None)
+        if self.qed is not None:
+            start = clock()
+            try:
+                res[self.qed] = QED.qed(m, qedProperties=_qedProperties(m, self._qedKnown(res, values.get("crippen"))))
+            except FAILURES:
+                res[self.qed] = rdDescriptors.applyFunc("qed", m)
+            profile.record("descriptor", "qed", clock() - start, failures=res[self.qed] is None)
+        return res
@@ -0,0 +1,112 @@
+"""Element and ring pre-screening of SMARTS patterns.
+
+A pattern can only match a molecule that has, for every query atom, an atom
+of an element (and aromaticity) the query atom allows, at least as many such
+atoms as there are query atoms restricted to them, and a ring if the pattern
+itself has one.  PatternScreen derives these necessary conditions once from
+each pattern's query description, so patterns that cannot match are skipped
+without running a substructure match.  Query primitives the screen does not
+understand (negations, recursive SMARTS, ...) never exclude a molecule, so
+screening does not change any match result.
+"""
+import re
+import numpy as np
+from rdkit import Chem
+
+_ELEMENT_QUERY = re.compile(r"^(AtomType|AtomAtomicNum) (\d+) = val$")
+# atom kinds are (atomic number, aromatic) pairs, counted at 2 * atomic number + aromatic
+N_KINDS = 2 * 128
+
+def kindIndex(atomicNum, aromatic):
+    return 2 * atomicNum + int(aromatic)
+
+def _parseQuery(lines, i=0):
+    # (set of allowed (atomic number, aromatic) kinds or None, next line) of the node at lines[i]
+    depth = len(lines[i]) - len(lines[i].lstrip(" "))
+    text = lines[i].strip()
+    j = i + 1
+    children = []
+    while j < len(lines) and len(lines[j]) - len(lines[j].lstrip(" ")) > depth:
+        child, j = _parseQuery(lines, j)
+        children.append(child)
+    if text == "AtomAnd":
+        constrained = [child for child in children if child is not None]
+        if not constrained:
+            return None, j
+        return frozenset.intersection(*constrained), j
+    if text == "AtomOr":
+        if not children or any(child is None for child in children):
+            return None, j
+        return frozenset.union(*children), j
+    match = _ELEMENT_QUERY.match(text)
+    if match is None or children:
+        return None, j
+    value = int(match.group(2))
+    if match.group(1) == "AtomAtomicNum":
+        return frozenset([(value, False), (value, True)]), j
+    # AtomType encodes aromatic atoms as 1000 + atomic number
+    return frozenset([(value % 1000, value >= 1000)]), j
+
+def queryKinds(atom):
+    """(atomic number, aromatic) kinds a query atom can match, None if unrestricted"""
+    if not atom.HasQuery():
+        # plain atoms match on the atomic number
+        return frozenset([(atom.GetAtomicNum(), False), (atom.GetAtomicNum(), True)])
+    lines = [line for line in atom.DescribeQuery().split("\n") if line.strip()]
+    if not lines:
+        return None
+    return _parseQuery(lines)[0]
+
+def molKinds(mol):
+    """Number of atoms of each kind, indexed by kindIndex"""
+    keys = [kindIndex(atom.GetAtomicNum(), atom.GetIsAromatic()) for atom in mol.GetAtoms()]
+    return np.bincount(keys, minlength=N_KINDS)[:N_KINDS] if keys else np.zeros(N_KINDS, dtype=np.int64)
+
+
+class PatternScreen(object):
+    """Necessary conditions for matching each of a list of query molecules
+
+    The conditions are compiled into a matrix of minimum atom counts per
+    distinct kind set, so candidates(mol) is a few numpy operations on the
+    molecule's kind counts.  It returns the indices of the patterns that may
+    match mol; all others certainly do not.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        sets = {}
+        needs = []
+        for pattern in self.patterns:
+            kinds = [queryKinds(atom) for atom in pattern.GetAtoms()]
+            restricted = set(k for k in kinds if k is not None)
+            # query atoms map to distinct atoms: every restricted kind set needs at least
+            # as many atoms as there are query atoms restricted to (a subset of) it
+            needs.append([(sets.setdefault(allowed, len(sets)), sum(1 for k in kinds if k is not None and k <= allowed))
+                          for allowed in restricted])
+        self.members = np.zeros((max(len(sets), 1), N_KINDS), dtype=np.int64)
+        for allowed, k in sets.items():
+            self.members[k, [kindIndex(*kind) for kind in allowed]] = 1
+        self.required = np.zeros((len(self.patterns), self.members.shape[0]), dtype=np.int64)
+        for i, pattern_needs in enumerate(needs):
+            for k, n in pattern_needs:
+                self.required[i, k] = n
+        self.sizes = np.array([pattern.GetNumAtoms() for pattern in self.patterns], dtype=np.int64)
+        # the query graph has a cycle if it has more bonds than a forest on its atoms
+        self.rings = np.array([pattern.GetNumBonds() - pattern.GetNumAtoms() + len(Chem.GetMolFrags(pattern)) > 0
+                               for pattern in self.patterns], dtype=bool)
+
+    def candidates(self, mol, kinds=None):
+        if kinds is None:
+            kinds = molKinds(mol)
+        possible = (self.required <= self.members.dot(kinds)).all(axis=1)
+        possible &= self.sizes <= mol.GetNumAtoms()
+        if mol.GetRingInfo().NumRings() == 0:
+            possible &= ~self.rings
+        return np.flatnonzero(possible).tolist()
+
+    def countMatching(self, mol, kinds=None):
+        """number of patterns mol has a substructure match for"""
+        return sum(1 for i in self.candidates(mol, kinds) if mol.HasSubstructMatch(self.patterns[i]))
+
+    def countMatches(self, mol, kinds=None):
+        """total number of (unique) substructure matches of all patterns"""
+        return sum(len(mol.GetSubstructMatches(self.patterns[i])) for i in self.candidates(mol, kinds))
@@ -36,13 +36,17 @@ import numpy
 from rdkit.DataStructs import IntSparseIntVect
 from rdkit.DataStructs import ConvertToNumpyArray
 from .DescriptorGenerator import DescriptorGenerator
+from . import fusedDescriptors
+from ..fingerprint import fingerprint_width, fingerprints_into
 import logging
 
 import sys
 
 def to_np(vect, nbits):
     arr = numpy.zeros((nbits, ), 'i')
-    return ConvertToNumpyArray(vect, arr)
+    # ConvertToNumpyArray fills arr in place and returns None
+    ConvertToNumpyArray(vect, arr)
+    return arr
 
 def clip_sparse(vect, nbits):
     l = [0]*nbits
@@ -50,7 +54,59 @@ def clip_sparse(vect, nbits):
         l[i] = min(v, 255)
     return l
 
-class Morgan(DescriptorGenerator):
+class FingerprintGenerator(DescriptorGenerator):
+    """Base of the fingerprint generators
+
+    Subclasses return the RDKit fingerprint of a molecule from fingerprint;
+    it is a bit vector, or a sparse count vector (clipped to 255) when
+    COUNTS is set.  fingerprintsInto writes the fingerprints of many
+    molecules directly into a preallocated uint8 matrix, bit-packed for bit
+    vectors when asked, and is used by the columnar processMolsInto.
+    """
+    COUNTS = False
+
+    def fingerprint(self, m):
+        raise NotImplementedError
+
+    def calculateMol(self, m, smiles, internalParsing=False):
+        if self.COUNTS:
+            return clip_sparse(self.fingerprint(m), self.nbits)
+        return to_np(self.fingerprint(m), self.nbits)
+
+    def fingerprintLayout(self, packed=False):
+        if self.COUNTS:
+            return "counts"
+        return "packed" if packed else "bits"
+
+    def allocateFingerprints(self, n, packed=False):
+        """(n, nbits) uint8 matrix, (n, nbits/8) if packed and not COUNTS"""
+        return numpy.zeros((n, fingerprint_width(self.nbits, self.fingerprintLayout(packed))), dtype=numpy.uint8)
+
+    def fingerprintsInto(self, mols, out=None, packed=False, internalParsing=True):
+        """mols -> fingerprint matrix (see allocateFingerprints), zero rows for None molecules"""
+        if out is None:
+            out = self.allocateFingerprints(len(mols), packed)
+        if not internalParsing:
+            mols = [m if m is None else self.molFromMol(m) for m in mols]
+        return fingerprints_into(mols, self.fingerprint, out, self.fingerprintLayout(packed))
+
+    def processMolsInto(self, mols, smiles, values=None, valid=None, internalParsing=False,
+                        n_jobs=1, chunk_size=1000):
+        """Columnar processMols writing the fingerprints of all molecules at once"""
+        if n_jobs > 1 or self.descriptorCache is not None:
+            return DescriptorGenerator.processMolsInto(self, mols, smiles, values, valid, internalParsing,
+                                                       n_jobs, chunk_size)
+        if len(mols) != len(smiles):
+            raise ValueError("Number of molecules does not match number of unparsed molecules")
+        if values is None:
+            values = numpy.zeros((len(mols), len(self.columns)), dtype=numpy.float64)
+        if valid is None:
+            valid = numpy.zeros(len(mols), dtype=bool)
+        self.fingerprintsInto(mols, values, internalParsing=internalParsing)
+        valid[:] = [m is not None for m in mols]
+        return values, valid
+
+class Morgan(FingerprintGenerator):
     """Computes Morgan3 bitvector counts"""
     NAME = "Morgan%s"
     def __init__(self, radius=3, nbits=2048):
@@ -66,16 +122,15 @@ class Morgan(DescriptorGenerator):
         morgan = [("m3-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += morgan
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        counts = to_np(rd.GetMorganFingerprintAsBitVect(m,
-                                                        radius=self.radius, nBits=self.nbits), self.nbits)
-        return counts        
+    def fingerprint(self, m):
+        return rd.GetMorganFingerprintAsBitVect(m, radius=self.radius, nBits=self.nbits)
 
 Morgan()
 
-class MorganCounts(DescriptorGenerator):
+class MorganCounts(FingerprintGenerator):
     """Computes Morgan3 bitvector counts"""
     NAME = "Morgan%sCounts"
+    COUNTS = True
     def __init__(self, radius=3, nbits=2048):
         if radius == 3 and nbits == 2048:
             self.NAME = self.NAME % "3"
@@ -89,15 +144,13 @@ class MorganCounts(DescriptorGenerator):
         morgan = [("m3-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += morgan
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        v = rd.GetHashedMorganFingerprint(m,
-                                          radius=self.radius, nBits=self.nbits)
-        return clip_sparse(v, self.nbits)
+    def fingerprint(self, m):
+        return rd.GetHashedMorganFingerprint(m, radius=self.radius, nBits=self.nbits)
 
 
 MorganCounts()
 
-class ChiralMorgan(DescriptorGenerator):
+class ChiralMorgan(FingerprintGenerator):
     """Computes Morgan3 bitvector counts"""
     NAME = "Morgan%sCounts"
     def __init__(self, radius=3, nbits=2048):
@@ -113,15 +166,16 @@ class ChiralMorgan(DescriptorGenerator):
         morgan = [("cm3-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += morgan
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return to_np(rd.GetMorganFingerprint(
-            m, radius=self.radius, nBits=self.nbits, useChirality=True), self.nbits)
+    def fingerprint(self, m):
+        return rd.GetMorganFingerprintAsBitVect(
+            m, radius=self.radius, nBits=self.nbits, useChirality=True)
 
 ChiralMorgan()
 
-class ChiralMorganCounts(DescriptorGenerator):
+class ChiralMorganCounts(FingerprintGenerator):
     """Computes Morgan3 bitvector counts"""
     NAME = "Morgan%sCounts"
+    COUNTS = True
     def __init__(self, radius=3, nbits=2048):
         if radius == 3 and nbits == 2048:
             self.NAME = self.NAME % "Chiral3"
@@ -135,14 +189,13 @@ class ChiralMorganCounts(DescriptorGenerator):
         morgan = [("cm3-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += morgan
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return clip_sparse(rd.GetHashedMorganFingerprint(
-            m, radius=self.radius, nBits=self.nbits, useChirality=True),
-                    self.nbits)
+    def fingerprint(self, m):
+        return rd.GetHashedMorganFingerprint(
+            m, radius=self.radius, nBits=self.nbits, useChirality=True)
 
 ChiralMorganCounts()
 
-class FeatureMorgan(DescriptorGenerator):
+class FeatureMorgan(FingerprintGenerator):
     """Computes Morgan3 bitvector counts"""
     NAME = "Morgan%s"
     def __init__(self, radius=3, nbits=2048):
@@ -158,17 +211,18 @@ class FeatureMorgan(DescriptorGenerator):
         morgan = [("fm3-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += morgan
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return to_np(rd.GetMorganFingerprintAsBitVect(
-            m, radius=self.radius, nBits=self.nbits, invariants=rd.GetFeatureInvariants(m)), self.nbits)
+    def fingerprint(self, m):
+        return rd.GetMorganFingerprintAsBitVect(
+            m, radius=self.radius, nBits=self.nbits, invariants=rd.GetFeatureInvariants(m))
 
 
 FeatureMorgan()
 
 
-class FeatureMorganCounts(DescriptorGenerator):
+class FeatureMorganCounts(FingerprintGenerator):
     """Computes Morgan3 bitvector counts"""
     NAME = "Morgan%sCounts"
+    COUNTS = True
     def __init__(self, radius=3, nbits=2048):
         if radius == 3 and nbits == 2048:
             self.NAME = self.NAME % "Feature3"
@@ -182,14 +236,13 @@ class FeatureMorganCounts(DescriptorGenerator):
         morgan = [("fm3-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += morgan
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return clip_sparse(rd.GetHashedMorganFingerprint(
-            m, radius=self.radius, nBits=self.nbits, invariants=rd.GetFeatureInvariants(m)),
-                    self.nbits)
+    def fingerprint(self, m):
+        return rd.GetHashedMorganFingerprint(
+            m, radius=self.radius, nBits=self.nbits, invariants=rd.GetFeatureInvariants(m))
 
 FeatureMorganCounts()
 
-class AtomPair(DescriptorGenerator):
+class AtomPair(FingerprintGenerator):
     """Computes AtomPairs bitvector counts"""
     NAME = "AtomPairCounts"
     def __init__(self, minPathLen=1, maxPathLen=30, nbits=2048):
@@ -204,16 +257,17 @@ class AtomPair(DescriptorGenerator):
         ap = [("AP-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += ap
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return to_np(rd.GetAtomPairFingerprint(m, minLength=self.minPathLen, 
-                                               maxLength=self.maxPathLen, nBits=self.nbits), self.nbits)
+    def fingerprint(self, m):
+        return rd.GetHashedAtomPairFingerprintAsBitVect(m, minLength=self.minPathLen,
+                                                        maxLength=self.maxPathLen, nBits=self.nbits)
 
 
 AtomPair()
 
-class AtomPairCounts(DescriptorGenerator):
+class AtomPairCounts(FingerprintGenerator):
     """Computes AtomPairs bitvector counts"""
     NAME = "AtomPairCounts"
+    COUNTS = True
     def __init__(self, minPathLen=1, maxPathLen=30, nbits=2048):
         if minPathLen != 1 or maxPathLen != 30 or nbits != 2048:
             self.NAME = self.NAME + ("%s-%s-%s"%(minPathLen,maxPathLen,nbits))
@@ -226,14 +280,13 @@ class AtomPairCounts(DescriptorGenerator):
         ap = [("AP-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += ap
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return clip_sparse(rd.GetHashedAtomPairFingerprint(m, minLength=self.minPathLen, 
-                                                           maxLength=self.maxPathLen, nBits=self.nbits),
-                           self.nbits)
+    def fingerprint(self, m):
+        return rd.GetHashedAtomPairFingerprint(m, minLength=self.minPathLen,
+                                               maxLength=self.maxPathLen, nBits=self.nbits)
 
 AtomPairCounts()
 
-class RDKitFPBits(DescriptorGenerator):
+class RDKitFPBits(FingerprintGenerator):
     """Computes RDKitFp bitvector"""
     NAME = "RDKitFPBits"
     def __init__(self, minPathLen=1, maxPathLen=7, nbits=2048):
@@ -248,16 +301,15 @@ class RDKitFPBits(DescriptorGenerator):
         ap = [("RDKFP-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += ap
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return clip_sparse(Chem.RDKFingerprint(m, minPath=self.minPathLen, 
-                                          maxPath=self.maxPathLen, fpSize=self.nbits),
-                    self.nbits)
+    def fingerprint(self, m):
+        return Chem.RDKFingerprint(m, minPath=self.minPathLen,
+                                   maxPath=self.maxPathLen, fpSize=self.nbits)
 
 
 RDKitFPBits()
 
 
-class RDKitFPUnbranched(DescriptorGenerator):
+class RDKitFPUnbranched(FingerprintGenerator):
     """Computes RDKitFp bitvector"""
     NAME = "RDKitUnbranchedFPBits"
     def __init__(self, minPathLen=1, maxPathLen=7, nbits=2048):
@@ -272,10 +324,9 @@ class RDKitFPUnbranched(DescriptorGenerator):
         ap = [("RDKFP-%d"%d, numpy.uint8) for d in range(nbits)]
         self.columns += ap
 
-    def calculateMol(self, m, smiles, internalParsing=False):
-        return clip_sparse(Chem.RDKFingerprint(m, minPath=self.minPathLen, branchedPaths=False,
-                                          maxPath=self.maxPathLen, fpSize=self.nbits),
-                    self.nbits)
+    def fingerprint(self, m):
+        return Chem.RDKFingerprint(m, minPath=self.minPathLen, branchedPaths=False,
+                                   maxPath=self.maxPathLen, fpSize=self.nbits)
 
 
 RDKitFPUnbranched()
@@ -359,9 +410,11 @@ class RDKit2D(DescriptorGenerator):
                 raise ValueError("%s: Failed to initialize: unable to find specified properties:\n\t%s"%(
                     self.__class__.__name__,
                     "\n\t".join(failed)))
+        # shared intermediates (EState, charges, Crippen, VSA, QED) are computed once per molecule
+        self.fused = fusedDescriptors.FusedDescriptors([name for name, _ in self.columns])
         
     def calculateMol(self, m, smiles, internalParsing=False):
-        res = [ applyFunc(name, m) for name, _ in self.columns ]
+        res = self.fused.calculate(m, self.descriptorProfile)
         return res
     
 
@@ -30,26 +30,47 @@
 #
 from . import rdDescriptors
 from . import dists
+from . import cdfTables
 from collections import namedtuple
-import scipy.stats as st
+from rdkit import Chem
 import numpy as np
 import logging
+import hashlib
+import time
+import os
+
+# a table of empirical cdfs (see corpusDistributions) used instead of
+#  dists.dists, inherited by worker processes through the environment
+NORMALIZATION_ENV = "RDKIT2D_NORMALIZATION"
 
 cdfs = {}
+# the table files the cdfs were loaded from, part of the cache namespace
+cdfFiles = []
 
-for name, (dist, params, minV,maxV,avg,std) in dists.dists.items():
-    arg = params[:-2]
-    loc = params[-2]
-    scale = params[-1]
+def useNormalization(path=None):
+    """Normalizes with the cdf tables at path, or only the dists.dists cdfs with None
 
-    dist = getattr(st, dist)
-    
-    # make the cdf with the parameters
-    def cdf(v, dist=dist, arg=arg,loc=loc,scale=scale,minV=minV,maxV=maxV):
-        v = dist.cdf(np.clip(v, minV, maxV), loc=loc, scale=scale, *arg)
-        return np.clip(v, 0., 1.)
-    
-    cdfs[name] = cdf
+    Descriptors without a table in path keep their dists.dists cdf.  The
+    interpolation tables written by cdfTables.buildCdfTables are used for
+    those when present, the scipy cdfs (which import scipy.stats lazily)
+    otherwise.
+    """
+    cdfs.clear()
+    del cdfFiles[:]
+    if os.path.exists(cdfTables.CDF_TABLES):
+        cdfs.update(cdfTables.loadCdfTables())
+        cdfFiles.append(cdfTables.CDF_TABLES)
+    if path is not None:
+        cdfs.update(cdfTables.loadCdfTables(path))
+        cdfFiles.append(path)
+        os.environ[NORMALIZATION_ENV] = path
+    else:
+        os.environ.pop(NORMALIZATION_ENV, None)
+    missing = [name for name in dists.dists if name not in cdfs]
+    if missing:
+        cdfs.update(cdfTables.scipyCdfs(missing))
+
+useNormalization(os.environ.get(NORMALIZATION_ENV))
 
 for name in rdDescriptors.FUNCS:
     if name not in cdfs:
@@ -64,11 +85,153 @@ def applyNormalizedFunc(name, m):
         logging.exception("Could not compute %s for molecule", name)
         return 0.0
 
+def normalizeValue(name, v, profile=None):
+    """applyNormalizedFunc for an already computed value v, recorded in profile when given"""
+    if name not in cdfs:
+        return 0.0
+    if profile is None:
+        try:
+            return cdfs[name](v)
+        except:
+            logging.exception("Could not compute %s for molecule", name)
+            return 0.0
+    start = time.perf_counter()
+    try:
+        res = cdfs[name](v)
+        failed = False
+    except:
+        logging.exception("Could not compute %s for molecule", name)
+        res = 0.0
+        failed = True
+    profile.record("cdf", name, time.perf_counter() - start, failures=failed)
+    return res
+
+def applyNormalizedFuncs(names, raw, failed=None, out=None, profile=None):
+    """(n_mols, n_descriptors) raw values -> normalized values
+
+    Applies each column's clip and cdf in one vectorized call.  Columns
+    without a normalization and values that failed to compute (failed[i,j])
+    are set to 0.0, as in applyNormalizedFunc.  The values are written to
+    out when given.  With a DescriptorProfile every cdf call is recorded,
+    counting one call per normalized value.
+    """
+    if out is None:
+        res = np.zeros(raw.shape, dtype=np.float64)
+    else:
+        res = out
+        res[:] = 0.
+    if failed is None:
+        failed = np.zeros(raw.shape, dtype=bool)
+    for j, name in enumerate(names):
+        if name not in cdfs:
+            continue
+        ok = ~failed[:, j]
+        start = time.perf_counter()
+        n_failed = 0
+        try:
+            res[ok, j] = cdfs[name](raw[ok, j])
+        except:
+            # fall back to one value at a time so only the failing ones are zeroed
+            for i in np.where(ok)[0]:
+                try:
+                    res[i, j] = cdfs[name](raw[i, j])
+                except:
+                    logging.exception("Could not compute %s for molecule", name)
+                    n_failed += 1
+        if profile is not None:
+            profile.record("cdf", name, time.perf_counter() - start, calls=int(ok.sum()), failures=n_failed)
+    return res
+
 class RDKit2DNormalized(rdDescriptors.RDKit2D):
     NAME = "RDKit2DNormalized"
 
+    def cacheNamespace(self):
+        # normalized values also depend on the cdf tables in use
+        spec = rdDescriptors.RDKit2D.cacheNamespace(self)
+        for path in cdfFiles:
+            with open(path, 'rb') as f:
+                spec += hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+        return "%s-%s" % (self.NAME, hashlib.blake2b(spec.encode(), digest_size=8).hexdigest())
+
     def calculateMol(self, m, smiles, internalParsing=False):
-        res = [ applyNormalizedFunc(name, m) for name, _ in self.columns ]
+        profile = self.descriptorProfile
+        res = [ normalizeValue(name, v, profile) for (name, _), v in zip(self.columns, self.fused.calculate(m, profile)) ]
         return res   
+
+    def calculateMols(self, mols, out=None):
+        """mols -> (n_mols, n_columns) normalized descriptor matrix, written to out when given"""
+        names = [name for name, _ in self.columns]
+        raw = np.zeros((len(mols), len(names)), dtype=np.float64)
+        failed = np.zeros(raw.shape, dtype=bool)
+        profile = self.descriptorProfile
+        for i, m in enumerate(mols):
+            for j, v in enumerate(self.fused.calculate(m, profile)):
+                if v is None:
+                    failed[i, j] = True
+                else:
+                    raw[i, j] = v
+        return applyNormalizedFuncs(names, raw, failed, out, profile)
+
+    def processMolsInto(self, mols, smiles, values=None, valid=None, internalParsing=False,
+                        n_jobs=1, chunk_size=1000):
+        """Columnar processMols normalizing all molecules (of a chunk) at once
+
+        Same values as processMolInto for every molecule; normalized
+        descriptors never fail, so valid is always True.
+        """
+        if n_jobs > 1:
+            return self.parallelMolsInto(mols, smiles, values, valid, internalParsing, n_jobs, chunk_size)
+        if len(mols) != len(smiles):
+            raise ValueError("Number of molecules does not match number of unparsed molecules")
+        if values is None:
+            values = np.zeros((len(mols), len(self.columns)), dtype=np.float64)
+        if valid is None:
+            valid = np.zeros(len(mols), dtype=bool)
+        valid[:] = True
+        cache = self.descriptorCache
+        todo = list(range(len(mols)))
+        if cache is not None:
+            keys = [Chem.MolToSmiles(m) for m in mols]
+            todo = [i for i, key in enumerate(keys) if cache.getInto(key, values[i]) is None]
+        todo_mols = [mols[i] for i in todo]
+        if not internalParsing:
+            todo_mols = [self.molFromMol(m) for m in todo_mols]
+        if len(todo) == len(mols):
+            self.calculateMols(todo_mols, out=values)
+        else:
+            values[todo] = self.calculateMols(todo_mols)
+        if cache is not None:
+            for i in todo:
+                cache.putRow(keys[i], True, values[i])
+        return values, valid
+
+    def processMols(self, mols, smiles, internalParsing=False, n_jobs=1, chunk_size=1000):
+        """mols, smiles -> results, normalizing all molecules at once
+
+        Same values as processMol for every molecule; normalized descriptors
+        never fail, so the leading "calculated" flag is always True.
+        """
+        values, valid = self.processMolsInto(mols, smiles, internalParsing=internalParsing,
+                                             n_jobs=n_jobs, chunk_size=chunk_size)
+        return [[True] + list(row) for row in values]
+
+    def process_many(self, smiles):
+        """smiles strings -> descriptors, batched version of process
+
+        returns None for invalid smiles strings
+        """
+        mols = []
+        for smile in smiles:
+            try:
+                mols.append(self.molFromSmiles(smile))
+            except:
+                mols.append(None)
+        indices = [i for i, m in enumerate(mols) if m is not None]
+        results = [None] * len(smiles)
+        for i, res in zip(indices, self.processMols([mols[i] for i in indices],
+                                                    [smiles[i] for i in indices],
+                                                    internalParsing=True)):
+            results[i] = res
+        return results
     
 RDKit2DNormalized()
\ No newline at end of file
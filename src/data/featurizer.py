@@ -77,14 +77,22 @@ class Vocab(object):
         return self.index([atom_type1, bond_type, atom_type2])
 
 def smiles_to_graph(smiles, vocab, max_length=5, n_virtual_nodes=8, add_self_loop=True):
-    d_atom_feats = 137
-    d_bond_feats = 14
+    # smiles may also be a Mol.ToBinary blob of an already canonicalized molecule (see mol_binary.py)
+    if isinstance(smiles, bytes):
+        if len(smiles) == 0:
+            return None
+        return mol_to_graph(Chem.Mol(smiles), vocab, max_length, n_virtual_nodes, add_self_loop)
     # Canonicalize
     mol = Chem.MolFromSmiles(smiles)
     if mol is None:
         return None
-    new_order = Chem.rdmolfiles.CanonicalRankAtoms(mol)
-    mol = Chem.rdmolops.RenumberAtoms(mol, new_order)
+    return mol_to_graph(canonicalize_mol(mol), vocab, max_length, n_virtual_nodes, add_self_loop)
+
+
+def mol_to_graph(mol, vocab, max_length=5, n_virtual_nodes=8, add_self_loop=True):
+    # mol must already be canonicalized with canonicalize_mol
+    d_atom_feats = 137
+    d_bond_feats = 14
     # Featurize Atoms
     n_atoms = mol.GetNumAtoms()
     atom_features = []
@@ -202,15 +210,21 @@ def smiles_to_graph(smiles, vocab, max_length=5, n_virtual_nodes=8, add_self_loo
     return [edges, atom_pairs_features_in_triplets, bond_features_in_triplets, triplet_labels, virtual_atom_and_virtual_node_labels, paths, line_graph_path_labels, mol_graph_path_labels, virtual_path_labels, self_loop_labels]
 
 
+def canonicalize_mol(mol):
+    new_order = Chem.rdmolfiles.CanonicalRankAtoms(mol)
+    return Chem.rdmolops.RenumberAtoms(mol, new_order)
+
 def smiles_to_graph_tune(smiles, max_length=5, n_virtual_nodes=8, add_self_loop=True):
-    d_atom_feats = 137
-    d_bond_feats = 14
     # Canonicalize
     mol = Chem.MolFromSmiles(smiles)
     if mol is None:
         return None
-    new_order = Chem.rdmolfiles.CanonicalRankAtoms(mol)
-    mol = Chem.rdmolops.RenumberAtoms(mol, new_order)
+    return mol_to_graph_tune(canonicalize_mol(mol), max_length, n_virtual_nodes, add_self_loop)
+
+def mol_to_graph_tune(mol, max_length=5, n_virtual_nodes=8, add_self_loop=True):
+    # mol must already be canonicalized with canonicalize_mol
+    d_atom_feats = 137
+    d_bond_feats = 14
     # Featurize Atoms
     n_atoms = mol.GetNumAtoms()
     atom_features = []
@@ -5,7 +5,8 @@ import numpy as np
 from dgl.data.utils import load_graphs
 import torch
 import dgl.backend as F
-import scipy.sparse as sps
+
+from .fingerprint import load_fingerprints
 
 
 SPLIT_TO_ID = {'train':0, 'val':1, 'test':2}
@@ -15,6 +16,7 @@ class MoleculeDataset(Dataset):
         self.cache_path = os.path.join(root_path, f"{dataset}/{dataset}_{path_length}.pkl")
         split_path = os.path.join(root_path, f"{dataset}/splits/{split_name}.npy")
         ecfp_path = os.path.join(root_path, f"{dataset}/rdkfp1-7_512.npz")
+        packed_ecfp_path = os.path.join(root_path, f"{dataset}/rdkfp1-7_512_packed.npy")
         md_path = os.path.join(root_path, f"{dataset}/molecular_descriptors.npz")
         # Load Data
         df = pd.read_csv(dataset_path)
@@ -22,7 +24,7 @@ class MoleculeDataset(Dataset):
             use_idxs = np.load(split_path, allow_pickle=True)[SPLIT_TO_ID[split]]
         else: 
             use_idxs = np.arange(0, len(df))
-        fps = torch.from_numpy(sps.load_npz(ecfp_path).todense().astype(np.float32))
+        fps = torch.from_numpy(load_fingerprints(ecfp_path, packed_ecfp_path))
         mds = np.load(md_path)['md'].astype(np.float32)
         mds = torch.from_numpy(np.where(np.isnan(mds), 0, mds))
         self.df, self.fps, self.mds = df.iloc[use_idxs], fps[use_idxs], mds[use_idxs]
@@ -56,6 +58,10 @@ class MoleculeDataset(Dataset):
     def __getitem__(self, idx):
         return self.smiless[idx], self.graphs[idx], self.fps[idx], self.mds[idx], self.labels[idx]
 
+    def graph_sizes(self):
+        # (n_nodes, n_edges) of every cached graph, used as batching costs
+        return np.array([[g.num_nodes(), g.num_edges()] for g in self.graphs], dtype=np.int64)
+
     def task_pos_weights(self):
         task_pos_weights = torch.ones(self.labels.shape[1])
         num_pos = torch.sum(torch.nan_to_num(self.labels,nan=0), axis=0)
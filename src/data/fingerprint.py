@@ -0,0 +1,100 @@
+import os
+import numpy as np
+from functools import partial
+from rdkit import Chem, DataStructs
+from scipy import sparse as sp
+
+
+# np.packbits puts bit 0 of a byte first (most significant), RDKit's FPS text last
+_REVERSE_BITS = np.array([int(f'{i:08b}'[::-1], 2) for i in range(256)], dtype=np.uint8)
+
+
+def pack_into(fps, out):
+    # bit vectors -> rows of the uint8 matrix out, in np.packbits order
+    text = ''.join(DataStructs.BitVectToFPSText(fp) for fp in fps)
+    out[:] = _REVERSE_BITS[np.frombuffer(bytes.fromhex(text), dtype=np.uint8).reshape(len(fps), -1)]
+
+
+def bits_into(fps, out):
+    # bit vectors -> 0/1 rows of out, which may have any numeric dtype
+    for fp, row in zip(fps, out):
+        DataStructs.ConvertToNumpyArray(fp, row)
+
+
+def counts_into(fps, out, clip=255):
+    # sparse count vectors -> rows of out, counts clipped to clip
+    out[:] = 0
+    rows, cols, counts = [], [], []
+    for i, fp in enumerate(fps):
+        nonzero = fp.GetNonzeroElements()
+        rows.extend([i] * len(nonzero))
+        cols.extend(nonzero.keys())
+        counts.extend(nonzero.values())
+    if rows:
+        out[rows, cols] = np.minimum(counts, clip)
+
+
+FINGERPRINT_WRITERS = {'packed': pack_into, 'bits': bits_into, 'counts': counts_into}
+
+
+def fingerprint_width(fp_size, layout='packed'):
+    # number of columns of a fingerprint matrix
+    return fp_size // 8 if layout == 'packed' else fp_size
+
+
+def fingerprints_into(mols, fp_func, out, layout='packed', batch_size=1024):
+    """Write fp_func(mol) of every molecule into the rows of the preallocated matrix out.
+
+    layout is 'packed' (uint8 rows of fp_size/8 bytes in np.packbits order, fp_size a multiple of 8),
+    'bits' (0/1 rows) or 'counts' (sparse count vectors, clipped to 255); rows of None molecules are
+    zeros. Fingerprints are converted batch_size molecules at a time with RDKit's bulk conversions.
+    """
+    write = FINGERPRINT_WRITERS[layout]
+    valid = [i for i, mol in enumerate(mols) if mol is not None]
+    if len(valid) < len(mols):
+        out[[i for i, mol in enumerate(mols) if mol is None]] = 0
+    for start in range(0, len(valid), batch_size):
+        ids = valid[start:start+batch_size]
+        fps = [fp_func(mols[i]) for i in ids]
+        if ids[-1] - ids[0] == len(ids) - 1:
+            write(fps, out[ids[0]:ids[-1]+1])
+        else:
+            rows = np.empty((len(ids),) + out.shape[1:], dtype=out.dtype)
+            write(fps, rows)
+            out[ids] = rows
+    return out
+
+
+def rdkfp(mol, min_path=1, max_path=7, fp_size=512):
+    return Chem.RDKFingerprint(mol, minPath=min_path, maxPath=max_path, fpSize=fp_size)
+
+
+def rdkfp_packed_mols(mols, min_path=1, max_path=7, fp_size=512, out=None):
+    # (n_mols, fp_size/8) bit-packed RDKit fingerprints, written to out when given
+    if out is None:
+        out = np.empty((len(mols), fp_size // 8), dtype=np.uint8)
+    return fingerprints_into(mols, partial(rdkfp, min_path=min_path, max_path=max_path, fp_size=fp_size), out)
+
+
+def rdkfp_packed(smiles, min_path=1, max_path=7, fp_size=512):
+    return rdkfp_packed_mols([Chem.MolFromSmiles(smiles)], min_path, max_path, fp_size)[0]
+
+
+def packed_to_npz(packed_path, npz_path, chunk_size=100000):
+    # convert a packed fingerprint memmap to the sparse rdkfp1-7_512.npz format, one chunk at a time
+    packed = np.load(packed_path, mmap_mode='r')
+    blocks = []
+    for start in range(0, len(packed), chunk_size):
+        blocks.append(sp.csr_matrix(np.unpackbits(packed[start:start+chunk_size], axis=1)))
+    sp.save_npz(npz_path, sp.vstack(blocks, format='csc'))
+
+
+def load_fingerprints(npz_path, packed_path=None):
+    # dense float32 fingerprint matrix, read from the packed memmap when it is available
+    if packed_path is not None and os.path.exists(packed_path):
+        packed = np.load(packed_path, mmap_mode='r')
+        fps = np.empty((len(packed), packed.shape[1] * 8), dtype=np.float32)
+        for start in range(0, len(packed), 100000):
+            fps[start:start+100000] = np.unpackbits(packed[start:start+100000], axis=1)
+        return fps
+    return np.asarray(sp.load_npz(npz_path).todense()).astype(np.float32)
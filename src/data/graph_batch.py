@@ -0,0 +1,35 @@
+from typing import NamedTuple
+import torch
+
+
+class GraphBatch(NamedTuple):
+    """A batch of triplet graphs as plain tensors, the input of the scatter backend of LiGhT
+
+    Edges are (source, destination) columns of edge_index.  The nodes of
+    graph i are node_ptr[i]:node_ptr[i+1] and node_graph is the graph of
+    every node.  The remaining fields are the node data (begin_end, edge,
+    vavn) and edge data (path, vp, sl) of the DGL graphs built by the
+    featurizer, with the batch offsets of Collator_tune already added to path.
+    """
+    edge_index: torch.Tensor
+    node_ptr: torch.Tensor
+    node_graph: torch.Tensor
+    begin_end: torch.Tensor
+    edge: torch.Tensor
+    vavn: torch.Tensor
+    path: torch.Tensor
+    vp: torch.Tensor
+    sl: torch.Tensor
+
+    @classmethod
+    def from_dgl(cls, g):
+        src, dst = g.edges()
+        n_nodes = g.batch_num_nodes()
+        node_ptr = torch.cat([n_nodes.new_zeros(1), torch.cumsum(n_nodes, dim=0)])
+        node_graph = torch.repeat_interleave(torch.arange(len(n_nodes), device=n_nodes.device), n_nodes)
+        return cls(torch.stack([src, dst]), node_ptr, node_graph,
+                   g.ndata['begin_end'], g.ndata['edge'], g.ndata['vavn'],
+                   g.edata['path'], g.edata['vp'], g.edata['sl'])
+
+    def to(self, device):
+        return GraphBatch(*[t.to(device) for t in self])
@@ -0,0 +1,38 @@
+import os
+import numpy as np
+from rdkit import Chem
+
+from .featurizer import canonicalize_mol
+
+
+def mol_binary(smiles):
+    # Mol.ToBinary blob of the canonicalized molecule as a uint8 vector; empty for unparsable smiles
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return np.zeros(0, dtype=np.uint8)
+    # computed and private atom properties (e.g. _ChiralityPossible) are used by the atom featurizer
+    return np.frombuffer(canonicalize_mol(mol).ToBinary(Chem.PropertyPickleOptions.AllProps), dtype=np.uint8)
+
+
+class MolBinaryStore(object):
+    """Read-only, memory-mapped store of canonicalized RDKit molecules.
+
+    data is the concatenation of all Mol.ToBinary blobs and offsets[i]:offsets[i+1] the byte range
+    of molecule i. Items are returned as bytes, which smiles_to_graph accepts in place of a SMILES
+    string; rebuilding a Mol from them skips parsing, sanitization and canonical ranking.
+    """
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def load(cls, root_path):
+        data = np.load(os.path.join(root_path, 'mol_binaries.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(root_path, 'mol_offsets.npy'))
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.data[self.offsets[idx]:self.offsets[idx+1]].tobytes()
@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from functools import partial
+from rdkit import Chem
+
+from .pipeline import load_molecule_chunk, items_digest
+
+
+def mol_key(mol, smiles, kind='smiles'):
+    # 64-bit hash of the canonical SMILES (or InChIKey); unparsable smiles are hashed as written
+    if mol is None:
+        text = 'invalid:' + smiles
+    elif kind == 'smiles':
+        text = Chem.MolToSmiles(mol)
+    elif kind == 'inchikey':
+        text = Chem.MolToInchiKey(mol) or Chem.MolToSmiles(mol)
+    else:
+        raise ValueError('Unknown key kind %s' % kind)
+    return np.frombuffer(hashlib.blake2b(text.encode(), digest_size=8).digest(), dtype=np.uint64)[0]
+
+
+def molecule_key(smiles, kind='smiles'):
+    return mol_key(Chem.MolFromSmiles(smiles), smiles, kind)
+
+
+def molecule_record(smiles, kind='smiles'):
+    # (is valid, molecule key) as a uint64 pair
+    mol = Chem.MolFromSmiles(smiles)
+    return np.array([mol is not None, mol_key(mol, smiles, kind)], dtype=np.uint64)
+
+
+class MoleculeStore(object):
+    """Append-only store of per-molecule preprocessing results keyed by molecule_key.
+
+    The store is a list of segments, each a 'molecules' chunk directory (see pipeline.py) plus the
+    keys.npy of its rows. Updating a dataset only featurizes the keys that are not stored yet and
+    adds them as new segments; dataset artifacts are then gathered from the store row by row.
+    The key and the featurization parameters (e.g. max_length, build_graph and the descriptors
+    namespace of the generator) are kept in meta.json, a store cannot be updated with others.
+    """
+    def __init__(self, path, key='smiles', **params):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta = dict(key=key, **params)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                old_meta = json.load(f)
+            if old_meta != meta:
+                raise ValueError(f'{path} was written with {old_meta}, cannot update it with {meta}')
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        self.key = key
+        self._index = None
+
+    def segment_paths(self):
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.startswith('segment_'))
+
+    def index(self):
+        # (keys, segment id, row within segment) of every stored molecule
+        if self._index is None:
+            keys, segment_ids, rows = [], [], []
+            for i, segment_path in enumerate(self.segment_paths()):
+                segment_keys = np.load(os.path.join(segment_path, 'keys.npy'))
+                keys.append(segment_keys)
+                segment_ids.append(np.full(len(segment_keys), i, dtype=np.int64))
+                rows.append(np.arange(len(segment_keys), dtype=np.int64))
+            if keys:
+                self._index = (np.concatenate(keys), np.concatenate(segment_ids), np.concatenate(rows))
+            else:
+                self._index = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        return self._index
+
+    def __len__(self):
+        return len(self.index()[0])
+
+    def lookup(self, keys):
+        # position of every key in the store index, -1 for keys that are not stored
+        store_keys = self.index()[0]
+        if len(store_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        order = np.argsort(store_keys)
+        sorted_keys = store_keys[order]
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[pos] == keys, order[pos], -1)
+
+    def missing(self, keys):
+        # indices of the first occurrence of every key that still has to be featurized
+        keys = np.asarray(keys, dtype=np.uint64)
+        _, first = np.unique(keys, return_index=True)
+        first = np.sort(first)
+        return first[self.lookup(keys[first]) < 0]
+
+    def append(self, keys, chunk_paths, chunk_size):
+        """Add finished 'molecules' chunks, computed for the given keys in order, as new segments."""
+        start = len(self.segment_paths())
+        for i, chunk_path in enumerate(chunk_paths):
+            segment_path = os.path.join(self.path, f'segment_{start+i:05d}')
+            tmp_path = os.path.join(self.path, f'tmp_{start+i:05d}')
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            shutil.copytree(chunk_path, tmp_path)
+            np.save(os.path.join(tmp_path, 'keys.npy'), np.asarray(keys[i*chunk_size:(i+1)*chunk_size], dtype=np.uint64))
+            os.replace(tmp_path, segment_path)
+        self._index = None
+
+    def gather(self, keys, fp_out_path=None, md_out_path=None):
+        """Collect (graphs, sizes, fps, mds) for keys, in the order given; every key must be stored.
+
+        Segments are read one at a time, so fingerprints and descriptors can be streamed into
+        memmaps when output paths are given.
+        """
+        _, segment_ids, rows = self.index()
+        pos = self.lookup(np.asarray(keys, dtype=np.uint64))
+        if np.any(pos < 0):
+            raise KeyError(f'{int(np.sum(pos < 0))} molecules are missing from {self.path}')
+        n_items = len(pos)
+        key_segments, key_rows = segment_ids[pos], rows[pos]
+        segment_lens = np.bincount(segment_ids)
+        graphs, sizes, fps, mds = [None] * n_items, None, None, None
+        for i, segment_path in enumerate(self.segment_paths()):
+            ids = np.where(key_segments == i)[0]
+            if len(ids) == 0:
+                continue
+            seg_graphs, seg_sizes, seg_fps, seg_mds = load_molecule_chunk(segment_path, int(segment_lens[i]))
+            if sizes is None:
+                sizes = np.empty((n_items,) + seg_sizes.shape[1:], dtype=seg_sizes.dtype)
+                fps = np.empty((n_items,) + seg_fps.shape[1:], dtype=seg_fps.dtype) if fp_out_path is None else \
+                    np.lib.format.open_memmap(fp_out_path, mode='w+', dtype=seg_fps.dtype, shape=(n_items,) + seg_fps.shape[1:])
+                mds = np.empty((n_items,) + seg_mds.shape[1:], dtype=seg_mds.dtype) if md_out_path is None else \
+                    np.lib.format.open_memmap(md_out_path, mode='w+', dtype=seg_mds.dtype, shape=(n_items,) + seg_mds.shape[1:])
+            seg_rows = key_rows[ids]
+            sizes[ids] = seg_sizes[seg_rows]
+            fps[ids] = seg_fps[seg_rows]
+            mds[ids] = seg_mds[seg_rows]
+            for j, row in zip(ids.tolist(), seg_rows.tolist()):
+                graphs[j] = seg_graphs[row]
+        return graphs, sizes, fps, mds
+
+
+def update_store(runner, store, smiless, featurize, stage_prefix='molecules'):
+    """Featurize the molecules of smiless that are not stored yet and add them to store.
+
+    Both the hashing and the featurization run as ChunkedRunner stages named after the content of
+    their inputs, so an interrupted update resumes where it stopped. Returns the keys of smiless.
+    """
+    name = f'keys_{store.key}_{items_digest(smiless)}'
+    runner.run(name, partial(molecule_key, kind=store.key), smiless)
+    keys = runner.merge_arrays(name, len(smiless))
+    new_ids = store.missing(keys)
+    print(f'{len(new_ids)} of {len(smiless)} molecules are not in {store.path}')
+    if len(new_ids):
+        new_smiless = [smiless[i] for i in new_ids]
+        name = f'{stage_prefix}_{items_digest(new_smiless)}'
+        chunk_paths = runner.run(name, featurize, new_smiless, kind='molecules')
+        store.append(keys[new_ids], chunk_paths, runner.chunk_size)
+        runner.mark_merged(name)
+    return keys
+
+
+def deduplicate(runner, smiless, kind='smiles'):
+    """Drop unparsable smiles and all but the first occurrence of every molecule key.
+
+    Returns the indices of the kept rows in smiless, in their original order, and the sorted
+    unique keys of the kept molecules, a compact hash set that can be probed with np.searchsorted.
+    """
+    name = f'records_{kind}_{items_digest(smiless)}'
+    runner.run(name, partial(molecule_record, kind=kind), smiless)
+    records = runner.merge_arrays(name, len(smiless))
+    valid_ids = np.where(records[:, 0] == 1)[0]
+    hash_set, first = np.unique(records[valid_ids, 1], return_index=True)
+    print(f'kept {len(hash_set)} of {len(smiless)} molecules: {len(smiless) - len(valid_ids)} unparsable, '
+          f'{len(valid_ids) - len(hash_set)} duplicates')
+    return np.sort(valid_ids[first]), hash_set
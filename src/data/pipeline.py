@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import torch
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from rdkit import Chem
+from dgl.data.utils import save_graphs, load_graphs
+
+from .featurizer import canonicalize_mol, mol_to_graph_tune
+from .fingerprint import rdkfp_packed_mols
+from .size_index import mol_size
+
+
+def items_digest(items):
+    # short content hash of a molecule list, used to name resumable stages of an update
+    digest = hashlib.blake2b(digest_size=8)
+    for item in items:
+        digest.update(item.encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def func_signature(func):
+    """A json-able description of a stage function that is stable across runs.
+
+    Partials are described by their function, arguments and keywords; descriptor generators by
+    their cacheNamespace (which covers the cdf tables of normalized descriptors), other objects
+    by their type.
+    """
+    if isinstance(func, partial):
+        return [func_signature(func.func), [func_signature(arg) for arg in func.args],
+                {key: func_signature(value) for key, value in sorted(func.keywords.items())}]
+    if isinstance(func, (str, int, float, bool)) or func is None:
+        return func
+    if isinstance(func, (list, tuple)):
+        return [func_signature(value) for value in func]
+    if hasattr(func, 'cacheNamespace'):
+        return func.cacheNamespace()
+    if hasattr(func, '__qualname__'):
+        return f'{func.__module__}.{func.__qualname__}'
+    return f'{type(func).__module__}.{type(func).__qualname__}'
+
+def save_array_chunk(path, results):
+    with open(path, 'wb') as f:
+        np.save(f, np.stack(results))
+
+def save_graph_chunk(path, results):
+    # invalid molecules (None) are skipped; their positions are recovered from 'ids'
+    ids = [i for i, g in enumerate(results) if g is not None]
+    save_graphs(path, [results[i] for i in ids], labels={'ids': torch.LongTensor(ids)})
+
+def load_graph_chunk(path, n_items):
+    graphs, label_dict = load_graphs(path)
+    results = [None] * n_items
+    for i, g in zip(label_dict['ids'].tolist(), graphs):
+        results[i] = g
+    return results
+
+def save_blob_chunk(path, results):
+    # variable-length uint8 results, concatenated with their lengths
+    with open(path, 'wb') as f:
+        np.savez(f, data=np.concatenate(results), lengths=np.array([len(r) for r in results], dtype=np.int64))
+
+def save_molecule_chunk(path, results):
+    # a directory holding the per-molecule arrays and, when graphs were built, the graphs
+    os.makedirs(path)
+    graphs, sizes, fps, mds = zip(*results)
+    np.savez(os.path.join(path, 'arrays.npz'), sizes=np.stack(sizes), fps=np.stack(fps), mds=np.stack(mds))
+    if any(g is not None for g in graphs):
+        save_graph_chunk(os.path.join(path, 'graphs.bin'), graphs)
+
+def load_molecule_chunk(path, n_items):
+    arrays = np.load(os.path.join(path, 'arrays.npz'))
+    graph_path = os.path.join(path, 'graphs.bin')
+    graphs = load_graph_chunk(graph_path, n_items) if os.path.exists(graph_path) else [None] * n_items
+    return graphs, arrays['sizes'], arrays['fps'], arrays['mds']
+
+def descriptor_row(smiles, generator):
+    # descriptor values without the leading "calculated" flag, NaN for unparsable smiles
+    md = np.full(len(generator.columns), np.nan)
+    mol = generator.molFromSmiles(smiles)
+    if mol is not None:
+        generator.processMolInto(mol, smiles, md, internalParsing=True)
+    return md
+
+def featurize_molecule(smiles, generator, max_length=5, n_virtual_nodes=2, build_graph=True, fp_size=512):
+    """Parse smiles once and derive every preprocessing artifact from that Mol.
+
+    Returns (graph, size index row, packed RDKit fingerprint, descriptor row). Fingerprint and
+    descriptors use the parsed Mol, the graph its canonically renumbered copy, exactly as the
+    separate smiles-based stages do.
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    fp = rdkfp_packed_mols([mol], fp_size=fp_size)[0]
+    if mol is None:
+        return None, mol_size(None), fp, np.full(len(generator.columns), np.nan)
+    md = np.empty(len(generator.columns), dtype=np.float64)
+    generator.processMolInto(mol, smiles, md, internalParsing=True)
+    sizes = mol_size(mol, max_length, n_virtual_nodes)
+    graph = mol_to_graph_tune(canonicalize_mol(mol), max_length, n_virtual_nodes) if build_graph else None
+    return graph, sizes, fp, md
+
+
+STAGE_WRITERS = {
+    'array': ('.npy', save_array_chunk),
+    'graphs': ('.bin', save_graph_chunk),
+    'molecules': ('', save_molecule_chunk),
+    'blobs': ('.npz', save_blob_chunk),
+}
+
+
+class ChunkedRunner(object):
+    """Run preprocessing stages over a molecule list in fixed-size, checkpointed chunks.
+
+    Every finished chunk of a stage is written to work_dir/<stage>/ before the next one starts, so
+    an interrupted run resumes at the first missing chunk. A stage only resumes with the same items
+    (by content digest), chunk size and function (see func_signature). cleanup() deletes the
+    stages merged so far. All stages share one worker pool, which is closed when the runner is used
+    as a context manager and exits.
+
+    backend 'process' runs the stages in n_jobs worker processes, 'thread' in n_jobs threads of
+    this process, which share the descriptor generator (compiled patterns, cdf tables, caches)
+    instead of unpickling it per task batch and need no result pickling, but only overlap where
+    RDKit releases the GIL. Both give identical results; see scripts/benchmark_preprocess_backends.py.
+    """
+    BACKENDS = {'process': Pool, 'thread': ThreadPool}
+
+    def __init__(self, work_dir, n_jobs=32, chunk_size=100000, imap_chunksize=None, backend='process'):
+        if backend not in self.BACKENDS:
+            raise ValueError(f'unknown backend {backend}, choose from {", ".join(self.BACKENDS)}')
+        self.work_dir = work_dir
+        self.backend = backend
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        # large enough to amortize IPC, small enough to keep every worker busy until the chunk ends
+        self.imap_chunksize = imap_chunksize or max(1, chunk_size // (n_jobs * 16))
+        self.pool = None
+        self.throughput = {}
+        self.merged = []
+
+    def __enter__(self):
+        self.pool = self.BACKENDS[self.backend](self.n_jobs)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.pool.close()
+        else:
+            self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def _stage_dir(self, name, items, func):
+        stage_dir = os.path.join(self.work_dir, name)
+        os.makedirs(stage_dir, exist_ok=True)
+        meta = {'n_items': len(items), 'chunk_size': self.chunk_size, 'items': items_digest(items),
+                'func': func_signature(func)}
+        meta_path = os.path.join(stage_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                old_meta = json.load(f)
+            if old_meta != meta:
+                raise ValueError(f'{stage_dir} was written with {old_meta}, cannot resume with {meta}, '
+                                 f'remove it to start the stage over')
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        return stage_dir
+
+    def chunk_paths(self, name, n_items, kind='array'):
+        ext = STAGE_WRITERS[kind][0]
+        n_chunks = -(-n_items // self.chunk_size)
+        return [os.path.join(self.work_dir, name, f'chunk_{i:05d}{ext}') for i in range(n_chunks)]
+
+    def run(self, name, func, items, kind='array'):
+        """Apply func to every item, skipping chunks already on disk. Returns the chunk paths."""
+        stage_dir = self._stage_dir(name, items, func)
+        save_chunk = STAGE_WRITERS[kind][1]
+        chunk_paths = self.chunk_paths(name, len(items), kind)
+        n_done, elapsed = 0, 0.
+        for i, chunk_path in enumerate(chunk_paths):
+            if os.path.exists(chunk_path):
+                continue
+            start_time = time.time()
+            chunk = items[i*self.chunk_size:(i+1)*self.chunk_size]
+            results = list(self.pool.imap(func, chunk, chunksize=self.imap_chunksize))
+            tmp_path = os.path.join(stage_dir, f'tmp_{i:05d}')
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            save_chunk(tmp_path, results)
+            os.replace(tmp_path, chunk_path)
+            chunk_time = time.time() - start_time
+            n_done += len(chunk)
+            elapsed += chunk_time
+            print(f'[{name}] chunk {i+1}/{len(chunk_paths)}: {len(chunk)/chunk_time:.1f} mol/s')
+        if n_done:
+            self.throughput[name] = n_done / elapsed
+        return chunk_paths
+
+    def mark_merged(self, name):
+        # the chunks of stage name were copied or merged elsewhere, cleanup() may delete them
+        if name not in self.merged:
+            self.merged.append(name)
+
+    def cleanup(self):
+        """Delete the chunk directories of all stages merged so far"""
+        for name in self.merged:
+            shutil.rmtree(os.path.join(self.work_dir, name), ignore_errors=True)
+        self.merged = []
+
+    def merge_arrays(self, name, n_items, out_path=None):
+        # concatenate array chunks into one (memmapped, if out_path is given) array without loading them all
+        chunk_paths = self.chunk_paths(name, n_items)
+        first = np.load(chunk_paths[0], mmap_mode='r')
+        shape = (n_items,) + first.shape[1:]
+        if out_path is None:
+            merged = np.empty(shape, dtype=first.dtype)
+        else:
+            merged = np.lib.format.open_memmap(out_path, mode='w+', dtype=first.dtype, shape=shape)
+        start = 0
+        for chunk_path in chunk_paths:
+            chunk = np.load(chunk_path, mmap_mode='r')
+            merged[start:start+len(chunk)] = chunk
+            start += len(chunk)
+        self.mark_merged(name)
+        return merged
+
+    def merge_graphs(self, name, n_items):
+        results = []
+        for i, chunk_path in enumerate(self.chunk_paths(name, n_items, kind='graphs')):
+            results.extend(load_graph_chunk(chunk_path, min(self.chunk_size, n_items - i*self.chunk_size)))
+        self.mark_merged(name)
+        return results
+
+    def merge_blobs(self, name, n_items, data_path, offsets_path):
+        # concatenate blob chunks into one uint8 .npy memmap plus the (n_items + 1,) int64 offsets into it
+        chunk_paths = self.chunk_paths(name, n_items, kind='blobs')
+        lengths = np.concatenate([np.load(chunk_path)['lengths'] for chunk_path in chunk_paths])
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        data = np.lib.format.open_memmap(data_path, mode='w+', dtype=np.uint8, shape=(int(offsets[-1]),))
+        start = 0
+        for chunk_path in chunk_paths:
+            chunk = np.load(chunk_path)['data']
+            data[start:start+len(chunk)] = chunk
+            start += len(chunk)
+        data.flush()
+        np.save(offsets_path, offsets)
+        self.mark_merged(name)
+        return data, offsets
+
+    def merge_molecules(self, name, n_items, fp_out_path=None, md_out_path=None):
+        """Concatenate 'molecules' chunks into (graphs, sizes, fps, mds).
+
+        Graphs are kept in memory; fingerprints and descriptors are streamed into memmaps when
+        output paths are given.
+        """
+        chunk_paths = self.chunk_paths(name, n_items, kind='molecules')
+        chunk_lens = [min(self.chunk_size, n_items - i*self.chunk_size) for i in range(len(chunk_paths))]
+        graphs, sizes, fps, mds = [], [], None, None
+        start = 0
+        for chunk_path, chunk_len in zip(chunk_paths, chunk_lens):
+            chunk_graphs, chunk_sizes, chunk_fps, chunk_mds = load_molecule_chunk(chunk_path, chunk_len)
+            if fps is None:
+                fps = np.empty((n_items,) + chunk_fps.shape[1:], dtype=chunk_fps.dtype) if fp_out_path is None else \
+                    np.lib.format.open_memmap(fp_out_path, mode='w+', dtype=chunk_fps.dtype, shape=(n_items,) + chunk_fps.shape[1:])
+                mds = np.empty((n_items,) + chunk_mds.shape[1:], dtype=chunk_mds.dtype) if md_out_path is None else \
+                    np.lib.format.open_memmap(md_out_path, mode='w+', dtype=chunk_mds.dtype, shape=(n_items,) + chunk_mds.shape[1:])
+            graphs.extend(chunk_graphs)
+            sizes.append(chunk_sizes)
+            fps[start:start+chunk_len] = chunk_fps
+            mds[start:start+chunk_len] = chunk_mds
+            start += chunk_len
+        self.mark_merged(name)
+        return graphs, np.concatenate(sizes), fps, mds
+
+    def report(self):
+        for name, rate in self.throughput.items():
+            print(f'[{name}] {rate:.1f} mol/s')
@@ -1,13 +1,16 @@
 from torch.utils.data import Dataset
 import os
 import numpy as np
-import scipy.sparse as sps
 import torch
 import dgl.backend as F
 
+from .size_index import SizeIndex, build_size_index
+from .fingerprint import load_fingerprints
+from .mol_binary import MolBinaryStore
+
 
 class MoleculeDataset(Dataset):
-    def __init__(self, root_path):
+    def __init__(self, root_path, use_mol_binaries=False):
         self.root_path = root_path
         if 'pubchem' in root_path:
             smiles_path = os.path.join(root_path, "pubchem-10m-clean.txt")
@@ -19,11 +22,14 @@ class MoleculeDataset(Dataset):
             raise ValueError('Unknown Pretraining dataset!')
 
         fp_path = os.path.join(root_path, "rdkfp1-7_512.npz")
+        packed_fp_path = os.path.join(root_path, "rdkfp1-7_512_packed.npy")
         md_path = os.path.join(root_path, "molecular_descriptors.npz")
         with open(smiles_path, 'r') as f:
             lines = f.readlines()
             self.smiles_list = [line.strip('\n') for line in lines]
-        self.fps = torch.from_numpy(sps.load_npz(fp_path).todense().astype(np.float32))
+        # molecule binaries written by preprocess_pretrain_dataset.py --mol_binaries replace the smiles fed to the collator
+        self.mol_binaries = MolBinaryStore.load(root_path) if use_mol_binaries else None
+        self.fps = torch.from_numpy(load_fingerprints(fp_path, packed_fp_path))
         mds = np.load(md_path)['md'].astype(np.float32)
         mds = np.where(np.isnan(mds), 0, mds)
         self.mds = torch.from_numpy(mds)
@@ -35,8 +41,26 @@ class MoleculeDataset(Dataset):
         return len(self.smiles_list)
     
     def __getitem__(self, idx):
+        if self.mol_binaries is not None:
+            return self.mol_binaries[idx], self.fps[idx], self.mds[idx]
         return self.smiles_list[idx], self.fps[idx], self.mds[idx]
 
+    def size_index(self, max_length=5, n_virtual_nodes=2, n_jobs=32):
+        # written by preprocess_pretrain_dataset.py; built and cached here for older datasets
+        index_path = os.path.join(self.root_path, f"size_index_{max_length}.npz")
+        if os.path.exists(index_path):
+            size_index = SizeIndex.load(index_path)
+            if size_index.n_virtual_nodes == n_virtual_nodes and len(size_index) == len(self.smiles_list):
+                return size_index
+        size_index = SizeIndex(build_size_index(self.smiles_list, max_length, n_virtual_nodes, n_jobs), max_length, n_virtual_nodes)
+        size_index.save(index_path)
+        return size_index
+
+    def graph_sizes(self, max_length=5, n_virtual_nodes=2, n_jobs=32):
+        # (n_nodes, n_edges) of the graph built for every molecule
+        size_index = self.size_index(max_length, n_virtual_nodes, n_jobs)
+        return np.stack([size_index['n_nodes'], size_index['n_edges']], axis=1).astype(np.int64)
+
     def task_pos_weights(self):
         task_pos_weights = torch.ones(self.fps.shape[1])
         num_pos = torch.sum(torch.nan_to_num(self.fps,nan=0), axis=0)
@@ -0,0 +1,154 @@
+import math
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class CostAwareBatchSampler(Sampler):
+    """Group molecules into batches whose total cost (triplet nodes or path edges) stays under max_cost.
+
+    Indices are shuffled per epoch, sorted by cost inside buckets of bucket_size molecules so that
+    molecules of similar size are packed together, and the resulting batches are shuffled again.
+    Under DDP every rank receives the same number of batches; the global batch list is split
+    round-robin across ranks, padding (or dropping, with drop_last) the tail.
+    """
+    def __init__(self, costs, max_cost, max_batch_size=None, shuffle=True, drop_last=False,
+                 num_replicas=None, rank=None, seed=0, bucket_size=4096):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.costs = np.asarray(costs, dtype=np.int64)
+        self.max_cost = max_cost
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        self._cache = None
+        n_oversized = int(np.sum(self.costs > max_cost))
+        if n_oversized:
+            print(f'{n_oversized} molecules exceed max_cost={max_cost} and will be put in singleton batches')
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _build_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.costs)) if self.shuffle else np.arange(len(self.costs))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start+self.bucket_size]
+            if self.shuffle:
+                bucket = bucket[np.argsort(self.costs[bucket], kind='stable')]
+            batch, batch_cost = [], 0
+            for idx in bucket.tolist():
+                cost = self.costs[idx]
+                if batch and (batch_cost + cost > self.max_cost or len(batch) == self.max_batch_size):
+                    batches.append(batch)
+                    batch, batch_cost = [], 0
+                batch.append(idx)
+                batch_cost += cost
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # every rank must see the same number of batches
+        if self.drop_last:
+            n_per_rank = len(batches) // self.num_replicas
+        else:
+            n_per_rank = math.ceil(len(batches) / self.num_replicas)
+            n_pad = n_per_rank * self.num_replicas - len(batches)
+            batches = batches + [batches[i % len(batches)] for i in range(n_pad)]
+        batches = batches[:n_per_rank * self.num_replicas]
+        return batches[self.rank::self.num_replicas]
+
+    def _batches(self):
+        if self._cache is None or self._cache[0] != self.epoch:
+            self._cache = (self.epoch, self._build_batches())
+        return self._cache[1]
+
+    @property
+    def avg_batch_size(self):
+        # mean number of molecules per batch, used to normalize per-batch losses in the trainers
+        batches = self._batches()
+        return sum(len(batch) for batch in batches) / max(len(batches), 1)
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
+
+
+class EdgeBalancedDistributedSampler(Sampler):
+    """Drop-in replacement for DistributedSampler that balances per-step cost across ranks.
+
+    Every epoch the indices are shuffled and cut into steps of batch_size*num_replicas molecules.
+    Inside a step molecules are sorted by cost and dealt to ranks in snake order
+    (0..R-1, R-1..0, ...), so each rank gets exactly batch_size molecules with a near-equal
+    total cost. Use it with DataLoader(batch_size=batch_size, drop_last=True).
+    """
+    def __init__(self, costs, batch_size, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=True):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.costs = np.asarray(costs, dtype=np.int64)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        step_size = batch_size * num_replicas
+        if drop_last:
+            self.n_steps = len(self.costs) // step_size
+        else:
+            self.n_steps = math.ceil(len(self.costs) / step_size)
+        # rank owning each position of a cost-sorted step
+        positions = np.arange(step_size)
+        rounds, offsets = positions // num_replicas, positions % num_replicas
+        self._snake = np.where(rounds % 2 == 0, offsets, num_replicas - 1 - offsets)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shuffled_steps(self):
+        # (n_steps, batch_size*num_replicas) indices of the molecules used at every step
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.costs)) if self.shuffle else np.arange(len(self.costs))
+        n_total = self.n_steps * self.batch_size * self.num_replicas
+        if n_total > len(indices):
+            indices = np.concatenate([indices, indices[:n_total - len(indices)]])
+        return indices[:n_total].reshape(self.n_steps, -1)
+
+    def _sort_steps(self, steps):
+        order = np.argsort(-self.costs[steps], axis=1, kind='stable')
+        return np.take_along_axis(steps, order, axis=1)
+
+    def __iter__(self):
+        steps = self._sort_steps(self._shuffled_steps())
+        return iter(steps[:, self._snake == self.rank].reshape(-1).tolist())
+
+    def __len__(self):
+        return self.n_steps * self.batch_size
+
+    def balance_report(self):
+        """Per-step max/mean rank cost for this epoch, balanced vs. a count-only split of the same steps."""
+        steps = self._shuffled_steps()
+        sorted_costs = self.costs[self._sort_steps(steps)]
+        balanced = np.stack([sorted_costs[:, self._snake == r].sum(axis=1) for r in range(self.num_replicas)], axis=1)
+        # a count-only split hands out the shuffled molecules round-robin
+        shuffled_costs = self.costs[steps]
+        baseline = np.stack([shuffled_costs[:, r::self.num_replicas].sum(axis=1) for r in range(self.num_replicas)], axis=1)
+        report = {}
+        for name, loads in (('balanced', balanced), ('count_only', baseline)):
+            imbalance = loads.max(axis=1) / np.maximum(loads.mean(axis=1), 1)
+            report[name] = {'mean_imbalance': float(imbalance.mean()), 'max_imbalance': float(imbalance.max()),
+                            'mean_rank_cost_std': float(loads.std(axis=1).mean())}
+        return report
@@ -0,0 +1,96 @@
+import numpy as np
+from multiprocessing import Pool
+from functools import partial
+from rdkit import Chem
+
+
+SIZE_COLUMNS = ['n_atoms', 'n_bonds', 'n_triplets', 'n_nodes', 'n_lgp_edges', 'n_mgp_edges', 'n_vp_edges', 'n_sl_edges', 'n_edges']
+COLUMN_TO_ID = {name: i for i, name in enumerate(SIZE_COLUMNS)}
+
+
+def molecule_size(smiles, max_length=5, n_virtual_nodes=2, add_self_loop=True):
+    # Counts of the graph smiles_to_graph would build, without featurizing; all zeros for invalid smiles
+    return mol_size(Chem.MolFromSmiles(smiles), max_length, n_virtual_nodes, add_self_loop)
+
+
+def mol_size(mol, max_length=5, n_virtual_nodes=2, add_self_loop=True):
+    sizes = np.zeros(len(SIZE_COLUMNS), dtype=np.int32)
+    if mol is None:
+        return sizes
+    degrees = np.array([atom.GetDegree() for atom in mol.GetAtoms()], dtype=np.int64)
+    n_triplets = mol.GetNumBonds() + int(np.sum(degrees == 0))
+    dist_matrix = Chem.rdmolops.GetDistanceMatrix(mol)
+    n_nodes = n_triplets + n_virtual_nodes
+    n_lgp_edges = int(np.sum(degrees * (degrees - 1)))
+    n_mgp_edges = int(np.sum((dist_matrix >= 3) & (dist_matrix <= max_length)))
+    n_vp_edges = 2 * n_triplets * n_virtual_nodes
+    n_sl_edges = n_nodes if add_self_loop else 0
+    sizes[:] = [mol.GetNumAtoms(), mol.GetNumBonds(), n_triplets, n_nodes,
+                n_lgp_edges, n_mgp_edges, n_vp_edges, n_sl_edges,
+                n_lgp_edges + n_mgp_edges + n_vp_edges + n_sl_edges]
+    return sizes
+
+
+def build_size_index(smiless, max_length=5, n_virtual_nodes=2, n_jobs=32, chunksize=1000):
+    worker = partial(molecule_size, max_length=max_length, n_virtual_nodes=n_virtual_nodes)
+    sizes = np.zeros((len(smiless), len(SIZE_COLUMNS)), dtype=np.int32)
+    with Pool(n_jobs) as pool:
+        for i, row in enumerate(pool.imap(worker, smiless, chunksize=chunksize)):
+            sizes[i] = row
+    return sizes
+
+
+def save_size_index(path, sizes, max_length, n_virtual_nodes):
+    np.savez(path, sizes=sizes, columns=np.array(SIZE_COLUMNS), max_length=max_length, n_virtual_nodes=n_virtual_nodes)
+
+
+class SizeIndex(object):
+    """Per-molecule graph size metadata (int32 columns in SIZE_COLUMNS), one row per dataset molecule."""
+    def __init__(self, sizes, max_length=5, n_virtual_nodes=2):
+        self.sizes = sizes
+        self.max_length = max_length
+        self.n_virtual_nodes = n_virtual_nodes
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        columns = data['columns'].tolist()
+        if columns != SIZE_COLUMNS:
+            raise ValueError(f'Unexpected size index columns in {path}: {columns}')
+        return cls(data['sizes'], int(data['max_length']), int(data['n_virtual_nodes']))
+
+    def save(self, path):
+        save_size_index(path, self.sizes, self.max_length, self.n_virtual_nodes)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, name):
+        return self.sizes[:, COLUMN_TO_ID[name]]
+
+    @property
+    def valid(self):
+        return self['n_atoms'] > 0
+
+    def cost(self, kind='edges'):
+        # batching / load-balancing cost per molecule
+        if kind == 'nodes':
+            return self['n_nodes']
+        elif kind == 'edges':
+            return self['n_edges']
+        else:
+            raise ValueError('Unknown cost kind %s' % kind)
+
+    def select(self, max_nodes=None, max_edges=None, drop_invalid=True):
+        # indices of molecules within the given graph size limits
+        keep = self.valid if drop_invalid else np.ones(len(self), dtype=bool)
+        if max_nodes is not None:
+            keep &= self['n_nodes'] <= max_nodes
+        if max_edges is not None:
+            keep &= self['n_edges'] <= max_edges
+        return np.where(keep)[0]
+
+    def summary(self, percentiles=(50, 90, 99, 100)):
+        valid = self.sizes[self.valid]
+        return {name: np.percentile(valid[:, i], percentiles).tolist() if len(valid) else []
+                for i, name in enumerate(SIZE_COLUMNS)}
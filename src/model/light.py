@@ -6,6 +6,8 @@ from dgl.nn.functional import edge_softmax
 import numpy as np
 
 from ..data.featurizer import VIRTUAL_ATOM_FEATURE_PLACEHOLDER, VIRTUAL_BOND_FEATURE_PLACEHOLDER
+from ..data.graph_batch import GraphBatch
+from . import scatter
 
 def init_params(module):
     if isinstance(module, nn.Linear):
@@ -51,6 +53,62 @@ class MLP(nn.Module):
         feats = self.out_proj(feats)
         return feats
 
+ATTENTION_BACKENDS = ['dgl', 'dense']
+
+def dense_attention(query, key, value, bias, dropout_p=0.):
+    """softmax(query key^T + bias) value over (..., n_queries, n_keys) blocks, without scaling"""
+    bias = bias.to(query.dtype)
+    if hasattr(nn.functional, 'scaled_dot_product_attention'):
+        # torch<2.1 has no scale argument, so its default 1/sqrt(d_head) scale is undone on the query
+        return nn.functional.scaled_dot_product_attention(query * query.shape[-1]**0.5, key, value,
+                                                          attn_mask=bias, dropout_p=dropout_p)
+    attn = torch.softmax(torch.matmul(query, key.transpose(-2, -1)) + bias, dim=-1)
+    return torch.matmul(nn.functional.dropout(attn, dropout_p), value)
+
+class DenseLayout(object):
+    """The nodes of every graph of a batched graph (or GraphBatch) as one block of a padded dense batch
+
+    pack/unpack convert (n_nodes, ...) node data to (n_graphs, max_nodes, ...)
+    and back, attention_bias scatters (n_edges, n_heads) edge data into the
+    (n_graphs, n_heads, max_nodes, max_nodes) additive bias of the 'dense'
+    attention backend, with rows indexed by destination and columns by source
+    nodes and -inf for node pairs without an edge.
+    """
+    def __init__(self, g):
+        if isinstance(g, GraphBatch):
+            n_nodes = g.node_ptr[1:] - g.node_ptr[:-1]
+            src, dst = g.edge_index
+        else:
+            n_nodes = g.batch_num_nodes()
+            src, dst = g.edges()
+        device = n_nodes.device
+        self.n_graphs = len(n_nodes)
+        self.max_nodes = int(n_nodes.max())
+        self.graph_ids = torch.repeat_interleave(torch.arange(self.n_graphs, device=device), n_nodes)
+        starts = torch.cumsum(n_nodes, dim=0) - n_nodes
+        self.local_ids = torch.arange(len(self.graph_ids), device=device) - starts[self.graph_ids]
+        self.edge_ids = (self.graph_ids[dst], self.local_ids[dst], self.local_ids[src])
+        # nodes without incoming edges aggregate nothing, as in edge_softmax
+        self.has_in_edges = torch.bincount(dst, minlength=len(self.graph_ids)) > 0
+        # the bias rows of padding and of nodes without incoming edges
+        self.empty_rows = torch.ones((self.n_graphs, self.max_nodes), dtype=torch.bool, device=device)
+        self.empty_rows[self.graph_ids, self.local_ids] = ~self.has_in_edges
+
+    def pack(self, x):
+        packed = x.new_zeros((self.n_graphs, self.max_nodes) + tuple(x.shape[1:]))
+        packed[self.graph_ids, self.local_ids] = x
+        return packed
+
+    def unpack(self, x):
+        return x[self.graph_ids, self.local_ids]
+
+    def attention_bias(self, a):
+        bias = a.new_full((self.n_graphs, self.max_nodes, self.max_nodes, a.shape[-1]), float('-inf'))
+        bias[self.edge_ids] = a
+        # rows that are all -inf would softmax to nan
+        bias[self.empty_rows] = 0.
+        return bias.permute(0, 3, 1, 2)
+
 class TripletTransformer(nn.Module):
     def __init__(self,
                 d_feats,
@@ -60,13 +118,17 @@ class TripletTransformer(nn.Module):
                 n_ffn_dense_layers,
                 feat_drop=0.,
                 attn_drop=0.,
-                activation=nn.GELU()):
+                activation=nn.GELU(),
+                attention_backend='dgl'):
         super(TripletTransformer, self).__init__()
+        if attention_backend not in ATTENTION_BACKENDS:
+            raise ValueError(f'Unknown attention backend {attention_backend}, choose from {", ".join(ATTENTION_BACKENDS)}')
         self.d_feats = d_feats
         self.d_trip_path = d_feats//d_hpath_ratio
         self.path_length = path_length
         self.n_heads = n_heads
         self.scale = d_feats**(-0.5)
+        self.attention_backend = attention_backend
 
         self.attention_norm = nn.LayerNorm(d_feats)
         self.qkv = nn.Linear(d_feats, d_feats*3)
@@ -76,10 +138,6 @@ class TripletTransformer(nn.Module):
         self.attn_dropout = nn.Dropout(p=attn_drop)
         self.act = activation
 
-    def pretrans_edges(self, edges):
-        edge_h = edges.src['hv']
-        return {"he": edge_h}
-
     def forward(self, g, triplet_h, dist_attn, path_attn):
         g = g.local_var()
         new_triplet_h = self.attention_norm(triplet_h)
@@ -92,12 +150,36 @@ class TripletTransformer(nn.Module):
         g.edata['a'] = g.edata['node_attn'] + dist_attn.reshape(len(g.edata['node_attn']),-1,1) + path_attn.reshape(len(g.edata['node_attn']),-1,1)
         g.edata['sa'] = self.attn_dropout(edge_softmax(g, g.edata['a']))
 
-        g.ndata['hv'] = v.view(-1, self.d_feats)
-        g.apply_edges(self.pretrans_edges)
-        g.edata['he'] = ((g.edata['he'].view(-1, self.n_heads, self.d_feats//self.n_heads)) * g.edata['sa']).view(-1, self.d_feats)
-        
-        g.update_all(fn.copy_e('he', 'm'), fn.sum('m', 'agg_h'))
-        return self.node_out_layer(triplet_h, g.ndata['agg_h'])
+        # weighting the source values by the per-head attention and summing them is one fused
+        # sparse op, so no (n_edges, d_feats) message tensor is built
+        g.srcdata['hv'] = v
+        g.update_all(fn.u_mul_e('hv', 'sa', 'm'), fn.sum('m', 'agg_h'))
+        return self.node_out_layer(triplet_h, g.dstdata['agg_h'].view(-1, self.d_feats))
+
+    def scatter_forward(self, edge_index, triplet_h, dist_attn, path_attn):
+        """forward on the (source, destination) edge_index of a GraphBatch, with scatter ops instead of dgl"""
+        new_triplet_h = self.attention_norm(triplet_h)
+        qkv = self.qkv(new_triplet_h).reshape(-1, 3, self.n_heads, self.d_feats // self.n_heads).permute(1, 0, 2, 3)
+        q, k, v = qkv[0]*self.scale, qkv[1], qkv[2]
+        src, dst = edge_index[0], edge_index[1]
+        node_attn = torch.sum(q[src] * k[dst], dim=-1, keepdim=True)
+        a = node_attn + dist_attn.reshape(len(node_attn),-1,1) + path_attn.reshape(len(node_attn),-1,1)
+        sa = self.attn_dropout(scatter.edge_softmax(a, dst, triplet_h.shape[0]))
+        agg_h = scatter.scatter_sum(v[src] * sa, dst, triplet_h.shape[0])
+        return self.node_out_layer(triplet_h, agg_h.view(-1, self.d_feats))
+
+    def dense_forward(self, layout, triplet_h, attn_bias):
+        """forward with the graphs as padded dense blocks, attn_bias from layout.attention_bias(dist_attn + path_attn)"""
+        new_triplet_h = self.attention_norm(triplet_h)
+        qkv = self.qkv(new_triplet_h).reshape(-1, 3, self.n_heads, self.d_feats // self.n_heads).permute(1, 0, 2, 3)
+        q, k, v = qkv[0]*self.scale, qkv[1], qkv[2]
+        # the attention score of an edge is Q of its source dot K of its destination (u_dot_v('Q', 'K')),
+        # so the destination K are the queries and the source Q the keys
+        query, key, value = [layout.pack(x).transpose(1, 2) for x in (k, q, v)]
+        agg_h = dense_attention(query, key, value, attn_bias, self.attn_dropout.p if self.training else 0.)
+        agg_h = layout.unpack(agg_h.transpose(1, 2)).reshape(-1, self.d_feats)
+        agg_h = agg_h * layout.has_in_edges.unsqueeze(-1).to(agg_h.dtype)
+        return self.node_out_layer(triplet_h, agg_h)
 
     def _device(self):
         return next(self.parameters()).device
@@ -112,13 +194,15 @@ class LiGhT(nn.Module):
                 n_ffn_dense_layers=4,
                 feat_drop=0.,
                 attn_drop=0.,
-                activation=nn.GELU()):
+                activation=nn.GELU(),
+                attention_backend='dgl'):
         super(LiGhT, self).__init__()
         self.n_mol_layers = n_mol_layers
         self.n_heads = n_heads
         self.path_length = path_length
         self.d_g_feats = d_g_feats
         self.d_trip_path = d_g_feats//d_hpath_ratio
+        self.attention_backend = attention_backend
 
         self.mask_emb = nn.Embedding(1, d_g_feats)
         # Distance Attention
@@ -141,38 +225,60 @@ class LiGhT(nn.Module):
         )
         # Molecule Transformer Layers
         self.mol_T_layers = nn.ModuleList([
-            TripletTransformer(d_g_feats,d_hpath_ratio, path_length, n_heads, n_ffn_dense_layers, feat_drop, attn_drop, activation) for _ in range(n_mol_layers)
+            TripletTransformer(d_g_feats,d_hpath_ratio, path_length, n_heads, n_ffn_dense_layers, feat_drop, attn_drop, activation, attention_backend) for _ in range(n_mol_layers)
         ])
 
         self.feat_dropout = nn.Dropout(p=feat_drop)
         self.attn_dropout = nn.Dropout(p=attn_drop)
         self.act = activation
     
-    def _featurize_path(self, g, path_indices):
+    def _featurize_path(self, path_indices, vp, sl):
         mask = (path_indices[:,:]>=0).to(torch.int32)
         path_feats = torch.sum(mask, dim=-1)
         path_feats = self.path_len_emb(path_feats)
-        path_feats[g.edata['vp']==1] = self.virtual_path_emb.weight # virtual path
-        path_feats[g.edata['sl']==1] = self.self_loop_emb.weight # self loop
-        return path_feats    
+        path_feats = torch.where((vp==1).unsqueeze(-1), self.virtual_path_emb.weight, path_feats) # virtual path
+        path_feats = torch.where((sl==1).unsqueeze(-1), self.self_loop_emb.weight, path_feats) # self loop
+        return path_feats
     
     def _init_path(self, g, triplet_h, path_indices):
-        g = g.local_var()
-        path_indices[path_indices<-99] = -1
-        path_h = []
-        for i in range(self.path_length):
-            path_h.append(torch.cat([self.trip_fortrans[i](triplet_h),torch.zeros(size=(1,self.d_trip_path)).to(self._device())], dim=0)[path_indices[:, i]])
-        path_h = torch.stack(path_h, dim=-1)
-        mask = (path_indices>=0).to(torch.int32)
-        path_size = torch.sum(mask, dim=-1,keepdim=True)
-        path_h = torch.sum(path_h, dim=-1)/path_size
-        return path_h
+        # the 2-layer trip_fortrans MLPs of all path positions as one grouped matmul per layer,
+        # triplet_h -> (n_triplets, path_length, d_trip_path)
+        in_weight = torch.cat([mlp.in_proj.weight for mlp in self.trip_fortrans], dim=0)
+        in_bias = torch.cat([mlp.in_proj.bias for mlp in self.trip_fortrans], dim=0)
+        trip_h = self.act(nn.functional.linear(triplet_h, in_weight, in_bias)).view(-1, self.path_length, self.d_trip_path)
+        out_weight = torch.stack([mlp.out_proj.weight for mlp in self.trip_fortrans], dim=0)
+        out_bias = torch.stack([mlp.out_proj.bias for mlp in self.trip_fortrans], dim=0)
+        trip_h = torch.einsum('nli,loi->nlo', trip_h, out_weight) + out_bias
+        # masked mean over the path positions: padded positions (negative indices) get weight 0
+        # and point at row 0, the row of triplet i at position j is i*path_length+j
+        mask = path_indices >= 0
+        positions = torch.arange(self.path_length, device=path_indices.device)
+        rows = torch.where(mask, path_indices * self.path_length + positions, torch.zeros_like(path_indices))
+        path_h = nn.functional.embedding_bag(rows, trip_h.reshape(-1, self.d_trip_path),
+                                             per_sample_weights=mask.to(trip_h.dtype), mode='sum')
+        path_size = torch.sum(mask.to(torch.int32), dim=-1, keepdim=True)
+        return path_h/path_size
 
     def forward(self, g, triplet_h):
-        path_indices = g.edata['path']
-        dist_h = self._featurize_path(g, path_indices)
+        # a GraphBatch runs without dgl: the dense backend or scatter ops instead of edge_softmax/update_all
+        if isinstance(g, GraphBatch):
+            path_indices, vp, sl = g.path, g.vp, g.sl
+        else:
+            path_indices, vp, sl = g.edata['path'], g.edata['vp'], g.edata['sl']
+        dist_h = self._featurize_path(path_indices, vp, sl)
         path_h = self._init_path(g, triplet_h, path_indices)
         dist_attn, path_attn = self.dist_attn_layer(dist_h), self.path_attn_layer(path_h)
+        if self.attention_backend == 'dense':
+            # the edge bias is the same for all layers, so it is scattered once
+            layout = DenseLayout(g)
+            attn_bias = layout.attention_bias(dist_attn + path_attn)
+            for i in range(self.n_mol_layers):
+                triplet_h = self.mol_T_layers[i].dense_forward(layout, triplet_h, attn_bias)
+            return triplet_h
+        if isinstance(g, GraphBatch):
+            for i in range(self.n_mol_layers):
+                triplet_h = self.mol_T_layers[i].scatter_forward(g.edge_index, triplet_h, dist_attn, path_attn)
+            return triplet_h
         for i in range(self.n_mol_layers):
             triplet_h = self.mol_T_layers[i](g, triplet_h, dist_attn, path_attn)
         return triplet_h
@@ -192,7 +298,9 @@ class AtomEmbedding(nn.Module):
         self.input_dropout = nn.Dropout(input_drop)
     def forward(self, pair_node_feats, indicators):
         pair_node_h = self.in_proj(pair_node_feats)
-        pair_node_h[indicators==VIRTUAL_ATOM_FEATURE_PLACEHOLDER, 1, :] = self.virtual_atom_emb.weight#.half()
+        # masked selects instead of masked assignments keep the shapes static for torch.compile
+        virtual = (indicators==VIRTUAL_ATOM_FEATURE_PLACEHOLDER).unsqueeze(-1)
+        pair_node_h = torch.stack([pair_node_h[:, 0], torch.where(virtual, self.virtual_atom_emb.weight, pair_node_h[:, 1])], dim=1)
         return torch.sum(self.input_dropout(pair_node_h), dim=-2)
 
 class BondEmbedding(nn.Module):
@@ -207,7 +315,7 @@ class BondEmbedding(nn.Module):
         self.input_dropout = nn.Dropout(input_drop)
     def forward(self, edge_feats, indicators):
         edge_h = self.in_proj(edge_feats)
-        edge_h[indicators==VIRTUAL_BOND_FEATURE_PLACEHOLDER] = self.virutal_bond_emb.weight#.half()
+        edge_h = torch.where((indicators==VIRTUAL_BOND_FEATURE_PLACEHOLDER).unsqueeze(-1), self.virutal_bond_emb.weight, edge_h)
         return self.input_dropout(edge_h)
 
 class TripletEmbedding(nn.Module):
@@ -224,8 +332,11 @@ class TripletEmbedding(nn.Module):
     def forward(self, node_h, edge_h, fp, md, indicators):
         triplet_h = torch.cat([node_h, edge_h], dim=-1)
         triplet_h = self.in_proj(triplet_h)
-        triplet_h[indicators==1] = self.fp_proj(fp) # disturbed fp
-        triplet_h[indicators==2] = self.md_proj(md) # disturbed md
+        # the k-th fp (md) virtual node gets the k-th projected fp (md)
+        for indicator, h in [(1, self.fp_proj(fp)), (2, self.md_proj(md))]: # disturbed fp, md
+            is_virtual = indicators==indicator
+            rows = torch.clamp(torch.cumsum(is_virtual.to(torch.int64), dim=0) - 1, min=0)
+            triplet_h = torch.where(is_virtual.unsqueeze(-1), h[rows], triplet_h)
         return triplet_h
 
 class LiGhTPredictor(nn.Module):
@@ -245,7 +356,8 @@ class LiGhTPredictor(nn.Module):
                 attn_drop=0.,
                 activation=nn.GELU(),
                 n_node_types=1,
-                readout_mode='mean'
+                readout_mode='mean',
+                attention_backend='dgl'
     ):
         super(LiGhTPredictor, self).__init__()
         self.d_g_feats = d_g_feats
@@ -257,7 +369,7 @@ class LiGhTPredictor(nn.Module):
         self.mask_emb = nn.Embedding(1, d_g_feats)
         # Model
         self.model = LiGhT(
-            d_g_feats,d_hpath_ratio, path_length, n_mol_layers, n_heads, n_ffn_dense_layers, feat_drop, attn_drop, activation
+            d_g_feats,d_hpath_ratio, path_length, n_mol_layers, n_heads, n_ffn_dense_layers, feat_drop, attn_drop, activation, attention_backend
         )
         # Predict
         # self.node_predictor = nn.Linear(d_g_feats, n_node_types)
@@ -304,6 +416,8 @@ class LiGhTPredictor(nn.Module):
         return self.node_predictor(triplet_h[g.ndata['mask']>=1]), self.fp_predictor(triplet_h[indicators==1]), self.md_predictor(triplet_h[indicators==2]), self.contrastive_predictor(readout)
 
     def forward_tune(self, g, fp, md):
+        if isinstance(g, GraphBatch):
+            return self.predictor(self._generate_fps_scatter(g, fp, md))
         indicators = g.ndata['vavn'] # 0 indicates normal atoms and nodes (triplets); -1 indicates virutal atoms; >=1 indicate virtual nodes 
         # Input
         node_h = self.node_emb(g.ndata['begin_end'], indicators)          
@@ -322,6 +436,8 @@ class LiGhTPredictor(nn.Module):
         return self.predictor(g_feats)
 
     def generate_fps(self, g, fp, md):
+        if isinstance(g, GraphBatch):
+            return self._generate_fps_scatter(g, fp, md)
         indicators = g.ndata['vavn'] # 0 indicates normal atoms and nodes (triplets); -1 indicates virutal atoms; >=1 indicate virtual nodes 
         # Input
         node_h = self.node_emb(g.ndata['begin_end'], indicators)          
@@ -337,3 +453,19 @@ class LiGhTPredictor(nn.Module):
         readout = dgl.readout_nodes(g, 'ht', op=self.readout_mode)
         g_feats = torch.cat([fp_vn, md_vn, readout],dim=-1)
         return g_feats
+
+    def _generate_fps_scatter(self, g, fp, md):
+        indicators = g.vavn
+        # Input
+        node_h = self.node_emb(g.begin_end, indicators)
+        edge_h = self.edge_emb(g.edge, indicators)
+        triplet_h = self.triplet_emb(node_h, edge_h, fp, md, indicators)
+        # Model
+        triplet_h = self.model(g, triplet_h)
+        # Readout: every graph has one fp (1) and one md (2) virtual node, so their sums are their features;
+        # the virtual nodes are left out of the readout by masking instead of removing them
+        n_graphs = g.node_ptr.shape[0] - 1
+        fp_vn = scatter.segment_readout(triplet_h, g.node_graph, n_graphs, 'sum', indicators==1)
+        md_vn = scatter.segment_readout(triplet_h, g.node_graph, n_graphs, 'sum', indicators==2)
+        readout = scatter.segment_readout(triplet_h, g.node_graph, n_graphs, self.readout_mode, indicators<1)
+        return torch.cat([fp_vn, md_vn, readout],dim=-1)
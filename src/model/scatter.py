@@ -0,0 +1,62 @@
+import torch
+
+# Tensor.scatter_reduce(..., include_self=) is only available from torch 1.13 on, older versions
+# (like the pinned 1.10) take the maxima by sorting; torch.compile of the backend needs torch 2
+_HAS_SCATTER_REDUCE = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (1, 13)
+
+def _expand_index(index, like):
+    # (n,) -> index broadcast to the shape of like, as scatter_reduce expects
+    return index.view((-1,) + (1,) * (like.dim() - 1)).expand_as(like)
+
+def scatter_sum(src, index, n):
+    """Sums the rows of src into n rows by index"""
+    return src.new_zeros((n,) + tuple(src.shape[1:])).index_add(0, index, src)
+
+def _sorted_scatter_max(src, index, n):
+    # every column sorted by value, then stably by index: the last row of an index is its maximum
+    shape = (n,) + tuple(src.shape[1:])
+    if src.shape[0] == 0:
+        return src.new_full(shape, float('-inf'))
+    values, order = src.reshape(src.shape[0], -1).sort(dim=0)
+    _, index_order = index[order].sort(dim=0, stable=True)
+    values = values.gather(0, index_order)
+    counts = torch.bincount(index, minlength=n)
+    res = values[(torch.cumsum(counts, dim=0) - 1).clamp(min=0)]
+    res = torch.where((counts > 0).view(-1, 1), res, torch.full_like(res, float('-inf')))
+    return res.view(shape)
+
+def scatter_max(src, index, n):
+    """Maxima of the rows of src into n rows by index, -inf for rows without any"""
+    if not _HAS_SCATTER_REDUCE:
+        return _sorted_scatter_max(src, index, n)
+    return src.new_full((n,) + tuple(src.shape[1:]), float('-inf')).scatter_reduce(
+        0, _expand_index(index, src), src, reduce='amax', include_self=True)
+
+def edge_softmax(scores, dst, n_nodes):
+    """Softmax of the (n_edges, ...) scores over the incoming edges of every destination node, like dgl's edge_softmax"""
+    # the shift by the maximum does not change the result or its gradient, so it is not differentiated
+    max_scores = scatter_max(scores.detach(), dst, n_nodes)
+    exp_scores = torch.exp(scores - max_scores[dst])
+    return exp_scores / scatter_sum(exp_scores, dst, n_nodes)[dst]
+
+def segment_readout(x, node_graph, n_graphs, op='mean', mask=None):
+    """Per graph sum, mean or max of the node rows x, over the nodes with mask[i] when given
+
+    Like dgl.readout_nodes, graphs without (selected) nodes read out zeros.
+    Masked nodes are excluded by weights rather than by selecting rows, so
+    all shapes only depend on the batch size.
+    """
+    if mask is None:
+        mask = torch.ones(x.shape[0], dtype=torch.bool, device=x.device)
+    weight = mask.to(x.dtype).view((-1,) + (1,) * (x.dim() - 1))
+    if op == 'max':
+        masked = torch.where(weight > 0, x, torch.full_like(x, float('-inf')))
+        res = scatter_max(masked, node_graph, n_graphs)
+        return torch.where(torch.isinf(res) & (res < 0), torch.zeros_like(res), res)
+    res = scatter_sum(x * weight, node_graph, n_graphs)
+    if op == 'sum':
+        return res
+    if op == 'mean':
+        counts = scatter_sum(weight, node_graph, n_graphs)
+        return res / counts.clamp(min=1)
+    raise ValueError(f'Unknown readout {op}, choose from sum, mean, max')
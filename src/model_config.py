@@ -2,6 +2,7 @@ config_dict = {
     'KG-GCPT': {
         'd_node_feats': 137, 'd_edge_feats': 14, 'd_g_feats': 768, 'd_hpath_ratio': 12, 'n_mol_layers': 12, 'path_length': 5, 
         'n_heads': 12, 'n_ffn_dense_layers': 2,'input_drop':0.0, 'attn_drop': 0.1, 'feat_drop': 0.1, 'lr': 2e-04, 
-        'weight_decay': 1e-6, 'candi_rate':0.5, 'fp_disturb_rate': 0.5, 'md_disturb_rate': 0.5
+        'weight_decay': 1e-6, 'candi_rate':0.5, 'fp_disturb_rate': 0.5, 'md_disturb_rate': 0.5,
+        'attention_backend': 'dgl'
     },
 }
\ No newline at end of file
@@ -39,8 +39,12 @@ class Trainer():
             if (self.label_mean is not None) and (self.label_std is not None):
                 labels = (labels - self.label_mean)/self.label_std
             loss = (self.loss_fn(predictions, labels) * is_labeled).mean()
-            loss.backward()
             avg_train_loss += loss.item()
+            avg_batch_size = getattr(train_loader.batch_sampler, 'avg_batch_size', None)
+            if avg_batch_size is not None:
+                # cost-aware batches vary in size: weight each batch by its share of an average step
+                loss = loss * len(labels) / avg_batch_size
+            loss.backward()
             torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
             self.optimizer.step()
             self.lr_scheduler.step()
@@ -55,6 +59,8 @@ class Trainer():
         for epoch in tqdm(range(1, self.args.n_epochs+1)):
             if self.ddp:
                 train_loader.sampler.set_epoch(epoch)
+            if hasattr(train_loader.batch_sampler, 'set_epoch'):
+                train_loader.batch_sampler.set_epoch(epoch)
             train_loss = self.train_epoch(model, train_loader, epoch)
 
             if self.local_rank == 0:
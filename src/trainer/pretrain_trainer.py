@@ -1,4 +1,5 @@
 import os
+import time
 import wandb
 import torch
 import torch.nn.functional as F
@@ -67,6 +68,7 @@ class Trainer():
     
     def train_epoch(self, model, train_loader, epoch_idx):
         model.train()
+        step_start = time.time()
         for batch_idx, batched_data in enumerate(train_loader):
             self.optimizer.zero_grad()
             sl_predictions, sl_labels, fp_predictions, fps, disturbed_fps, md_predictions, mds, z = self._forward_epoch(model, batched_data)
@@ -79,7 +81,11 @@ class Trainer():
 
             loss = (sl_loss + fp_loss + md_loss + contrastive_loss) / 4
             
-            if self.gradient_accumulate_steps > 1:
+            avg_batch_size = getattr(train_loader.batch_sampler, 'avg_batch_size', None)
+            if avg_batch_size is not None:
+                # cost-aware batches vary in size: weight each batch by its share of an average update
+                loss = loss * len(batched_data[0]) / (avg_batch_size * self.gradient_accumulate_steps)
+            elif self.gradient_accumulate_steps > 1:
                 loss = loss / self.gradient_accumulate_steps
             loss.backward()
             
@@ -92,7 +98,9 @@ class Trainer():
                 self.optimizer.zero_grad()
             
             if self.local_rank == 0:
-                wandb.log({'train_loss': loss, 'sl_loss': sl_loss, 'fp_loss': fp_loss, 'md_loss': md_loss, 'contrastive_loss': contrastive_loss, 'lr': self.optimizer.state_dict()['param_groups'][0]['lr']})
+                # step_time includes waiting on the slowest rank at the gradient all-reduce
+                step_time, step_start = time.time() - step_start, time.time()
+                wandb.log({'train_loss': loss, 'sl_loss': sl_loss, 'fp_loss': fp_loss, 'md_loss': md_loss, 'contrastive_loss': contrastive_loss, 'lr': self.optimizer.state_dict()['param_groups'][0]['lr'], 'step_time': step_time})
             
             if self.n_updates % 1000 == 0:
                 if self.local_rank == 0:
@@ -125,8 +133,10 @@ class Trainer():
         self.optimizer.zero_grad()
         for epoch in range(1, 1001):
             model.train()
-            if self.ddp:
+            if hasattr(train_loader.sampler, 'set_epoch'):
                 train_loader.sampler.set_epoch(epoch)
+            if hasattr(train_loader.batch_sampler, 'set_epoch'):
+                train_loader.batch_sampler.set_epoch(epoch)
             self.train_epoch(model, train_loader, epoch)
             if self.training_updates >= self.args.n_steps:
                 break
@@ -0,0 +1,83 @@
+import copy
+
+import dgl
+import pytest
+import torch
+
+from src.data.collator import Collator_tune
+from src.data.featurizer import smiles_to_graph_tune
+from src.data.graph_batch import GraphBatch
+from src.model import scatter
+from src.model.light import LiGhTPredictor
+
+SMILES = ['CCO', 'c1ccccc1', 'CC(=O)Oc1ccccc1C(=O)O', 'CN1CCC[C@H]1c1cccnc1', 'O=C1CN=C(c2ccccc2)c2cc(Cl)ccc2N1']
+
+
+def make_samples(fps=None, mds=None):
+    graphs = [smiles_to_graph_tune(smiles, max_length=5, n_virtual_nodes=2) for smiles in SMILES]
+    # without self loops the only triplet of methane has no incoming edges
+    graphs.append(smiles_to_graph_tune('C', max_length=5, n_virtual_nodes=2, add_self_loop=False))
+    # nor has a triplet whose incoming edges were removed
+    g = smiles_to_graph_tune('CC(C)N', max_length=5, n_virtual_nodes=2)
+    graphs.append(dgl.remove_edges(g, g.in_edges(0, form='eid')))
+    fps = torch.zeros(len(graphs), 512) if fps is None else fps
+    mds = torch.zeros(len(graphs), 200) if mds is None else mds
+    return [(smiles, g, fp, md, torch.zeros(1)) for smiles, g, fp, md in zip(SMILES + ['C', 'CC(C)N'], graphs, fps, mds)]
+
+
+def make_batch():
+    _, bg, fps, mds, _ = Collator_tune()(make_samples())
+    fps.normal_()
+    mds.normal_()
+    return bg, fps, mds
+
+
+def make_model(backend, readout_mode):
+    torch.manual_seed(0)
+    model = LiGhTPredictor(d_node_feats=137, d_edge_feats=14, d_g_feats=48, d_hpath_ratio=4, n_mol_layers=2,
+                           path_length=5, n_heads=4, readout_mode=readout_mode, attention_backend=backend)
+    return model.eval()
+
+
+@pytest.mark.parametrize('readout_mode', ['mean', 'max'])
+def test_attention_backends_agree(readout_mode):
+    torch.manual_seed(0)
+    bg, fps, mds = make_batch()
+    assert (bg.in_degrees() == 0).any()
+    with torch.no_grad():
+        reference = make_model('dgl', readout_mode).generate_fps(copy.deepcopy(bg), fps, mds)
+        dense = make_model('dense', readout_mode).generate_fps(copy.deepcopy(bg), fps, mds)
+        dense_scatter = make_model('dense', readout_mode).generate_fps(GraphBatch.from_dgl(bg), fps, mds)
+        scatter = make_model('dgl', readout_mode).generate_fps(GraphBatch.from_dgl(bg), fps, mds)
+    assert reference.shape == (len(SMILES) + 2, 3 * 48)
+    for output in [dense, dense_scatter, scatter]:
+        assert torch.allclose(output, reference, atol=1e-5)
+
+
+def test_scatter_backend_loads_dgl_checkpoints(tmp_path):
+    bg, fps, mds = make_batch()
+    trained = make_model('dgl', 'mean')
+    for param in trained.parameters():
+        param.data.normal_(0, 0.05)
+    # as saved by the DDP pretraining trainer and loaded by finetune.py
+    checkpoint = tmp_path / 'model.pth'
+    torch.save({f'module.{k}': v for k, v in trained.state_dict().items()}, checkpoint)
+    state = {k.replace('module.', ''): v for k, v in torch.load(checkpoint).items()}
+    dgl_model, scatter_model = make_model('dgl', 'mean'), make_model('dgl', 'mean')
+    dgl_model.load_state_dict(state)
+    scatter_model.load_state_dict(state)
+    with torch.no_grad():
+        reference = dgl_model.generate_fps(copy.deepcopy(bg), fps, mds)
+        scatter = scatter_model.generate_fps(GraphBatch.from_dgl(bg), fps, mds)
+        _, batch, _, _, _ = Collator_tune(graph_backend='scatter')(make_samples(fps, mds))
+        collated = scatter_model.generate_fps(batch, fps, mds)
+    assert torch.allclose(scatter, reference, atol=1e-5)
+    assert torch.allclose(collated, reference, atol=1e-5)
+
+
+@pytest.mark.skipif(not scatter._HAS_SCATTER_REDUCE, reason='needs scatter_reduce to compare against')
+def test_sorted_scatter_max_matches_scatter_reduce():
+    torch.manual_seed(0)
+    index = torch.randint(0, 30, (500,))
+    for src in [torch.randn(500, 4), torch.randn(500, 3, 2), torch.randn(500)]:
+        assert torch.equal(scatter._sorted_scatter_max(src, index, 40), scatter.scatter_max(src, index, 40))
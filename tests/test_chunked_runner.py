@@ -0,0 +1,54 @@
+import os
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+
+from src.data.descriptors.rdNormalizedDescriptors import RDKit2DNormalized
+from src.data.pipeline import ChunkedRunner, featurize_molecule
+
+SMILES = ['CCO', 'c1ccccc1', 'CC(=O)Oc1ccccc1C(=O)O', 'not a smiles', 'CN1CCC[C@H]1c1cccnc1', '[Na+].[Cl-]',
+          'O=C1CN=C(c2ccccc2)c2cc(Cl)ccc2N1', 'C1CCCCC1N', 'OB(O)c1ccccc1', 'CC(C)NCC(O)COc1cccc2ccccc12']
+
+
+def smiles_length(smiles, scale=1):
+    return np.array([len(smiles) * scale])
+
+
+def run_molecules(work_dir, backend):
+    featurize = partial(featurize_molecule, generator=RDKit2DNormalized(), max_length=5, n_virtual_nodes=2)
+    with ChunkedRunner(str(work_dir), n_jobs=2, chunk_size=4, imap_chunksize=1, backend=backend) as runner:
+        runner.run('molecules', featurize, SMILES, kind='molecules')
+        return runner.merge_molecules('molecules', len(SMILES))
+
+
+def test_thread_and_process_backends_agree(tmp_path):
+    graphs, sizes, fps, mds = run_molecules(tmp_path / 'process', 'process')
+    other_graphs, other_sizes, other_fps, other_mds = run_molecules(tmp_path / 'thread', 'thread')
+    np.testing.assert_array_equal(sizes, other_sizes)
+    np.testing.assert_array_equal(fps, other_fps)
+    np.testing.assert_array_equal(mds, other_mds)
+    assert [g is None for g in graphs] == [smiles == 'not a smiles' for smiles in SMILES]
+    for g, h in zip(graphs, other_graphs):
+        if g is None:
+            assert h is None
+            continue
+        assert all(torch.equal(x, y) for x, y in zip(g.edges(), h.edges()))
+        for key in g.ndata:
+            assert torch.equal(g.ndata[key], h.ndata[key])
+        for key in g.edata:
+            assert torch.equal(g.edata[key], h.edata[key])
+
+
+def test_stage_resumes_only_with_the_same_inputs(tmp_path):
+    with ChunkedRunner(str(tmp_path), n_jobs=1, chunk_size=4, backend='thread') as runner:
+        runner.run('lengths', partial(smiles_length, scale=1), SMILES)
+        runner.run('lengths', partial(smiles_length, scale=1), SMILES)
+        with pytest.raises(ValueError):
+            runner.run('lengths', partial(smiles_length, scale=1), SMILES[::-1])
+        with pytest.raises(ValueError):
+            runner.run('lengths', partial(smiles_length, scale=2), SMILES)
+        runner.merge_arrays('lengths', len(SMILES))
+        runner.cleanup()
+    assert not os.path.exists(tmp_path / 'lengths')
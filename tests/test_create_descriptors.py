@@ -0,0 +1,14 @@
+import pandas as pd
+
+from src.data.descriptors import rdDescriptors  # registers the generators
+from src.data.descriptors.DescriptorGenerator import create_descriptors
+
+
+def test_create_descriptors_keeps_column_dtypes():
+    df = pd.DataFrame({'smiles': ['CCO', 'c1ccccc1', 'not a smiles']})
+    descriptors = create_descriptors(df, 'smiles', ['RDKit2D', 'Morgan3Counts'])
+    assert descriptors.RDKit2D_calculated.dtype == bool
+    assert descriptors.Morgan3Counts_calculated.dtype == bool
+    assert descriptors[descriptors.RDKit2D_calculated].index.tolist() == [0, 1]
+    columns = dict(rdDescriptors.MorganCounts().GetColumns())
+    assert all(descriptors[name].dtype == dtype for name, dtype in columns.items())
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from rdkit import Chem
+
+from src.data.descriptors import cdfTables, dists
+from src.data.descriptors.rdNormalizedDescriptors import RDKit2DNormalized, applyNormalizedFunc
+
+SMILES = ['CCO', 'c1ccccc1', 'CC(=O)Oc1ccccc1C(=O)O', 'CN1CCC[C@H]1c1cccnc1', 'O=C1CN=C(c2ccccc2)c2cc(Cl)ccc2N1',
+          '[Na+].[Cl-]', 'CCCCCCCCCCCCCCCC(=O)O', 'OB(O)c1ccccc1']
+NAMES = ['MolWt', 'TPSA', 'MolLogP', 'NumHDonors', 'BertzCT', 'qed', 'fr_benzene', 'MaxPartialCharge']
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_cdf_table_within_tolerance_of_scipy(name):
+    cdf = cdfTables.scipyCdfs([name])[name]
+    _, _, minV, maxV, _, _ = dists.dists[name]
+    x, y, err = cdfTables.tabulate(cdf, minV, maxV, tol=1e-6)
+    assert err <= 1e-6
+    # random points, and beyond the clipped range where both are constant
+    probes = np.concatenate([np.random.default_rng(0).uniform(minV, maxV, 20000), [minV - 1., maxV + 1.]])
+    assert np.abs(cdfTables.tableCdf(x, y)(probes) - cdf(probes)).max() <= 1e-6
+
+
+def test_vectorized_normalization_matches_per_molecule():
+    generator = RDKit2DNormalized()
+    mols = [Chem.MolFromSmiles(smiles) for smiles in SMILES]
+    batch = generator.calculateMols(mols)
+    names = [name for name, _ in generator.columns]
+    for mol, row in zip(mols, batch):
+        expected = [applyNormalizedFunc(name, mol) for name in names]
+        np.testing.assert_allclose(row, expected, rtol=0, atol=1e-12)
+        values = np.empty(len(names))
+        generator.processMolInto(mol, Chem.MolToSmiles(mol), values, internalParsing=True)
+        np.testing.assert_array_equal(values, row)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from rdkit import Chem
+from rdkit.Chem import QED
+
+from src.data.descriptors import fusedDescriptors, rdDescriptors
+from src.data.descriptors.fusedDescriptors import FusedDescriptors, _qedProperties
+
+RING_SMILES = ['c1ccccc1', 'CC(=O)Oc1ccccc1C(=O)O', 'CN1CCC[C@H]1c1cccnc1', 'O=C1CN=C(c2ccccc2)c2cc(Cl)ccc2N1',
+               'C1CCCCC1N', 'CC12CCC3C(CCC4=CC(=O)CCC34C)C1CCC2O', 'c1ccc2[nH]ccc2c1', 'O=S(=O)(N)c1ccc(F)cc1']
+ACYCLIC_SMILES = ['CCO', 'CCN(CC)CC', 'OC(=O)CCC(N)C(=O)O', '[Na+].[Cl-]', 'CC(C)(C)OC(=O)N', 'C=CC#N', 'ClCCCl']
+
+
+def columns():
+    return [name for name, _ in rdDescriptors.RDKit2D().columns]
+
+
+@pytest.mark.parametrize('smiles', RING_SMILES + ACYCLIC_SMILES)
+def test_fused_descriptors_match_applyfunc(smiles):
+    names = columns()
+    m = Chem.MolFromSmiles(smiles)
+    fused = FusedDescriptors(names).calculate(m)
+    for name, value in zip(names, fused):
+        expected = rdDescriptors.applyFunc(name, m)
+        assert value == expected or (np.isnan(value) and np.isnan(expected)), name
+
+
+@pytest.mark.parametrize('smiles', RING_SMILES + ACYCLIC_SMILES)
+def test_qed_is_computed_from_the_fused_properties(smiles, monkeypatch):
+    m = Chem.MolFromSmiles(smiles)
+    assert list(_qedProperties(m)) == list(QED.properties(m))
+    # qed only falls back to a full applyFunc evaluation when RDKit fails
+    calls = []
+    monkeypatch.setattr(fusedDescriptors.rdDescriptors, 'applyFunc',
+                        lambda name, m: calls.append(name) or rdDescriptors.FUNCS[name](m))
+    FusedDescriptors(['qed', 'MolWt', 'TPSA']).calculate(m)
+    assert 'qed' not in calls
+
+
+@pytest.mark.parametrize('smiles', RING_SMILES)
+def test_qed_properties_with_sssr_counts(smiles, monkeypatch):
+    # RDKit before 2022 returns the number of rings from GetSSSR
+    m = Chem.MolFromSmiles(smiles)
+    expected = list(QED.properties(m))
+    get_sssr = Chem.GetSSSR
+    monkeypatch.setattr(fusedDescriptors.Chem, 'GetSSSR', lambda mol: len(get_sssr(mol)))
+    assert list(_qedProperties(m)) == expected
@@ -0,0 +1,40 @@
+import torch
+
+from src.model.light import LiGhT
+
+VIRTUAL_PATH_INDICATOR = -1e6
+
+
+def per_position_init_path(model, triplet_h, path_indices):
+    # one trip_fortrans MLP call per path position, padded positions read a zero row
+    path_indices = torch.where(path_indices < 0, torch.full_like(path_indices, -1), path_indices)
+    zeros = torch.zeros(size=(1, model.d_trip_path))
+    path_h = torch.stack([torch.cat([model.trip_fortrans[i](triplet_h), zeros], dim=0)[path_indices[:, i]]
+                          for i in range(model.path_length)], dim=-1)
+    path_size = torch.sum((path_indices >= 0).to(torch.int32), dim=-1, keepdim=True)
+    return torch.sum(path_h, dim=-1) / path_size
+
+
+def test_fused_init_path_matches_per_position_mlps():
+    torch.manual_seed(0)
+    model = LiGhT(48, 4, 5, n_mol_layers=1, n_heads=4)
+    for param in model.parameters():
+        param.data.normal_(0, 0.1)
+    n_triplets, n_paths = 40, 300
+    triplet_h = torch.randn(n_triplets, 48, requires_grad=True)
+    path_indices = torch.randint(0, n_triplets, (n_paths, 5))
+    # paths of 1 to 5 triplets, padded like the featurizer does
+    lengths = torch.randint(1, 6, (n_paths, 1))
+    path_indices = torch.where(torch.arange(5) < lengths, path_indices, torch.full_like(path_indices, int(VIRTUAL_PATH_INDICATOR)))
+    before = path_indices.clone()
+
+    fused = model._init_path(None, triplet_h, path_indices)
+    reference = per_position_init_path(model, triplet_h, path_indices)
+    assert torch.equal(path_indices, before)
+    assert torch.allclose(fused, reference, atol=1e-6)
+
+    params = [triplet_h] + list(model.trip_fortrans.parameters())
+    fused_grads = torch.autograd.grad(fused.square().sum(), params)
+    reference_grads = torch.autograd.grad(reference.square().sum(), params)
+    for fused_grad, reference_grad in zip(fused_grads, reference_grads):
+        assert torch.allclose(fused_grad, reference_grad, atol=1e-5)
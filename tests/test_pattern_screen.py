@@ -0,0 +1,36 @@
+import pytest
+from rdkit import Chem
+from rdkit.Chem import QED as RDKitQED
+
+from src.data.descriptors import QED
+from src.data.descriptors.fusedDescriptors import _ACCEPTORS, _ALERTS, _qedProperties
+from src.data.descriptors.patternScreen import molKinds
+
+SMILES = ['CCO', 'c1ccccc1', 'CC(=O)Oc1ccccc1C(=O)O', 'CN1CCC[C@H]1c1cccnc1', 'O=C1CN=C(c2ccccc2)c2cc(Cl)ccc2N1',
+          'CC(=O)Nc1ccc(O)cc1', 'O=[N+]([O-])c1ccc(Br)cc1', 'C=CC(=O)OCC', 'CC(C)=NO', 'OO', 'CCSSCC', 'ClC(Cl)(Cl)Cl',
+          'O=C(Cl)c1ccccc1', 'CCOP(=O)(OCC)SC', 'N#Cc1ccncc1', 'c1ccc2ncccc2c1', 'O=S(=O)(N)c1ccc(F)cc1',
+          'C1CO1', 'CN=C=S', '[13CH4]', '[2H]OC', 'NNc1ccccc1', 'OB(O)c1ccccc1', 'C[Si](C)(C)Cl', '[Na+].[O-]C(=O)C',
+          'O=C1C=CC(=O)C=C1', 'CCCCCCCCCCCCCCCC(=O)O', 'C1=CC=CC=CC=C1', 'Fc1c(F)c(F)c(F)c(F)c1F', 'CC(=O)OO']
+
+
+def unscreened_counts(mol):
+    # every pattern searched, as RDKit's QED does
+    mol = Chem.RemoveHs(mol)
+    hba = sum(len(mol.GetSubstructMatches(pattern)) for pattern in RDKitQED.Acceptors)
+    alerts = sum(1 for pattern in RDKitQED.StructuralAlerts if mol.HasSubstructMatch(pattern))
+    return hba, alerts
+
+
+@pytest.mark.parametrize('smiles', SMILES)
+def test_screened_counts_match_unscreened(smiles):
+    mol = Chem.MolFromSmiles(smiles)
+    hba, alerts = unscreened_counts(mol)
+    kinds = molKinds(mol)
+    assert (_ACCEPTORS.countMatches(mol, kinds), _ALERTS.countMatching(mol, kinds)) == (hba, alerts)
+    expected = RDKitQED.properties(mol)
+    assert (expected.HBA, expected.ALERTS) == (hba, alerts)
+    # the fused RDKit2D path and the vendored QED.properties use the screens
+    fused = _qedProperties(mol)
+    assert (fused.HBA, fused.ALERTS) == (hba, alerts)
+    vendored = QED.properties(mol)
+    assert (vendored[2], vendored[7]) == (hba, alerts)